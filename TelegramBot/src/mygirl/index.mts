@@ -8,6 +8,7 @@ import { ExchangeMessageData, GPTResponseData } from '../types/index.js'
 import { chatGPTAPI } from './chatgpt-api.mjs'
 import { WebsocketClient } from './websocket-client.mjs'
 import { textToVoice } from './text-to-voice.mjs'
+import { waitForPicture } from './picture-job.mjs'
 import PromiseQueue from '../utils/promise-queue.mjs'
 import { splitParagraphToShorterParts } from '../utils/text.mjs'
 
@@ -63,7 +64,11 @@ class App {
           console.log('chatGPTAPI.sendMessage result', result)
           await this.parentMessageIds?.set(data.chat.id, result.id)
 
-          const { content: textContent, imageBase64: imageContent } = JSON.parse(result.text) as GPTResponseData
+          const {
+            content: textContent,
+            imageBase64: imageContent,
+            imageJobId,
+          } = JSON.parse(result.text) as GPTResponseData
           const textContentParts = splitParagraphToShorterParts(textContent)
           const queue = new PromiseQueue()
 
@@ -118,15 +123,20 @@ class App {
             })
           })
 
-          if (imageContent !== '') {
+          if (imageContent !== '' || imageJobId !== undefined) {
             queue.add(async () => {
+              // the picture comes inline, or later from its job
+              const picture = imageContent !== '' ? imageContent : await waitForPicture(imageJobId as string)
+              if (picture === '') {
+                return
+              }
               // reply image
               this.websocketClient.replyMessageRequest({
                 user: data.user,
                 chat: data.chat,
                 message: {
                   type: 'image',
-                  content: imageContent,
+                  content: picture,
                   id: data.message.id,
                 },
                 options: data.options,
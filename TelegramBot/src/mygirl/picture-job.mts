@@ -0,0 +1,28 @@
+import axios from 'axios'
+import dotenv from 'dotenv'
+
+import { sleep } from '../utils/sleep.mjs'
+
+dotenv.config()
+
+// The GPT server returns the text first and makes the picture in the background,
+// wait for it at /v1/images/jobs/<id>. Resolves to '' when there is no picture.
+export const waitForPicture = async (jobId: string, timeoutMs = 200000, intervalMs = 2000): Promise<string> => {
+  // @ts-ignore
+  const url = new URL(`/v1/images/jobs/${jobId}`, process.env.GPT_SERVER).toString()
+  const deadline = Date.now() + timeoutMs
+  while (Date.now() < deadline) {
+    try {
+      const { data } = await axios.get(url)
+      if (data.status !== 'queued' && data.status !== 'running') {
+        console.log('picture job finished', jobId, data.status)
+        return data.status === 'done' ? data.imageBase64 : ''
+      }
+    } catch (e) {
+      console.log('picture job request failed', jobId, e)
+      return ''
+    }
+    await sleep(intervalMs)
+  }
+  return ''
+}
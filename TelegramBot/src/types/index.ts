@@ -22,4 +22,5 @@ export interface ExchangeMessageData {
 export interface GPTResponseData {
   content: string
   imageBase64: string
+  imageJobId?: string
 }
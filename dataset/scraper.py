@@ -1,6 +1,7 @@
 import asyncio
 import re
-import time
+import sys
+from pathlib import Path
 from urllib.parse import urljoin, urlparse
 
 import httpx
@@ -9,61 +10,16 @@ import yaml
 from aiolimiter import AsyncLimiter
 from selectolax.parser import HTMLParser
 
+# robots.txt handling is shared with the crawler in src/crawler
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from src.crawler.robots import RobotsCache  # noqa: E402
 
-class RobotsCache:
-    def __init__(self, client: httpx.AsyncClient, user_agent: str):
-        self.client = client
-        self.user_agent = user_agent
-        self.cache: dict[str, tuple[float, list[tuple[str, bool]]]] = {}
 
-    async def allowed(self, url: str) -> bool:
-        parsed = urlparse(url)
-        base = f"{parsed.scheme}://{parsed.netloc}"
-        now = time.time()
-        rules = self.cache.get(base)
-        if rules is None or now - rules[0] > 3600:
-            robots_url = urljoin(base, "/robots.txt")
-            try:
-                resp = await self.client.get(robots_url, timeout=10)
-                text = resp.text if resp.status_code == 200 else ""
-            except Exception:
-                text = ""
-            parsed_rules = self._parse(text)
-            self.cache[base] = (now, parsed_rules)
-            rules = self.cache[base]
-        return self._check(rules[1], url)
-
-    def _parse(self, robots_text: str) -> list[tuple[str, bool]]:
-        agent = None
-        disallows: list[str] = []
-        allows: list[str] = []
-        for line in robots_text.splitlines():
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            if line.lower().startswith('user-agent:'):
-                agent = line.split(':', 1)[1].strip()
-            elif agent in ('*', 'MyGirlGPTScraper'):
-                if line.lower().startswith('disallow:'):
-                    path = line.split(':', 1)[1].strip()
-                    if path:
-                        disallows.append(path)
-                elif line.lower().startswith('allow:'):
-                    path = line.split(':', 1)[1].strip()
-                    if path:
-                        allows.append(path)
-        rules: list[tuple[str, bool]] = [(p, False) for p in disallows] + [(p, True) for p in allows]
-        return rules
-
-    def _check(self, rules: list[tuple[str, bool]], url: str) -> bool:
-        path = urlparse(url).path or '/'
-        decision = True
-        match_len = -1
-        for rule, allow in rules:
-            if path.startswith(rule) and len(rule) > match_len:
-                decision = allow
-                match_len = len(rule)
-        return decision
+def fetch_robots(client: httpx.AsyncClient):
+    async def fetch(robots_url: str) -> str | None:
+        resp = await client.get(robots_url, timeout=10)
+        return resp.text if resp.status_code == 200 else None
+    return fetch
 
 
 def is_allowed_start_url(url: str, allowlist: list[str]) -> bool:
@@ -115,7 +71,12 @@ async def crawl(config_path: str = './dataset/config.yaml'):
     raw_dir = cfg['raw_dir']
 
     client = httpx.AsyncClient(headers={'User-Agent': ua}, follow_redirects=True, timeout=timeout)
-    robots = RobotsCache(client, ua)
+    robots = RobotsCache(
+        ua,
+        fetch_robots(client),
+        ttl_seconds=cfg.get('robots_ttl_seconds', 3600),
+        cache_path=cfg.get('robots_cache_path'),
+    )
 
     limiter_by_host: dict[str, AsyncLimiter] = {}
     seen: set[str] = set()
@@ -179,6 +140,7 @@ async def crawl(config_path: str = './dataset/config.yaml'):
     await queue.join()
     for t in tasks:
         t.cancel()
+    robots.close()
     await client.aclose()
 
 
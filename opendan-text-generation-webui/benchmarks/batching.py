@@ -0,0 +1,90 @@
+'''
+Measures the aggregate generation throughput of concurrent clients with and
+without --continuous-batching, using a small transformers model on the CPU.
+
+Example:
+python benchmarks/batching.py --model sshleifer/tiny-gpt2
+
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from threading import Thread
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='sshleifer/tiny-gpt2', help='Hugging Face id or local path of the model to benchmark.')
+parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64], help='Numbers of concurrent clients to measure.')
+parser.add_argument('--max-new-tokens', type=int, default=64)
+parser.add_argument('--max-batch-size', type=int, default=64)
+parser.add_argument('--prompt', type=str, default='Once upon a time, in a quiet little town by the sea,')
+args = parser.parse_args()
+
+# modules.shared parses the command line when it is imported
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.argv = [sys.argv[0], '--cpu', '--max-batch-size', str(args.max_batch_size)]
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import modules.shared as shared
+from modules.text_generation import generate_reply
+
+state = {
+    'max_new_tokens': args.max_new_tokens,
+    'seed': -1,
+    'do_sample': True,
+    'temperature': 0.7,
+    'top_p': 0.9,
+    'typical_p': 1,
+    'repetition_penalty': 1.15,
+    'encoder_repetition_penalty': 1,
+    'top_k': 40,
+    'min_length': 0,
+    'no_repeat_ngram_size': 0,
+    'num_beams': 1,
+    'penalty_alpha': 0,
+    'length_penalty': 1,
+    'early_stopping': False,
+    'add_bos_token': True,
+    'ban_eos_token': True,  # every client generates exactly max_new_tokens
+    'truncation_length': 2048,
+    'custom_stopping_strings': '',
+    'skip_special_tokens': True,
+    'stream': True,
+}
+
+
+def run_client():
+    for _ in generate_reply(args.prompt, state):
+        pass
+
+
+def measure(clients):
+    threads = [Thread(target=run_client) for _ in range(clients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return clients * args.max_new_tokens / (time.time() - t0)
+
+
+if __name__ == '__main__':
+    shared.model = AutoModelForCausalLM.from_pretrained(args.model)
+    shared.tokenizer = AutoTokenizer.from_pretrained(args.model)
+    shared.model_name = args.model
+    shared.model_type = 'HF_generic'
+
+    results = {}
+    for batching in [False, True]:
+        shared.args.continuous_batching = batching
+        measure(1)  # warmup
+        for clients in args.clients:
+            results[(batching, clients)] = measure(clients)
+
+    print(f"\n{'clients':>8} | {'unbatched tokens/s':>19} | {'batched tokens/s':>17} | {'speedup':>7}")
+    for clients in args.clients:
+        unbatched, batched = results[(False, clients)], results[(True, clients)]
+        print(f"{clients:>8} | {unbatched:>19.1f} | {batched:>17.1f} | {batched / unbatched:>6.2f}x")
@@ -0,0 +1,69 @@
+'''
+Compares the cost of streaming a long reply by decoding all the new tokens
+at every step against the incremental StreamingDetokenizer, and checks that
+both produce the same text.
+
+Example:
+python benchmarks/detokenizer.py --tokenizer gpt2 hf-internal-testing/llama-tokenizer
+
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from transformers import AutoTokenizer
+
+from modules.detokenizer import StreamingDetokenizer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tokenizer', type=str, nargs='+', default=['gpt2'], help='Hugging Face ids or local paths of the tokenizers to benchmark.')
+parser.add_argument('--tokens', type=int, default=2048, help='Length of the reply in tokens.')
+args = parser.parse_args()
+
+PROMPT = 'You: Tell me a long story.\nAssistant:'
+TEXT = "Once upon a time, in a quiet little town by the sea, there lived a girl named Mia. Elle aimait les crêpes 🥞 et le café ☕, 但是她最喜欢的是大海。 "
+
+
+def full_decode(tokenizer, prompt_ids, reply_ids):
+    output = prompt_ids + reply_ids
+    for i in range(1, len(reply_ids) + 1):
+        reply = tokenizer.decode(output[len(prompt_ids):len(prompt_ids) + i], skip_special_tokens=True)
+
+    return reply
+
+
+def incremental_decode(tokenizer, prompt_ids, reply_ids):
+    output = prompt_ids + reply_ids
+    detokenizer = StreamingDetokenizer(tokenizer, prompt_ids)
+    for i in range(1, len(reply_ids) + 1):
+        reply = detokenizer.update(output[:len(prompt_ids) + i])
+
+    return reply
+
+
+if __name__ == '__main__':
+    print(f"{'tokenizer':>40} | {'full decode (ms)':>16} | {'incremental (ms)':>16} | {'speedup':>7} | same text")
+    for name in args.tokenizer:
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        prompt_ids = tokenizer.encode(PROMPT)
+        reply_ids = []
+        while len(reply_ids) < args.tokens:
+            reply_ids += tokenizer.encode(TEXT, add_special_tokens=False)
+
+        reply_ids = reply_ids[:args.tokens]
+        results = []
+        for func in [full_decode, incremental_decode]:
+            t0 = time.time()
+            reply = func(tokenizer, prompt_ids, reply_ids)
+            results.append((time.time() - t0, reply))
+
+        (full_time, full_reply), (incremental_time, incremental_reply) = results
+
+        # The full decode drops the leading space of the reply with SentencePiece tokenizers,
+        # and the incremental one holds back a character that was cut in half by --tokens
+        same = full_reply.rstrip('\ufffd').strip() == incremental_reply.strip()
+        print(f"{name:>40} | {full_time * 1000:>16.1f} | {incremental_time * 1000:>16.1f} | {full_time / incremental_time:>6.1f}x | {same}")
@@ -3,7 +3,8 @@
 Converts a transformers model to safetensors format and shards it.
 
 This makes it faster to load (because of safetensors) and lowers its RAM usage
-while loading (because of sharding).
+while loading (because of sharding). Start the server with --fast-load to
+memory-map the shards straight to the GPU.
 
 Based on the original script by 81300:
 
@@ -11,14 +11,35 @@ import base64
 import datetime
 import hashlib
 import json
+import os
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
 import tqdm
+from requests.adapters import HTTPAdapter
 from tqdm.contrib.concurrent import thread_map
 
+BLOCK_SIZE = 1024 * 1024
+
+# The files larger than this are split into ranges of this size
+PART_SIZE = 64 * 1024 * 1024
+
+# The sizes and byte ranges are those of the stored files
+NO_ENCODING = {'Accept-Encoding': 'identity'}
+
+session = requests.Session()
+
+
+def set_pool_size(size):
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
 
 def select_model_from_default_options():
     models = {
@@ -98,7 +119,7 @@ def get_download_links_from_huggingface(model, branch, text_only=False):
     is_lora = False
     while True:
         url = f"{base}{page}" + (f"?cursor={cursor.decode()}" if cursor else "")
-        r = requests.get(url)
+        r = session.get(url)
         r.raise_for_status()
         content = r.content
 
@@ -164,37 +185,220 @@ def get_output_folder(model, branch, is_lora, base_folder=None):
     return output_folder
 
 
-def get_single_file(url, output_folder, start_from_scratch=False):
-    filename = Path(url.rsplit('/', 1)[1])
-    output_path = output_folder / filename
-    if output_path.exists() and not start_from_scratch:
-        # Check if the file has already been downloaded completely
-        r = requests.get(url, stream=True)
-        total_size = int(r.headers.get('content-length', 0))
-        if output_path.stat().st_size >= total_size:
+def get_file_info(url):
+    # Only the headers are needed to decide whether and how to resume
+    r = session.head(url, headers=NO_ENCODING, allow_redirects=True)
+    r.raise_for_status()
+    total_size = int(r.headers.get('content-length', 0))
+    accepts_ranges = r.headers.get('accept-ranges', '') == 'bytes'
+    return total_size, accepts_ranges, r.headers.get('etag', '')
+
+
+def hash_file(path, hasher=None, end=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = end if end is not None else float('inf')
+        while remaining > 0:
+            data = f.read(int(min(BLOCK_SIZE, remaining)))
+            if not data:
+                break
+
+            hasher.update(data)
+            remaining -= len(data)
+
+    return hasher
+
+
+def get_manifest_path(output_path):
+    return output_path.with_name(output_path.name + '.parts.json')
+
+
+class ChunkedDownload:
+
+    """
+    Downloads a file as byte ranges fetched in parallel. The progress of
+    each range is kept in a .parts.json manifest next to the file, so that
+    an interrupted download resumes every range where it stopped. The file
+    is hashed in order as its beginning gets complete, while the data is
+    still in the page cache.
+    """
+
+    def __init__(self, url, output_path, total_size, etag, connections, progress):
+        self.url = url
+        self.output_path = output_path
+        self.manifest_path = get_manifest_path(output_path)
+        self.total_size = total_size
+        self.etag = etag
+        self.connections = connections
+        self.progress = progress
+        self.condition = threading.Condition()
+        self.error = None
+        self.last_save = 0
+        self.parts = None
+
+    def load_manifest(self):
+        if self.manifest_path.exists() and self.output_path.exists():
+            manifest = json.loads(self.manifest_path.read_text())
+            if manifest['size'] == self.total_size and manifest['etag'] == self.etag:
+                return manifest['parts']
+
+        return None
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        tmp_path.write_text(json.dumps({'size': self.total_size, 'etag': self.etag, 'parts': self.parts}))
+        os.replace(tmp_path, self.manifest_path)
+        self.last_save = time.time()
+
+    # End of the part of the file that is complete from its beginning
+    def complete_until(self):
+        for start, end, written in self.parts:
+            if start + written < end:
+                return start + written
+
+        return self.total_size
+
+    def fetch(self, part):
+        start, end, written = part
+        if start + written >= end:
             return
-        # Otherwise, resume the download from where it left off
-        headers = {'Range': f'bytes={output_path.stat().st_size}-'}
-        mode = 'ab'
-    else:
-        headers = {}
-        mode = 'wb'
-
-    r = requests.get(url, stream=True, headers=headers)
-    with open(output_path, mode) as f:
-        total_size = int(r.headers.get('content-length', 0))
-        block_size = 1024
-        with tqdm.tqdm(total=total_size, unit='iB', unit_scale=True, bar_format='{l_bar}{bar}| {n_fmt:6}/{total_fmt:6} {rate_fmt:6}') as t:
-            for data in r.iter_content(block_size):
-                t.update(len(data))
+
+        headers = dict(NO_ENCODING, Range=f'bytes={start + written}-{end - 1}')
+        r = session.get(self.url, stream=True, headers=headers)
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f'The server ignored the byte range requested for {self.url}')
+
+        with open(self.output_path, 'r+b') as f:
+            f.seek(start + written)
+            for data in r.iter_content(BLOCK_SIZE):
+                if self.error is not None:
+                    return
+
+                data = data[:end - start - part[2]]
                 f.write(data)
+                f.flush()
+                with self.condition:
+                    part[2] += len(data)
+                    self.progress.update(len(data))
+                    if time.time() - self.last_save > 1:
+                        self.save_manifest()
+
+                    self.condition.notify_all()
+
+        if start + part[2] < end:
+            raise IOError(f'The connection was closed before the end of the byte range requested for {self.url}')
+
+    def fetched(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            with self.condition:
+                self.error = self.error or future.exception()
+                self.condition.notify_all()
+
+    def hash(self):
+        hasher = hashlib.sha256()
+        offset = 0
+        # Unbuffered, a buffered reader would read ahead into the zeros past complete_until()
+        with open(self.output_path, 'rb', buffering=0) as f:
+            while offset < self.total_size:
+                with self.condition:
+                    while self.complete_until() <= offset and self.error is None:
+                        self.condition.wait()
+
+                    if self.error is not None:
+                        return None
+
+                    end = self.complete_until()
+
+                while offset < end:
+                    data = f.read(min(BLOCK_SIZE, end - offset))
+                    if not data:
+                        raise IOError(f'{self.output_path} is shorter than the part that was written')
+
+                    hasher.update(data)
+                    offset += len(data)
+
+        return hasher.hexdigest()
+
+    def run(self, resume=True):
+        self.parts = self.load_manifest() if resume else None
+        if self.parts is None:
+            self.parts = [[start, min(start + PART_SIZE, self.total_size), 0] for start in range(0, self.total_size, PART_SIZE)]
+            with open(self.output_path, 'wb') as f:
+                f.truncate(self.total_size)
+
+            self.save_manifest()
+
+        self.progress.update(sum(part[2] for part in self.parts))
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for part in self.parts:
+                executor.submit(self.fetch, part).add_done_callback(self.fetched)
+
+            digest = self.hash()
+            if digest is None:
+                executor.shutdown(cancel_futures=True)
+
+        with self.condition:
+            if self.error is not None:
+                self.save_manifest()
+                raise self.error
+
+        self.manifest_path.unlink()
+        return digest
+
+
+def download_stream(url, output_path, start_from_scratch, progress):
+    hasher = hashlib.sha256()
+    offset = 0 if start_from_scratch or not output_path.exists() else output_path.stat().st_size
+    headers = dict(NO_ENCODING, Range=f'bytes={offset}-') if offset > 0 else NO_ENCODING
+    r = session.get(url, stream=True, headers=headers)
+    r.raise_for_status()
+
+    # The server may send the whole file instead of the rest of it
+    if offset > 0 and r.status_code != 206:
+        offset = 0
+
+    if offset > 0:
+        hash_file(output_path, hasher, end=offset)
+        progress.update(offset)
+
+    with open(output_path, 'ab' if offset > 0 else 'wb') as f:
+        for data in r.iter_content(BLOCK_SIZE):
+            hasher.update(data)
+            f.write(data)
+            progress.update(len(data))
+
+    return hasher.hexdigest()
+
+
+# Returns the sha256 of the downloaded file, or None if it was already there
+def get_single_file(url, output_folder, start_from_scratch=False, connections=1):
+    filename = Path(url.rsplit('/', 1)[1])
+    output_path = output_folder / filename
+    manifest_path = get_manifest_path(output_path)
+    total_size, accepts_ranges, etag = get_file_info(url)
 
+    # A file with a manifest was preallocated by an interrupted chunked download
+    if output_path.exists() and not start_from_scratch and not manifest_path.exists() and output_path.stat().st_size >= total_size:
+        return None
 
-def start_download_threads(file_list, output_folder, start_from_scratch=False, threads=1):
-    thread_map(lambda url: get_single_file(url, output_folder, start_from_scratch=start_from_scratch), file_list, max_workers=threads, disable=True)
+    chunked = accepts_ranges and total_size > 0 and (manifest_path.exists() or (connections > 1 and total_size > PART_SIZE))
+    if not chunked and manifest_path.exists():
+        manifest_path.unlink()
+        start_from_scratch = True
 
+    with tqdm.tqdm(total=total_size, unit='iB', unit_scale=True, bar_format='{l_bar}{bar}| {n_fmt:6}/{total_fmt:6} {rate_fmt:6}') as t:
+        if chunked:
+            return ChunkedDownload(url, output_path, total_size, etag, connections, t).run(resume=not start_from_scratch)
+        else:
+            return download_stream(url, output_path, start_from_scratch, t)
 
-def download_model_files(model, branch, links, sha256, output_folder, start_from_scratch=False, threads=1):
+
+def start_download_threads(file_list, output_folder, start_from_scratch=False, threads=1, connections=1):
+    return thread_map(lambda url: get_single_file(url, output_folder, start_from_scratch=start_from_scratch, connections=connections), file_list, max_workers=threads, disable=True)
+
+
+def download_model_files(model, branch, links, sha256, output_folder, start_from_scratch=False, threads=1, connections=8):
     # Creating the folder and writing the metadata
     if not output_folder.exists():
         output_folder.mkdir()
@@ -210,7 +414,16 @@ def download_model_files(model, branch, links, sha256, output_folder, start_from
 
     # Downloading the files
     print(f"Downloading the model to {output_folder}")
-    start_download_threads(links, output_folder, start_from_scratch=start_from_scratch, threads=threads)
+    set_pool_size(threads * connections)
+    digests = start_download_threads(links, output_folder, start_from_scratch=start_from_scratch, threads=threads, connections=connections)
+
+    # The files were hashed while they were written
+    expected = dict((fname, file_hash) for fname, file_hash in sha256)
+    for url, digest in zip(links, digests):
+        fname = url.rsplit('/', 1)[1]
+        if digest is not None and fname in expected and digest != expected[fname]:
+            print(f'Checksum failed: {fname}  {expected[fname]}')
+            print('[-] Rerun download-model.py with the --clean flag.')
 
 
 def check_model_files(model, branch, links, sha256, output_folder):
@@ -224,14 +437,12 @@ def check_model_files(model, branch, links, sha256, output_folder):
             validated = False
             continue
 
-        with open(output_folder / sha256[i][0], "rb") as f:
-            bytes = f.read()
-            file_hash = hashlib.sha256(bytes).hexdigest()
-            if file_hash != sha256[i][1]:
-                print(f'Checksum failed: {sha256[i][0]}  {sha256[i][1]}')
-                validated = False
-            else:
-                print(f'Checksum validated: {sha256[i][0]}  {sha256[i][1]}')
+        file_hash = hash_file(fpath).hexdigest()
+        if file_hash != sha256[i][1]:
+            print(f'Checksum failed: {sha256[i][0]}  {sha256[i][1]}')
+            validated = False
+        else:
+            print(f'Checksum validated: {sha256[i][0]}  {sha256[i][1]}')
 
     if validated:
         print('[+] Validated checksums of all model files!')
@@ -245,6 +456,7 @@ if __name__ == '__main__':
     parser.add_argument('MODEL', type=str, default=None, nargs='?')
     parser.add_argument('--branch', type=str, default='main', help='Name of the Git branch to download from.')
     parser.add_argument('--threads', type=int, default=1, help='Number of files to download simultaneously.')
+    parser.add_argument('--connections', type=int, default=8, help='Number of byte ranges of each large file to download simultaneously.')
     parser.add_argument('--text-only', action='store_true', help='Only download text files (txt/json).')
     parser.add_argument('--output', type=str, default=None, help='The folder where the model should be saved.')
     parser.add_argument('--clean', action='store_true', help='Does not resume the previous download.')
@@ -274,4 +486,4 @@ if __name__ == '__main__':
         check_model_files(model, branch, links, sha256, output_folder)
     else:
         # Download files
-        download_model_files(model, branch, links, sha256, output_folder, threads=args.threads)
+        download_model_files(model, branch, links, sha256, output_folder, start_from_scratch=args.clean, threads=args.threads, connections=args.connections)
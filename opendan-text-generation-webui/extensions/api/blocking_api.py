@@ -2,7 +2,8 @@ import json
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
 
-from modules import shared
+from modules import metrics, shared
+from modules.session import Session
 from modules.text_generation import encode, generate_reply
 
 from extensions.api.util import build_parameters, try_start_cloudflared
@@ -18,6 +19,11 @@ class Handler(BaseHTTPRequestHandler):
             })
 
             self.wfile.write(response.encode('utf-8'))
+        elif self.path == '/metrics':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(metrics.render().encode('utf-8'))
         else:
             self.send_error(404)
 
@@ -36,7 +42,7 @@ class Handler(BaseHTTPRequestHandler):
             generate_params['stream'] = False
 
             generator = generate_reply(
-                prompt, generate_params, stopping_strings=stopping_strings)
+                prompt, generate_params, stopping_strings=stopping_strings, session=Session(route='/api/v1/generate'))
 
             answer = ''
             for a in generator:
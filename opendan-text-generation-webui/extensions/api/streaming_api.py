@@ -4,6 +4,7 @@ from websockets.server import serve
 from threading import Thread
 
 from modules import shared
+from modules.session import Session
 from modules.text_generation import generate_reply
 
 from extensions.api.util import build_parameters, try_start_cloudflared
@@ -26,7 +27,7 @@ async def _handle_connection(websocket, path):
         generate_params['stream'] = True
 
         generator = generate_reply(
-            prompt, generate_params, stopping_strings=stopping_strings)
+            prompt, generate_params, stopping_strings=stopping_strings, session=Session(route=PATH))
 
         # As we stream, only send the new bytes.
         skip_index = len(prompt) if not shared.is_chat() else 0
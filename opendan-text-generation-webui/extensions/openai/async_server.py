@@ -0,0 +1,238 @@
+'''
+asyncio front end for the OpenAI compatible API.
+
+Connections are accepted and parsed on a single event loop with HTTP/1.1
+keep-alive, while the requests themselves run on a bounded pool of worker
+threads through the regular Handler class. Requests beyond max_concurrency
+wait in a queue of at most max_queue entries; anything past that is answered
+with 429 right away. When a client goes away, the next write of its worker
+fails and the generation is stopped.
+'''
+
+import asyncio
+import io
+import http.client
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class ResponseWriter:
+
+    """
+    File-like object handed to the Handler as wfile. The bytes are sent
+    from the event loop, the response is framed with chunked encoding when
+    the Handler doesn't set a Content-Length, and any write after the client
+    disconnected raises BrokenPipeError.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.headers_sent = False
+        self.chunked = False
+        self.close = False
+        self.buffer = b''
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.buffer += data
+            end = self.buffer.find(b'\r\n\r\n')
+            if end == -1:
+                return len(data)
+
+            head, data = self._frame_headers(self.buffer[:end]), self.buffer[end + 4:]
+            self.headers_sent = True
+            self.buffer = b''
+            self.connection.send(head)
+
+        if len(data) > 0:
+            self.connection.send(b'%x\r\n%s\r\n' % (len(data), data) if self.chunked else data)
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self.chunked:
+            self.connection.send(b'0\r\n\r\n')
+
+    def _frame_headers(self, head):
+        lines = head.split(b'\r\n')
+        names = [line.split(b':', 1)[0].strip().lower() for line in lines[1:]]
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'connection' and value.strip().lower() == b'close':
+                self.close = True
+
+        # 1xx, 204 and 304 responses have no body
+        status = int(lines[0].split(b' ')[1])
+        if b'content-length' not in names and b'transfer-encoding' not in names and status >= 200 and status not in (204, 304):
+            self.chunked = True
+            lines.append(b'Transfer-Encoding: chunked')
+
+        if self.connection.keep_alive and not self.close:
+            lines.append(b'Connection: keep-alive')
+
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+class Connection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+        self.client_address = writer.get_extra_info('peername')
+
+    def disconnected(self):
+        return self.reader.at_eof() or self.writer.transport.is_closing()
+
+    # Called from a worker thread, waits until the bytes are handed to the transport
+    def send(self, data):
+        if self.disconnected():
+            raise BrokenPipeError('Client disconnected')
+
+        asyncio.run_coroutine_threadsafe(self._send(data), self.server.loop).result()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read_request(self):
+        try:
+            head = await self.reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            await self.send_error(431, 'Request header fields too large')
+            return None
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            command, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            await self.send_error(400, 'Bad request syntax')
+            return None
+
+        headers = http.client.parse_headers(io.BytesIO(head[len(lines[0]) + 2:]))
+        connection = headers.get('Connection', '').lower()
+        self.keep_alive = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+
+        if headers.get('Expect', '').lower() == '100-continue':
+            await self._send(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+
+                body += chunk[:-2]
+
+            # Handler reads the body through Content-Length
+            del headers['Transfer-Encoding']
+            headers['Content-Length'] = str(len(body))
+        else:
+            body = await self.reader.readexactly(int(headers.get('Content-Length', 0)))
+
+        return command, path, version, headers, body
+
+    async def send_error(self, code, message, extra_headers=()):
+        body = json.dumps({'error': {'message': message, 'type': 'server_error', 'code': code}}).encode('utf-8')
+        head = [f'HTTP/1.1 {code} {http.client.responses.get(code, "")}', 'Content-Type: application/json', f'Content-Length: {len(body)}']
+        head += extra_headers
+        head.append('Connection: keep-alive' if self.keep_alive else 'Connection: close')
+        await self._send(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+    async def serve(self):
+        try:
+            while self.keep_alive:
+                request = await self.read_request()
+                if request is None:
+                    break
+
+                if self.server.inflight >= self.server.max_concurrency + self.server.max_queue:
+                    await self.send_error(429, 'The server is busy, please retry later.', ['Retry-After: 1'])
+                    continue
+
+                self.server.inflight += 1
+                try:
+                    await self.server.loop.run_in_executor(self.server.executor, self.handle, time.time(), *request)
+                finally:
+                    self.server.inflight -= 1
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.writer.close()
+
+    # Runs the Handler on a worker thread. queued_at tells the Handler how
+    # long the request waited for a free worker.
+    def handle(self, queued_at, command, path, version, headers, body):
+        if self.disconnected():
+            return
+
+        wfile = ResponseWriter(self)
+        handler = self.server.handler_class.__new__(self.server.handler_class)
+        handler.client_address = self.client_address
+        handler.server = self.server
+        handler.command, handler.path, handler.request_version = command, path, version
+        handler.requestline = f'{command} {path} {version}'
+        handler.headers = headers
+        handler.rfile = io.BytesIO(body)
+        handler.wfile = wfile
+        handler.close_connection = not self.keep_alive
+        handler.protocol_version = 'HTTP/1.1'
+        handler.client_disconnected = self.disconnected
+        handler.queued_at = queued_at
+
+        method = getattr(handler, f'do_{command}', None)
+        try:
+            if method is None:
+                handler.send_error(501, f'Unsupported method ({command})')
+            else:
+                method()
+
+            wfile.finish()
+        except (BrokenPipeError, ConnectionError):
+            print(f'Client {self.client_address} disconnected, stopped {command} {path}')
+            self.keep_alive = False
+            return
+        except Exception:
+            traceback.print_exc()
+            self.keep_alive = False
+            if not wfile.headers_sent and not self.disconnected():
+                handler.send_error(500)
+
+            return
+
+        if wfile.close or handler.close_connection or not wfile.headers_sent:
+            self.keep_alive = False
+
+
+class AsyncServer:
+    def __init__(self, server_address, handler_class, max_concurrency, max_queue):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='openai-worker')
+        self.inflight = 0
+        self.loop = None
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._accept, *self.server_address, limit=MAX_HEADER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    async def _accept(self, reader, writer):
+        await Connection(self, reader, writer).serve()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
 # preload the embedding model, useful for Docker images to prevent re-download on config change
+# it also embeds the character greetings into the on-disk vector cache, so run it from the
+# text-generation-webui directory (or pass the characters directory as the first argument)
 # Dockerfile:
 # ENV OPENEDAI_EMBEDDING_MODEL=all-mpnet-base-v2 # Optional
 # RUN python3 cache_embedded_model.py
-import os, sentence_transformers
+import os, sys, sentence_transformers
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from extensions.openai import embeddings
+
 st_model = os.environ["OPENEDAI_EMBEDDING_MODEL"] if "OPENEDAI_EMBEDDING_MODEL" in os.environ else "all-mpnet-base-v2"
 model = sentence_transformers.SentenceTransformer(st_model)
+
+cache_dir = os.environ.get('OPENEDAI_EMBEDDING_CACHE', 'cache/embeddings')
+characters_dir = sys.argv[1] if len(sys.argv) > 1 else 'characters'
+if cache_dir:
+    embeddings.warm_up(embeddings.EmbeddingService(model, st_model, cache_dir, batch_window=0), embeddings.character_texts(characters_dir))
@@ -1,11 +1,9 @@
 import base64
 import io
 import re
-import time
 from datetime import date
 from pathlib import Path
 
-import requests
 import json
 import yaml
 from PIL import Image
@@ -16,6 +14,10 @@ from openai.error import RateLimitError, APIError, Timeout
 import logging
 from dotenv import load_dotenv, find_dotenv
 
+from extensions.openai.picdecision import PictureDecider
+from extensions.openai.translations import TranslationTable
+from modules import http_client
+
 
 logging.basicConfig(
     level=logging.INFO,
@@ -52,6 +54,7 @@ params = {
     'steps': 20,
     'cfg_scale': 7,
     'translations': True,
+    'timeout': 120,  # seconds to wait for one txt2img request
     # NSFW options
     'nsfw_mode': nsfw_mode_env,
     'nsfw_prompt_prefix': nsfw_prompt_env if nsfw_prompt_env else '(8k, best quality, masterpiece:1.2), (realistic, photo-realistic:1.37), ultra-detailed, ultra high res, 1 girl, solo',
@@ -59,20 +62,25 @@ params = {
     'nsfw_model': nsfw_model_env,
 }
 
+# reloaded when the file changes
+translations = TranslationTable('extensions/openai/translations.json')
+
 characterfocus = ""
-positive_suffix = ""
-negative_suffix = ""
 initial_string = ""
 picture_response = False  # specifies if the next model response should appear as a picture
 
+# Returns the decision itself rather than the picture_response global, which
+# concurrent requests overwrite
 def check_need_create_pic(stringList):
-    global initial_string, picture_response
+    global initial_string
     initial_string = stringList[-1].get("content")
-    string_evaluation(stringList)
-    logging.info(f'need to send image: {picture_response}')
-    return picture_response
+    is_need = string_evaluation(stringList)
+    logging.info(f'need to send image: {is_need}')
+    return is_need
 
-def get_picture(stringList):
+# initial_string is the message that triggered the picture, the one seen by
+# the last check_need_create_pic call if not given
+def get_picture(stringList, initial_string=None):
     prompt = get_sd_prompt(stringList)
     logging.info(f"{prompt}")
     prompt = remove_surrounded_chars(prompt)
@@ -82,7 +90,7 @@ def get_picture(stringList):
     prompt = prompt.replace('in front of a mirror', '')
     prompt = prompt.strip()
     toggle_generation(False)
-    string = get_sd_pictures(prompt)
+    string = get_sd_pictures(prompt, initial_string)
     return string
 
 def remove_surrounded_chars(string):
@@ -103,43 +111,17 @@ def string_evaluation(stringList):
     characterfocus = True
     is_need = need_to_send_image(stringList)
     logging.info(f'need to send image: {is_need}')
-    if is_need:  # check for trigger words for generation
-        return toggle_generation(True)
-    return toggle_generation(False)
-
-# Add NSFW tags if NSFW is enabled, add character sheet tags if character is describing itself
-def create_suffix():
-    global params, positive_suffix, negative_suffix, characterfocus
-    positive_suffix = ""
-    negative_suffix = ""
-    if characterfocus:
-        positive_suffix = ""
-        negative_suffix = ""
-
-def add_translations(description,triggered_array,tpatterns):
-    global positive_suffix, negative_suffix
-    i = 0
-    for word_pair in tpatterns['pairs']:
-        if triggered_array[i] != 1:
-            if any(target in description for target in word_pair['descriptive_word']):
-                if not positive_suffix:
-                    positive_suffix = word_pair['SD_positive_translation']
-                else:
-                    positive_suffix = positive_suffix + ", " + word_pair['SD_positive_translation']
-                negative_suffix = negative_suffix + ", " + word_pair['SD_negative_translation']
-                triggered_array[i] = 1
-        i = i + 1
-    return triggered_array
+    toggle_generation(bool(is_need))  # check for trigger words for generation
+    return bool(is_need)
 
 # Get and save the Stable Diffusion-generated picture
-def get_sd_pictures(description):
-    global params, initial_string
-    create_suffix()
+def get_sd_pictures(description, initial_string=None):
+    global params
+    if initial_string is None:
+        initial_string = globals()['initial_string']
+    positive_suffix, negative_suffix = "", ""
     if params['translations']:
-        tpatterns = json.loads(open(Path(f'extensions/openai/translations.json'), 'r', encoding='utf-8').read())
-        triggered_array = [0] * len(tpatterns['pairs'])
-        triggered_array = add_translations(initial_string,triggered_array,tpatterns)
-        add_translations(description,triggered_array,tpatterns)
+        positive_suffix, negative_suffix = translations.suffixes(initial_string, description)
 
     prompt_prefix = params['nsfw_prompt_prefix'] if params.get('nsfw_mode') else params['prompt_prefix']
     negative_prompt = params['nsfw_negative_prompt'] if params.get('nsfw_mode') else params['negative_prompt']
@@ -174,18 +156,13 @@ def get_sd_pictures(description):
             logging.info('does not use controlnet')
             pass
 
-    num_retries = 3
-    for attempt in range(num_retries):
-        try:
-            response = requests.post(url=f'{params["address"]}/sdapi/v1/txt2img', json=payload)
-            response.raise_for_status()
-            r = response.json()
-            break
-        except Exception as e:
-            logging.info(f"Get exception during generation pic: {e}")
-            if attempt == num_retries - 1:
-                return ""
-        time.sleep(1)
+    try:
+        response = http_client.post(f'{params["address"]}/sdapi/v1/txt2img', json=payload, timeout=params['timeout'])
+        response.raise_for_status()
+        r = response.json()
+    except Exception as e:
+        logging.info(f"Get exception during generation pic: {e}")
+        return ""
     visible_result = ""
     if len(r.get('images')) > 0:
         img_str = r.get('images')[0]
@@ -225,27 +202,28 @@ def load_image_file_as_base64(file):
         img = base64.b64encode(f.read()).decode()
     return img
 
+# Goes through http_client like the SD requests, for the per-host limit, the
+# retries with backoff, the circuit breaker and the metrics. The completion has
+# no side effects, so its timeouts are retried too.
 def get_completion_from_messages(messages, model="gpt-3.5-turbo", temperature=0):
-    num_retries = 3
-    for attempt in range(num_retries):
-        backoff = attempt
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=temperature, # this is the degree of randomness of the model's output
-                timeout=3, # set request timeout to 3 seconds
-            )
-            break
-        except Exception as e:
-            logging.info(f"Get exception: {attempt}, {e}")
-            if attempt == num_retries - 1:
-                return ""
-        time.sleep(backoff)
-    if response is None:
+    try:
+        response = http_client.post(
+            f'{openai.api_base.rstrip("/")}/chat/completions',
+            headers={'Authorization': f'Bearer {openai.api_key}'},
+            json={
+                'model': model,
+                'messages': messages,
+                'temperature': temperature, # this is the degree of randomness of the model's output
+            },
+            timeout=3, # set request timeout to 3 seconds
+            retries=3,
+            retry_timeouts=True,
+        )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+    except Exception as e:
+        logging.info(f"Get exception: {e}")
         return ""
-    else:
-        return response.choices[0].message["content"]
 
 sys_prompt= {'role':'system', 'content':"""
 You are an Assistant named Stablediffy.
@@ -313,10 +291,23 @@ True
 ```
 """}
 
-def need_to_send_image(stringList):
+def ask_judge(result_string):
     global describe_prompt
     messages=[]
     messages.append(describe_prompt)
+    messages.append({"role":"user", "content": "The chat record is " + result_string + ". Should an image need to be sent?" })
+    return get_completion_from_messages(messages, temperature=0)
+
+# decides locally when it can, and asks the judge model (ask_judge) otherwise
+decider = PictureDecider(
+    triggers_are_in if os.getenv('OPENEDAI_PICTURE_PREFILTER', '1').lower() in ('1', 'true', 'yes', 'on') else None,
+    ask_judge,
+    cache_size=int(os.getenv('OPENEDAI_PICTURE_CACHE_SIZE', 1024)),
+    classifier_path=os.getenv('OPENEDAI_PICTURE_CLASSIFIER', ''),
+    threshold=float(os.getenv('OPENEDAI_PICTURE_CLASSIFIER_THRESHOLD', 0.5)),
+)
+
+def need_to_send_image(stringList):
     context=[]
     for index, item in enumerate(stringList[-2:]):
         if item.get('role') == "user":
@@ -330,12 +321,7 @@ def need_to_send_image(stringList):
             else:
                 context.append(f"Cherry: {item.get('content')}\n")
     result_string = ''.join(context)
-    messages.append({"role":"user", "content": "The chat record is " + result_string + ". Should an image need to be sent?" })
-    response =get_completion_from_messages(messages, temperature=0)
-    if 'True' in response:
-        return True
-    else:
-        return False
+    return decider.decide(stringList[-2:], result_string)
 
 def get_sd_prompt(stringList):
     global sys_prompt
@@ -0,0 +1,194 @@
+'''
+Batched and cached sentence embeddings for /v1/embeddings.
+
+Vectors are cached on disk by the sha256 of the model name and the text.
+The digests are appended to keys.bin and the vectors are stored at the same
+row of vectors.f16, a memory-mapped float16 array, so the cache survives
+restarts and costs almost no RAM. Texts that are not cached are queued and
+embedded by a single worker thread, which waits a few milliseconds for
+other requests so that concurrent calls share one model.encode() batch.
+'''
+
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from queue import Empty, Queue
+
+import numpy as np
+import yaml
+
+DIGEST_SIZE = 32
+GROW_ROWS = 4096
+
+
+class VectorCache:
+    def __init__(self, path, model_name, dim):
+        self.path = Path(path) / re.sub(r'[^\w.-]', '_', model_name)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.keys_file = self.path / 'keys.bin'
+        self.vectors_file = self.path / 'vectors.f16'
+
+        meta_file = self.path / 'meta.json'
+        if meta_file.exists() and json.loads(meta_file.read_text())['dim'] != dim:
+            self.keys_file.unlink(missing_ok=True)
+            self.vectors_file.unlink(missing_ok=True)
+
+        meta_file.write_text(json.dumps({'model': model_name, 'dim': dim}))
+
+        # A key is only appended once its vector is on disk, so a truncated
+        # last key can only come from a crash and is dropped
+        keys = self.keys_file.read_bytes() if self.keys_file.exists() else b''
+        keys = keys[:len(keys) - len(keys) % DIGEST_SIZE]
+        self.index = {keys[i:i + DIGEST_SIZE]: i // DIGEST_SIZE for i in range(0, len(keys), DIGEST_SIZE)}
+        self.count = len(self.index)
+        self.keys_fp = open(self.keys_file, 'ab')
+        self.keys_fp.truncate(len(keys))
+
+        self.vectors = None
+        self.capacity = 0
+        self._reserve(max(self.count, GROW_ROWS))
+
+    def digest(self, text):
+        return hashlib.sha256(f'{self.model_name}\0{text}'.encode('utf-8')).digest()
+
+    def _reserve(self, rows):
+        if rows <= self.capacity:
+            return
+
+        capacity = max(rows, self.capacity + GROW_ROWS)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+
+        with open(self.vectors_file, 'ab') as f:
+            f.truncate(capacity * self.dim * 2)
+
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float16, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    # Returns the cached vector of each digest, or None
+    def get(self, digests):
+        with self.lock:
+            rows = [self.index.get(d) for d in digests]
+            return [np.array(self.vectors[row], dtype=np.float32) if row is not None else None for row in rows]
+
+    def put(self, digests, vectors):
+        with self.lock:
+            new = [(d, v) for d, v in zip(digests, vectors) if d not in self.index]
+            if len(new) == 0:
+                return
+
+            self._reserve(self.count + len(new))
+            for i, (_, vector) in enumerate(new):
+                self.vectors[self.count + i] = vector
+
+            self.vectors.flush()
+            for i, (d, _) in enumerate(new):
+                self.index[d] = self.count + i
+                self.keys_fp.write(d)
+
+            self.keys_fp.flush()
+            self.count += len(new)
+
+
+class EmbeddingService:
+    def __init__(self, model, model_name, cache_dir, batch_window=0.01, max_batch_size=64):
+        self.model = model
+        self.model_name = model_name
+        self.dim = model.get_sentence_embedding_dimension()
+        self.cache = VectorCache(cache_dir, model_name, self.dim) if cache_dir else None
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    # Returns a (len(texts), dim) float32 array and the number of cache hits
+    def embed(self, texts):
+        digests = [self.cache.digest(text) for text in texts] if self.cache else [None] * len(texts)
+        vectors = self.cache.get(digests) if self.cache else [None] * len(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        hits = len(texts) - len(missing)
+        if len(missing) > 0:
+            future = Future()
+            self.queue.put(([texts[i] for i in missing], [digests[i] for i in missing], future))
+            for i, vector in zip(missing, future.result()):
+                vectors[i] = vector
+
+        return np.stack(vectors) if len(vectors) > 0 else np.zeros((0, self.dim), dtype=np.float32), hits
+
+    # Collects the requests that arrive within batch_window of the first one
+    def _loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            size = len(jobs[0][0])
+            deadline = time.time() + self.batch_window
+            while size < self.max_batch_size:
+                try:
+                    job = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+
+                jobs.append(job)
+                size += len(job[0])
+
+            try:
+                self._run(jobs)
+            except Exception as e:
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run(self, jobs):
+        # The same text can be requested several times in one batch
+        unique = {}
+        for texts, digests, _ in jobs:
+            for text, digest in zip(texts, digests):
+                unique.setdefault(text, digest)
+
+        texts = list(unique)
+        vectors = self.model.encode(texts, batch_size=self.max_batch_size, convert_to_numpy=True).astype(np.float32)
+        if self.cache:
+            # Rounded like the cached copies, so that a text gets the same vector whether it was cached or not
+            vectors = vectors.astype(np.float16).astype(np.float32)
+            self.cache.put([unique[text] for text in texts], vectors)
+
+        by_text = dict(zip(texts, vectors))
+
+        for texts, _, future in jobs:
+            future.set_result([by_text[text] for text in texts])
+
+
+# Greetings and contexts of the characters, which are embedded over and over
+def character_texts(characters_dir='characters'):
+    texts = []
+    for path in sorted(Path(characters_dir).glob('*')):
+        try:
+            if path.suffix in ['.yaml', '.yml']:
+                data = yaml.safe_load(path.read_text(encoding='utf-8'))
+            elif path.suffix == '.json':
+                data = json.loads(path.read_text(encoding='utf-8'))
+            else:
+                continue
+        except Exception:
+            continue
+
+        if isinstance(data, dict):
+            for key in ['greeting', 'char_greeting', 'first_mes', 'context', 'char_persona']:
+                if isinstance(data.get(key), str) and data[key].strip():
+                    texts.append(data[key])
+
+    return texts
+
+
+def warm_up(service, texts):
+    if len(texts) > 0:
+        _, hits = service.embed(texts)
+        print(f"Embeddings cache warmed up: {len(texts) - hits} new, {hits} already cached.")
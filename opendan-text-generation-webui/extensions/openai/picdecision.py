@@ -0,0 +1,115 @@
+'''
+Decides whether a chat turn should come with a picture.
+
+Asking the remote judge model costs a network round-trip on every turn,
+while almost no turn needs a picture. The decision is made locally when
+possible:
+1) turns without any trigger (triggers_are_in) are answered with False;
+2) the decisions are cached by the normalized last two turns;
+3) an optional local text classifier, loaded once at startup, replaces
+the remote judge.
+'''
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+class PictureDecider:
+    def __init__(self, prefilter, judge, cache_size=1024, classifier_path=None, threshold=0.5):
+        self.prefilter = prefilter
+        self.judge = judge  # returns the raw answer of the remote model, '' on failure
+        self.cache_size = cache_size
+        self.classifier_path = classifier_path
+        self.threshold = threshold
+        self.classifier = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            'turns': 0,
+            'prefilter_skips': 0,
+            'cache_hits': 0,
+            'local_decisions': 0,
+            'remote_calls': 0,
+            'remote_failures': 0,
+            'pictures': 0,
+            'decision_seconds': 0.0,
+        }
+
+    def load_classifier(self):
+        if not self.classifier_path or self.classifier is not None:
+            return
+
+        from transformers import pipeline
+        self.classifier = pipeline('text-classification', model=self.classifier_path, device=-1)
+        logging.info(f'Loaded the picture classifier: {self.classifier_path}')
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def _classify(self, record):
+        result = self.classifier(record, truncation=True)[0]
+        label = str(result['label']).lower()
+        positive = label in ['true', 'yes', 'positive', 'picture', 'label_1', '1']
+        score = result['score'] if positive else 1 - result['score']
+        return score >= self.threshold
+
+    # turns are the last two messages, record is the chat record given to the judge
+    def decide(self, turns, record):
+        t0 = time.time()
+        self._count('turns')
+        try:
+            if self.prefilter is not None and not any(self.prefilter(turn.get('content') or '') for turn in turns):
+                self._count('prefilter_skips')
+                return False
+
+            key = tuple((turn.get('role'), normalize(turn.get('content'))) for turn in turns)
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.counters['cache_hits'] += 1
+                    decision = self.cache[key]
+                    self.counters['pictures'] += int(decision)
+                    return decision
+
+            if self.classifier is not None:
+                decision = self._classify(record)
+                self._count('local_decisions')
+            else:
+                self._count('remote_calls')
+                answer = self.judge(record)
+                if not answer:
+                    # Don't remember failures
+                    self._count('remote_failures')
+                    return False
+
+                decision = 'True' in answer
+
+            with self.lock:
+                self.cache[key] = decision
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+                self.counters['pictures'] += int(decision)
+
+            return decision
+        finally:
+            self._count('decision_seconds', time.time() - t0)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            counters['cache_size'] = len(self.cache)
+
+        turns = max(counters['turns'], 1)
+        counters['remote_calls_per_1k_turns'] = 1000 * counters['remote_calls'] / turns
+        counters['avg_decision_ms'] = 1000 * counters.pop('decision_seconds') / turns
+        counters['classifier'] = self.classifier_path if self.classifier is not None else None
+        return counters
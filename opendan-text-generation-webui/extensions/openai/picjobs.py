@@ -0,0 +1,109 @@
+'''
+Background jobs for the pictures of the chat completions.
+
+Deciding whether the reply should come with a picture, writing its Stable
+Diffusion prompt and rendering it takes 10-30 seconds. When asynchronous
+pictures are requested, the chat reply is sent right away with a job id and
+this chain runs on a small pool of workers, which also bounds the number of
+concurrent requests to the SD backend. The picture can then be fetched from
+/v1/images/jobs/<id>, or pushed to a callback URL when it is ready.
+'''
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import extensions.openai.createpic as picgenerate
+from modules import http_client
+
+
+class PictureJob:
+    def __init__(self, messages, callback_url=None):
+        self.id = f'pic-{uuid.uuid4().hex}'
+        self.messages = messages
+        self.callback_url = callback_url
+        self.status = 'queued'  # queued, running, done, skipped, failed, timeout
+        self.image = ''
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'object': 'image.job',
+            'status': self.status,
+            'imageBase64': self.image,
+            'error': self.error,
+            'created': int(self.created),
+            'finished': int(self.finished) if self.finished else None,
+        }
+
+
+class PictureJobQueue:
+    def __init__(self, max_workers=2, timeout=120, ttl=600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='picture-job')
+        self.timeout = timeout
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, messages, callback_url=None):
+        job = PictureJob(messages, callback_url)
+        with self.lock:
+            self._purge()
+            self.jobs[job.id] = job
+
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+        # A job is given up on once it's been waiting or running for too long
+        if job is not None and job.status in ['queued', 'running'] and time.time() - job.created > self.timeout:
+            job.status = 'timeout'
+            job.finished = time.time()
+
+        return job
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished > self.ttl]:
+            del self.jobs[job_id]
+
+    def _run(self, job):
+        if time.time() - job.created > self.timeout:
+            job.status = 'timeout'
+            job.finished = time.time()
+            return
+
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            if picgenerate.check_need_create_pic(job.messages):
+                image = picgenerate.get_picture(job.messages, initial_string=job.messages[-1].get('content'))
+                if job.status == 'running':
+                    job.image = image
+                    job.status = 'done' if image else 'failed'
+                    job.error = None if image else 'The picture could not be generated.'
+            elif job.status == 'running':
+                job.status = 'skipped'
+        except Exception as e:
+            logging.info(f'Picture job {job.id} failed: {e}')
+            job.status = 'failed'
+            job.error = str(e)
+
+        if job.finished is None:
+            job.finished = time.time()
+
+        logging.info(f'Picture job {job.id}: {job.status} in {job.finished - job.created:.1f}s')
+        if job.callback_url and job.status != 'timeout':
+            try:
+                http_client.post(job.callback_url, json=job.to_dict(), timeout=10)
+            except Exception as e:
+                logging.info(f'Picture job {job.id}: callback failed: {e}')
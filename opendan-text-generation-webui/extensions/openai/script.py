@@ -4,13 +4,32 @@ import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
 
-from modules import shared
-from modules.text_generation import encode, generate_reply
+from modules import metrics, shared
+from modules.callbacks import get_stop_matcher
+from modules.encode_cache import get_stats
+from modules.model_registry import available_models, get_registry
+from modules.session import Session
+from modules.text_generation import (decode, encode, encode_batch,
+                                     generate_choices, generate_reply)
 import extensions.openai.character_utils as character_utils
 import extensions.openai.createpic as picgenerate
+import extensions.openai.embeddings as embeddings
+import extensions.openai.picjobs as picjobs
+from extensions.openai.sse import SSEWriter
 
 params = {
     'port': int(os.environ.get('OPENEDAI_PORT')) if 'OPENEDAI_PORT' in os.environ else 5001,
+    'server': os.environ.get('OPENEDAI_SERVER', 'threading'),  # or 'asyncio'
+    'max_concurrency': int(os.environ.get('OPENEDAI_MAX_CONCURRENCY', 4)),
+    'max_queue': int(os.environ.get('OPENEDAI_MAX_QUEUE', 32)),
+    'embedding_cache': os.environ.get('OPENEDAI_EMBEDDING_CACHE', 'cache/embeddings'),  # empty to disable
+    'embedding_batch_window': float(os.environ.get('OPENEDAI_EMBEDDING_BATCH_WINDOW_MS', 10)) / 1000,
+    'async_images': os.environ.get('OPENEDAI_ASYNC_IMAGES', '1').lower() in ('1', 'true', 'yes', 'on'),
+    'image_workers': int(os.environ.get('OPENEDAI_IMAGE_WORKERS', 2)),
+    'image_timeout': float(os.environ.get('OPENEDAI_IMAGE_TIMEOUT', 180)),
+    'stream_interval': float(os.environ.get('OPENEDAI_STREAM_INTERVAL_MS', 20)) / 1000,  # 0 sends every token
+    'stream_max_bytes': int(os.environ.get('OPENEDAI_STREAM_MAX_BYTES', 512)),
+    'max_choices': int(os.environ.get('OPENEDAI_MAX_CHOICES', 8)),  # upper bound of n
 }
 
 debug = True if 'OPENEDAI_DEBUG' in os.environ else False
@@ -24,6 +43,8 @@ except ImportError:
 
 st_model = os.environ["OPENEDAI_EMBEDDING_MODEL"] if "OPENEDAI_EMBEDDING_MODEL" in os.environ else "all-mpnet-base-v2"
 embedding_model = None
+embedding_service = None
+picture_jobs = picjobs.PictureJobQueue(params['image_workers'], params['image_timeout'])
 standard_stopping_strings = ['\nsystem:', '\nuser:', '\nhuman:', '\nassistant:','\n###', ]
 name1=""; name2="";  greeting="";  context=""
 # little helper to get defaults if arg is present but None and should be the same type as default.
@@ -47,41 +68,59 @@ def clamp(value, minvalue, maxvalue):
 
 
 class Handler(BaseHTTPRequestHandler):
+    route = None
+
+    # Set by the asyncio server, when the request started waiting for a worker
+    queued_at = None
+
+    # Replaced by the asyncio server, which can tell when the client went away
+    def client_disconnected(self):
+        return False
+
     def do_GET(self):
-        if self.path.startswith('/v1/models'):
+        if self.path.startswith('/v1/images/jobs/'):
+            job = picture_jobs.get(self.path[len('/v1/images/jobs/'):])
+            if job is None:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(job.to_dict()).encode('utf-8'))
+        elif self.path == '/metrics':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(metrics.render().encode('utf-8'))
+        elif self.path == '/v1/images/decisions':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(picgenerate.decider.stats()).encode('utf-8'))
+        elif self.path.startswith('/v1/models'):
 
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
 
-            # TODO: list all models and allow model changes via API? Lora's?
-            # This API should list capabilities, limits and pricing...
+            # The models that can be used in the "model" field, and the embeddings model.
+            # Any other name is answered by the active model.
+            resident = get_registry().stats()['models']
             models = [{
-                "id": shared.model_name,  # The real chat/completions model
+                "id": name,
                 "object": "model",
                 "owned_by": "user",
-                "permission": []
-            }, {
+                "permission": [],
+                "active": name == shared.model_name,
+                "loaded": resident[name]['device'] if name in resident else None,
+            } for name in available_models()]
+            models.append({
                 "id": st_model,  # The real sentence transformer embeddings model
                 "object": "model",
                 "owned_by": "user",
                 "permission": []
-            }, {  # these are expected by so much, so include some here as a dummy
-                "id": "gpt-3.5-turbo",  # /v1/chat/completions
-                "object": "model",
-                "owned_by": "user",
-                "permission": []
-            }, {
-                "id": "text-curie-001",  # /v1/completions, 2k context
-                "object": "model",
-                "owned_by": "user",
-                "permission": []
-            }, {
-                "id": "text-davinci-002",  # /v1/embeddings text-embedding-ada-002:1536, text-davinci-002:768
-                "object": "model",
-                "owned_by": "user",
-                "permission": []
-            }]
+            })
 
             response = ''
             if self.path == '/v1/models':
@@ -91,7 +130,8 @@ class Handler(BaseHTTPRequestHandler):
                 })
             else:
                 the_model_name = self.path[len('/v1/models/'):]
-                response = json.dumps({
+                found = [m for m in models if m['id'] == the_model_name]
+                response = json.dumps(found[0] if found else {
                     "id": the_model_name,
                     "object": "model",
                     "owned_by": "user",
@@ -102,248 +142,234 @@ class Handler(BaseHTTPRequestHandler):
         else:
             self.send_error(404)
 
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        body = json.loads(self.rfile.read(content_length).decode('utf-8'))
+    def completions(self, body):
+        is_legacy = '/generate' in self.path
+        is_chat = 'chat' in self.path
+        resp_list = 'data' if is_legacy else 'choices'
+
+        # The model was made active by do_POST
+        model = shared.model_name
+        created_time = int(time.time())
+        cmpl_id = "conv-%d" % (created_time)
+
+        # Try to use openai defaults or map them to something with the same intent
+        stopping_strings = default(shared.settings, 'custom_stopping_strings', [])
+        if 'stop' in body:
+            if isinstance(body['stop'], str):
+                stopping_strings = [body['stop']]
+            elif isinstance(body['stop'], list):
+                stopping_strings = body['stop']
+
+        truncation_length = default(shared.settings, 'truncation_length', 2048)
+        truncation_length = clamp(default(body, 'truncation_length', truncation_length), 1, truncation_length)
+
+        default_max_tokens = truncation_length if is_chat else 16  # completions default, chat default is 'inf' so we need to cap it., the default for chat is "inf"
+
+        max_tokens_str = 'length' if is_legacy else 'max_tokens'
+        max_tokens = default(body, max_tokens_str, default(shared.settings, 'max_new_tokens', default_max_tokens))
+
+        # hard scale this, assuming the given max is for GPT3/4, perhaps inspect the requested model and lookup the context max
+        while truncation_length <= max_tokens:
+            max_tokens = max_tokens // 2
+
+        req_params = {
+            'max_new_tokens': max_tokens,
+            'temperature': default(body, 'temperature', 0.72),
+            'top_p': default(body, 'top_p', 0.73),
+            'top_k': default(body, 'best_of', 0),
+            # XXX not sure about this one, seems to be the right mapping, but the range is different (-2..2.0) vs 0..2
+            # 0 is default in openai, but 1.0 is default in other places. Maybe it's scaled? scale it.
+            'repetition_penalty': 1.18,  # (default(body, 'presence_penalty', 0) + 2.0 ) / 2.0, # 0 the real default, 1.2 is the model default, but 1.18 works better.
+            # XXX not sure about this one either, same questions. (-2..2.0), 0 is default not 1.0, scale it.
+            'encoder_repetition_penalty': 1.0,  # (default(body, 'frequency_penalty', 0) + 2.0) / 2.0,
+            'suffix': body.get('suffix', None),
+            'stream': default(body, 'stream', False),
+            'echo': default(body, 'echo', False),
+            #####################################################
+            'seed': shared.settings.get('seed', -1),
+            # unofficial, but it needs to get set anyways.
+            'truncation_length': truncation_length,
+            # no more args.
+            'add_bos_token': shared.settings.get('add_bos_token', True),
+            'do_sample': True,
+            'typical_p': 1.0,
+            'min_length': 0,
+            'no_repeat_ngram_size': 0,
+            'num_beams': 1,
+            'penalty_alpha': 0.0,
+            'length_penalty': 1,
+            'early_stopping': False,
+            'ban_eos_token': False,
+            'skip_special_tokens': True,
+            'context':context,
+            'greeting':greeting,
+            'mode':model,
+            'name1':name1,
+            'name2':name2,
+            "chat_prompt_size":2048
+        }
+        # 
+        # fixup absolute 0.0's
+        for par in ['temperature', 'repetition_penalty', 'encoder_repetition_penalty']:
+            req_params[par] = clamp(req_params[par], 0.001, 1.999)
+
+        # n replies to each prompt, generated in one batch. A stream only has one choice.
+        n = 1 if req_params['stream'] else clamp(default(body, 'n', 1), 1, params['max_choices'])
+
+        self.send_response(200)
+        if req_params['stream']:
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            # self.send_header('Connection', 'keep-alive')
+        else:
+            self.send_header('Content-Type', 'application/json')
+        self.end_headers()
 
-        if debug:
-            print(self.headers)  # did you know... python-openai sends your linux kernel & python version?
-        if debug:
-            print(body)
+        token_count = 0
+        completion_token_count = 0
+        prompt = ''
+        stream_object_type = ''
+        object_type = ''
 
-        if '/completions' in self.path or '/generate' in self.path:
-            is_legacy = '/generate' in self.path
-            is_chat = 'chat' in self.path
-            resp_list = 'data' if is_legacy else 'choices'
-
-            # XXX model is ignored for now
-            # model = body.get('model', shared.model_name) # ignored, use existing for now
-            model = shared.model_name
-            created_time = int(time.time())
-            cmpl_id = "conv-%d" % (created_time)
-
-            # Try to use openai defaults or map them to something with the same intent
-            stopping_strings = default(shared.settings, 'custom_stopping_strings', [])
-            if 'stop' in body:
-                if isinstance(body['stop'], str):
-                    stopping_strings = [body['stop']]
-                elif isinstance(body['stop'], list):
-                    stopping_strings = body['stop']
-
-            truncation_length = default(shared.settings, 'truncation_length', 2048)
-            truncation_length = clamp(default(body, 'truncation_length', truncation_length), 1, truncation_length)
-
-            default_max_tokens = truncation_length if is_chat else 16  # completions default, chat default is 'inf' so we need to cap it., the default for chat is "inf"
-
-            max_tokens_str = 'length' if is_legacy else 'max_tokens'
-            max_tokens = default(body, max_tokens_str, default(shared.settings, 'max_new_tokens', default_max_tokens))
-
-            # hard scale this, assuming the given max is for GPT3/4, perhaps inspect the requested model and lookup the context max
-            while truncation_length <= max_tokens:
-                max_tokens = max_tokens // 2
-
-            req_params = {
-                'max_new_tokens': max_tokens,
-                'temperature': default(body, 'temperature', 0.72),
-                'top_p': default(body, 'top_p', 0.73),
-                'top_k': default(body, 'best_of', 0),
-                # XXX not sure about this one, seems to be the right mapping, but the range is different (-2..2.0) vs 0..2
-                # 0 is default in openai, but 1.0 is default in other places. Maybe it's scaled? scale it.
-                'repetition_penalty': 1.18,  # (default(body, 'presence_penalty', 0) + 2.0 ) / 2.0, # 0 the real default, 1.2 is the model default, but 1.18 works better.
-                # XXX not sure about this one either, same questions. (-2..2.0), 0 is default not 1.0, scale it.
-                'encoder_repetition_penalty': 1.0,  # (default(body, 'frequency_penalty', 0) + 2.0) / 2.0,
-                'suffix': body.get('suffix', None),
-                'stream': default(body, 'stream', False),
-                'echo': default(body, 'echo', False),
-                #####################################################
-                'seed': shared.settings.get('seed', -1),
-                # int(body.get('n', 1)) # perhaps this should be num_beams or chat_generation_attempts? 'n' doesn't have a direct map
-                # unofficial, but it needs to get set anyways.
-                'truncation_length': truncation_length,
-                # no more args.
-                'add_bos_token': shared.settings.get('add_bos_token', True),
-                'do_sample': True,
-                'typical_p': 1.0,
-                'min_length': 0,
-                'no_repeat_ngram_size': 0,
-                'num_beams': 1,
-                'penalty_alpha': 0.0,
-                'length_penalty': 1,
-                'early_stopping': False,
-                'ban_eos_token': False,
-                'skip_special_tokens': True,
-                'context':context,
-                'greeting':greeting,
-                'mode':model,
-                'name1':name1,
-                'name2':name2,
-                "chat_prompt_size":2048
-            }
-            # 
-            # fixup absolute 0.0's
-            for par in ['temperature', 'repetition_penalty', 'encoder_repetition_penalty']:
-                req_params[par] = clamp(req_params[par], 0.001, 1.999)
+        if is_chat:
+            stream_object_type = 'chat.completions.chunk'
+            object_type = 'chat.completions'
 
-            self.send_response(200)
-            if req_params['stream']:
-                self.send_header('Content-Type', 'text/event-stream')
-                self.send_header('Cache-Control', 'no-cache')
-                # self.send_header('Connection', 'keep-alive')
-            else:
-                self.send_header('Content-Type', 'application/json')
-            self.end_headers()
+            messages = body['messages']
+
+            system_msg = ''  # You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible. Knowledge cutoff: {knowledge_cutoff} Current date: {current_date}
+            if 'prompt' in body:  # Maybe they sent both? This is not documented in the API, but some clients seem to do this.
+                system_msg = body['prompt']
 
-            token_count = 0
-            completion_token_count = 0
-            prompt = ''
-            stream_object_type = ''
-            object_type = ''
-
-            if is_chat:
-                stream_object_type = 'chat.completions.chunk'
-                object_type = 'chat.completions'
-
-                messages = body['messages']
-
-                system_msg = ''  # You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible. Knowledge cutoff: {knowledge_cutoff} Current date: {current_date}
-                if 'prompt' in body:  # Maybe they sent both? This is not documented in the API, but some clients seem to do this.
-                    system_msg = body['prompt']
-
-                chat_msgs = []
-                messages_for_pic = []
-
-                for m in messages:
-                    role = m['role']
-                    content = m['content']
-                    # name = m.get('name', 'user')
-                    if role == 'system':
-                        system_msg += content
-                    else:
-                        chat_msgs.extend([f"\n{role}: {content.strip()}"])  # Strip content? linefeed?
-                        messages_for_pic.append(m)
-
-                system_token_count = len(encode(system_msg)[0])
-                remaining_tokens = req_params['truncation_length'] - req_params['max_new_tokens'] - system_token_count
-                chat_msg = ''
-                while chat_msgs:
-                    new_msg = chat_msgs.pop()
-                    new_msg=character_utils.replace_openai_names(new_msg,req_params['name1'],req_params['name2'])
-                    new_size = len(encode(new_msg)[0])
-                    if new_size <= remaining_tokens:
-                        chat_msg = new_msg + chat_msg
-                        remaining_tokens -= new_size
-                    else:
-                        # TODO: clip a message to fit?
-                        # ie. user: ...<clipped message>
-                        break
-
-                if len(chat_msgs) > 0:
-                    print(f"truncating chat messages, dropping {len(chat_msgs)} messages.")
-
-                if system_msg:
-                    prompt = 'system: ' + system_msg + '\n' + chat_msg + '\nassistant: '
+            chat_msgs = []
+            messages_for_pic = []
+
+            for m in messages:
+                role = m['role']
+                content = m['content']
+                # name = m.get('name', 'user')
+                if role == 'system':
+                    system_msg += content
                 else:
-                    # prompt = chat_msg + '\nassistant: '
-                    prompt = req_params['context']+ chat_msg + '\n'+req_params['name2']+':'
-                token_count = len(encode(prompt)[0])
-                
-                # pass with some expected stop strings.
-                # some strange cases of "##| Instruction: " sneaking through.
-                stopping_strings += standard_stopping_strings
-                stopping_strings+=character_utils.get_stopping_strings(req_params)
-                req_params['custom_stopping_strings'] = stopping_strings
+                    chat_msgs.extend([f"\n{role}: {content.strip()}"])  # Strip content? linefeed?
+                    messages_for_pic.append(m)
+
+            system_token_count = len(encode(system_msg)[0])
+            remaining_tokens = req_params['truncation_length'] - req_params['max_new_tokens'] - system_token_count
+            chat_msgs = [character_utils.replace_openai_names(msg, req_params['name1'], req_params['name2']) for msg in chat_msgs]
+            msg_sizes = [len(ids[0]) for ids in encode_batch(chat_msgs)]
+            chat_msg = ''
+            while chat_msgs:
+                new_msg = chat_msgs.pop()
+                new_size = msg_sizes.pop()
+                if new_size <= remaining_tokens:
+                    chat_msg = new_msg + chat_msg
+                    remaining_tokens -= new_size
+                else:
+                    # TODO: clip a message to fit?
+                    # ie. user: ...<clipped message>
+                    break
+
+            if len(chat_msgs) > 0:
+                print(f"truncating chat messages, dropping {len(chat_msgs)} messages.")
+
+            if system_msg:
+                prompt = 'system: ' + system_msg + '\n' + chat_msg + '\nassistant: '
             else:
-                stream_object_type = 'text_completion.chunk'
-                object_type = 'text_completion'
+                # prompt = chat_msg + '\nassistant: '
+                prompt = req_params['context']+ chat_msg + '\n'+req_params['name2']+':'
+            token_count = len(encode(prompt)[0])
+            prompts, token_counts = [prompt], [token_count]
+
+            # pass with some expected stop strings.
+            # some strange cases of "##| Instruction: " sneaking through.
+            stopping_strings += standard_stopping_strings
+            stopping_strings+=character_utils.get_stopping_strings(req_params)
+            req_params['custom_stopping_strings'] = stopping_strings
+        else:
+            stream_object_type = 'text_completion.chunk'
+            object_type = 'text_completion'
 
-                # ... encoded as a string, array of strings, array of tokens, or array of token arrays.
-                if is_legacy:
-                    prompt = body['context']  # Older engines.generate API
-                else:
-                    prompt = body['prompt']  # XXX this can be different types
+            # ... encoded as a string, array of strings, array of tokens, or array of token arrays.
+            if is_legacy:
+                prompt = body['context']  # Older engines.generate API
+            else:
+                prompt = body['prompt']  # XXX this can be different types
 
-                if isinstance(prompt, list):
-                    prompt = ''.join(prompt)  # XXX this is wrong... need to split out to multiple calls?
+            # Each string or token array of a list is a separate prompt
+            if isinstance(prompt, list) and len(prompt) > 0 and isinstance(prompt[0], int):
+                prompts = [decode(prompt)]
+            elif isinstance(prompt, list):
+                prompts = [decode(p) if isinstance(p, list) else p for p in prompt] or ['']
+            else:
+                prompts = [prompt]
 
+            if req_params['stream']:
+                prompts = [''.join(prompts)]  # XXX a stream only has one choice
+
+            token_counts = []
+            for i, prompt in enumerate(prompts):
                 token_count = len(encode(prompt)[0])
                 if token_count >= req_params['truncation_length']:
                     new_len = int(len(prompt) * (float(shared.settings['truncation_length']) - req_params['max_new_tokens']) / token_count)
-                    prompt = prompt[-new_len:]
+                    prompts[i] = prompt = prompt[-new_len:]
                     print(f"truncating prompt to {new_len} characters, was {token_count} tokens. Now: {len(encode(prompt)[0])} tokens.")
 
-                # pass with some expected stop strings.
-                # some strange cases of "##| Instruction: " sneaking through.
-                stopping_strings += standard_stopping_strings
-                req_params['custom_stopping_strings'] = stopping_strings
+                token_counts.append(token_count)
 
-            if req_params['stream']:
-                shared.args.chat = True
-                # begin streaming
-                chunk = {
-                    "id": cmpl_id,
-                    "object": stream_object_type,
-                    "created": created_time,
-                    "model": shared.model_name,
-                    resp_list: [{
-                        "index": 0,
-                        "finish_reason": None,
-                    }],
-                }
+            prompt, token_count = prompts[0], token_counts[0]
 
-                if stream_object_type == 'text_completion.chunk':
-                    chunk[resp_list][0]["text"] = ""
-                else:
-                    # This is coming back as "system" to the openapi cli, not sure why.
-                    # So yeah... do both methods? delta and messages.
-                    chunk[resp_list][0]["message"] = {'role': 'assistant', 'content': ''}
-                    chunk[resp_list][0]["delta"] = {'role': 'assistant', 'content': ''}
-                    # { "role": "assistant" }
+            # pass with some expected stop strings.
+            # some strange cases of "##| Instruction: " sneaking through.
+            stopping_strings += standard_stopping_strings
+            req_params['custom_stopping_strings'] = stopping_strings
 
-                response = 'data: ' + json.dumps(chunk) + '\n'
-                self.wfile.write(response.encode('utf-8'))
+        # Each request gets its own session so that concurrent requests
+        # don't share the stop flag. Streaming replies are generated in
+        # chat mode, without the prompt in front of them.
+        session = Session(chat=True if req_params['stream'] else None, route=self.route)
+
+        if n > 1 or len(prompts) > 1:
+            if debug:
+                print({'prompts': prompts, 'n': n, 'req_params': req_params, 'stopping_strings': stopping_strings})
+            choices = generate_choices(prompts, req_params, n, stopping_strings, session)
+        else:
+            if req_params['stream']:
+                # begin streaming
+                writer = SSEWriter(self.wfile, cmpl_id, stream_object_type, created_time, shared.model_name, resp_list, params['stream_interval'], params['stream_max_bytes'])
+                writer.start()
 
             # generate reply #######################################
             if debug:
                 print({'prompt': prompt, 'req_params': req_params, 'stopping_strings': stopping_strings})
-            generator = generate_reply(prompt, req_params, stopping_strings=stopping_strings)
+            generator = generate_reply(prompt, req_params, stopping_strings=stopping_strings, session=session)
 
             answer = ''
             seen_content = ''
-            longest_stop_len = max([len(x) for x in stopping_strings])
+            stop_matcher = get_stop_matcher(stopping_strings)
 
             for a in generator:
+                if self.client_disconnected():
+                    print(f"Client {self.client_address} disconnected, stopping generation.")
+                    session.cancel()
+                    return
+
                 if isinstance(a, str):
                     answer = a
                 else:
                     answer = a[0]
 
-                stop_string_found = False
                 len_seen = len(seen_content)
-                search_start = max(len_seen - longest_stop_len, 0)
-
-                for string in stopping_strings:
-                    idx = answer.find(string, search_start)
-                    if idx != -1:
-                        answer = answer[:idx]  # clip it.
-                        stop_string_found = True
+                search_start = max(len_seen - stop_matcher.longest, 0)
 
-                if stop_string_found:
+                idx = stop_matcher.find(answer, search_start)
+                if idx != -1:
+                    answer = answer[:idx]  # clip it.
                     break
 
                 # If something like "\nYo" is generated just before "\nYou:"
                 # is completed, buffer and generate more, don't send it
-                buffer_and_continue = False
-
-                for string in stopping_strings:
-                    for j in range(len(string) - 1, 0, -1):
-                        if answer[-j:] == string[:j]:
-                            buffer_and_continue = True
-                            break
-                    else:
-                        continue
-                    break
-
-                if buffer_and_continue:
+                if stop_matcher.partial_suffix_len(answer) > 0:
                     continue
 
                 if req_params['stream']:
@@ -354,103 +380,119 @@ class Handler(BaseHTTPRequestHandler):
                         continue
 
                     seen_content = answer
-                    chunk = {
-                        "id": cmpl_id,
-                        "object": stream_object_type,
-                        "created": created_time,
-                        "model": shared.model_name,
-                        resp_list: [{
-                            "index": 0,
-                            "finish_reason": None,
-                        }],
-                    }
-                    if stream_object_type == 'text_completion.chunk':
-                        chunk[resp_list][0]['text'] = new_content
-                    else:
-                        # So yeah... do both methods? delta and messages.
-                        chunk[resp_list][0]['message'] = {'content': new_content}
-                        chunk[resp_list][0]['delta'] = {'content': new_content}
-                    response = 'data: ' + json.dumps(chunk) + '\n'
-                    self.wfile.write(response.encode('utf-8'))
-                    completion_token_count += len(encode(new_content)[0])
+                    writer.write(new_content)
+
+            # Counted from the generated ids, the backends without ids re-encode the answer
+            completion_token_count = session.new_tokens if session.new_tokens is not None else len(encode(answer)[0])
+            if debug:
+                print({'encode_cache': get_stats()})
 
             if req_params['stream']:
-                chunk = {
-                    "id": cmpl_id,
-                    "object": stream_object_type,
-                    "created": created_time,
-                    "model": model,  # TODO: add Lora info?
-                    resp_list: [{
-                            "index": 0,
-                            "finish_reason": "stop",
-                    }],
-                    "usage": {
-                        "prompt_tokens": token_count,
-                        "completion_tokens": completion_token_count,
-                        "total_tokens": token_count + completion_token_count
-                    }
-                }
-                if stream_object_type == 'text_completion.chunk':
-                    chunk[resp_list][0]['text'] = ''
-                else:
-                    # So yeah... do both methods? delta and messages.
-                    chunk[resp_list][0]['message'] = {'content': ''}
-                    chunk[resp_list][0]['delta'] = {}
-                response = 'data: ' + json.dumps(chunk) + '\ndata: [DONE]\n'
-                self.wfile.write(response.encode('utf-8'))
+                writer.finish(model, {
+                    "prompt_tokens": token_count,
+                    "completion_tokens": completion_token_count,
+                    "total_tokens": token_count + completion_token_count
+                })
                 # Finished if streaming.
                 if debug:
                     print({'response': answer})
                 return
 
-            if debug:
-                print({'response': answer})
+            choices = [(answer, completion_token_count)]
 
-            completion_token_count = len(encode(answer)[0])
+        if debug:
+            print({'response': [answer for answer, _ in choices]})
+
+        # Each prompt is only counted once in the total usage
+        completion_token_count = sum(count for _, count in choices)
+        resp = {
+            "id": cmpl_id,
+            "object": object_type,
+            "created": created_time,
+            "model": model,  # TODO: add Lora info?
+            resp_list: [],
+            "usage": {
+                "prompt_tokens": sum(token_counts),
+                "completion_tokens": completion_token_count,
+                "total_tokens": sum(token_counts) + completion_token_count
+            }
+        }
+
+        for i, (answer, choice_token_count) in enumerate(choices):
+            token_count = token_counts[i // n]
             stop_reason = "stop"
-            if token_count + completion_token_count >= req_params['truncation_length']:
+            if token_count + choice_token_count >= req_params['truncation_length']:
                 stop_reason = "length"
 
-            resp = {
-                "id": cmpl_id,
-                "object": object_type,
-                "created": created_time,
-                "model": model,  # TODO: add Lora info?
-                resp_list: [{
-                    "index": 0,
-                    "finish_reason": stop_reason,
-                }],
+            resp[resp_list].append({
+                "index": i,
+                "finish_reason": stop_reason,
                 "usage": {
                     "prompt_tokens": token_count,
-                    "completion_tokens": completion_token_count,
-                    "total_tokens": token_count + completion_token_count
+                    "completion_tokens": choice_token_count,
+                    "total_tokens": token_count + choice_token_count
                 }
+            })
+
+            if not is_chat:
+                resp[resp_list][i]["text"] = answer
+                continue
+
+            picBase64=""
+            content={
+                "content":answer,
+                "imageBase64":picBase64
             }
 
-            if is_chat:
-                picBase64=""
-                content={
-                    "content":answer,
-                    "imageBase64":picBase64
-                }
-                # just gengerate pic in chat mode
-                messages_for_pic.append({"role": "assistant", "content": answer })
-                shouldGetPic=picgenerate.check_need_create_pic(messages_for_pic)
-
-                if shouldGetPic:
-                    messages_for_pic.append({"role": "assistant", "content": answer })
-                    picBase64= picgenerate.get_picture(messages_for_pic)
-                    content['imageBase64']=picBase64
-                    resp[resp_list][0]["message"] = {"role": "assistant", "content":json.dumps(content) }
-                else:
-                    #picgenerate.input_bot_string(answer)
-                    resp[resp_list][0]["message"] = {"role": "assistant", "content": json.dumps(content)}
+            # just gengerate pic in chat mode, for the first choice
+            if i > 0:
+                resp[resp_list][i]["message"] = {"role": "assistant", "content": json.dumps(content)}
+                continue
+
+            messages_for_pic.append({"role": "assistant", "content": answer })
+
+            # By default the text is returned now and the picture is made in the background.
+            # It can be fetched from /v1/images/jobs/<imageJobId> when it's ready.
+            if body.get('async_image', params['async_images']):
+                job = picture_jobs.submit(messages_for_pic, body.get('image_callback_url'))
+                content['imageJobId'] = job.id
+                resp[resp_list][i]["message"] = {"role": "assistant", "content": json.dumps(content)}
+            elif picgenerate.check_need_create_pic(messages_for_pic):
+                picBase64= picgenerate.get_picture(messages_for_pic, initial_string=answer)
+                content['imageBase64']=picBase64
+                resp[resp_list][i]["message"] = {"role": "assistant", "content":json.dumps(content) }
             else:
-                resp[resp_list][0]["text"] = answer
-            # print('generate result ',content)
-            response = json.dumps(resp)
-            self.wfile.write(response.encode('utf-8'))
-        elif '/embeddings' in self.path and embedding_model is not None:
+                #picgenerate.input_bot_string(answer)
+                resp[resp_list][i]["message"] = {"role": "assistant", "content": json.dumps(content)}
+
+        # print('generate result ',content)
+        response = json.dumps(resp)
+        self.wfile.write(response.encode('utf-8'))
+
+    def do_POST(self):
+        content_length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(content_length).decode('utf-8'))
+
+        if debug:
+            print(self.headers)  # did you know... python-openai sends your linux kernel & python version?
+        if debug:
+            print(body)
+
+        if '/completions' in self.path or '/generate' in self.path:
+            # A fixed label, whatever the path looks like
+            self.route = '/v1/chat/completions' if 'chat' in self.path else '/v1/completions'
+
+            # Unknown names such as gpt-3.5-turbo use the active model
+            registry = get_registry()
+            name = registry.resolve(body.get('model'))
+            t0 = time.time()
+            if self.queued_at is not None:
+                metrics.QUEUE_WAIT.observe(t0 - self.queued_at, model=name or shared.model_name, route=self.route, queue='server')
+
+            with registry.use(name):
+                metrics.QUEUE_WAIT.observe(time.time() - t0, model=shared.model_name, route=self.route, queue='model')
+                self.completions(body)
+        elif '/embeddings' in self.path and embedding_service is not None:
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
@@ -459,7 +501,8 @@ class Handler(BaseHTTPRequestHandler):
             if type(input) is str:
                 input = [input]
 
-            embeddings = embedding_model.encode(input).tolist()
+            embeddings, cache_hits = embedding_service.embed(input)
+            embeddings = embeddings.tolist()
 
             data = [{"object": "embedding", "embedding": emb, "index": n} for n, emb in enumerate(embeddings)]
 
@@ -470,11 +513,12 @@ class Handler(BaseHTTPRequestHandler):
                 "usage": {
                     "prompt_tokens": 0,
                     "total_tokens": 0,
+                    "cache_hits": cache_hits,
                 }
             })
 
             if debug:
-                print(f"Embeddings return size: {len(embeddings[0])}, number: {len(embeddings)}")
+                print(f"Embeddings return size: {len(embeddings[0]) if embeddings else 0}, number: {len(embeddings)}, cache hits: {cache_hits}")
             self.wfile.write(response.encode('utf-8'))
         elif '/moderations' in self.path:
             # for now do nothing, just don't error.
@@ -528,16 +572,29 @@ class Handler(BaseHTTPRequestHandler):
 
 
 def run_server():
-    global embedding_model
+    global embedding_model, embedding_service
     try:
         embedding_model = SentenceTransformer(st_model)
+        embedding_service = embeddings.EmbeddingService(embedding_model, st_model, params['embedding_cache'], params['embedding_batch_window'])
         print(f"\nLoaded embedding model: {st_model}, max sequence length: {embedding_model.max_seq_length}")
+        Thread(target=embeddings.warm_up, args=(embedding_service, embeddings.character_texts()), daemon=True).start()
     except:
         print(f"\nFailed to load embedding model: {st_model}")
         pass
 
+    try:
+        picgenerate.decider.load_classifier()
+    except Exception as e:
+        print(f"\nFailed to load the picture classifier: {e}")
+
     server_addr = ('0.0.0.0' if shared.args.listen else '127.0.0.1', params['port'])
-    server = ThreadingHTTPServer(server_addr, Handler)
+    if params['server'] == 'asyncio':
+        from extensions.openai.async_server import AsyncServer
+        server = AsyncServer(server_addr, Handler, params['max_concurrency'], params['max_queue'])
+        print(f"Using the asyncio server (max concurrency: {params['max_concurrency']}, max queue: {params['max_queue']})")
+    else:
+        server = ThreadingHTTPServer(server_addr, Handler)
+
     if shared.args.share:
         try:
             from flask_cloudflared import _run_cloudflared
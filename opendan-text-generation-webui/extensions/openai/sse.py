@@ -0,0 +1,92 @@
+'''
+Writer for the streamed (server-sent events) completions.
+
+The chunks of a stream only differ by their content, so the JSON around it
+is serialized once into a byte template and only the content is encoded for
+each chunk. The new text is sent at most every `interval` seconds or once
+`max_bytes` are pending, so that fast models don't pay a write syscall and
+a JSON serialization per token.
+'''
+
+import json
+import time
+
+# stands for the content in the templates
+PLACEHOLDER = '\0content\0'
+
+
+def _template(chunk):
+    return [part.encode('utf-8') for part in ('data: ' + json.dumps(chunk) + '\n').split(json.dumps(PLACEHOLDER))]
+
+
+class SSEWriter:
+    def __init__(self, wfile, cmpl_id, object_type, created, model, resp_list, interval=0.02, max_bytes=512):
+        self.wfile = wfile
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.is_text = object_type == 'text_completion.chunk'
+        self.base = {
+            "id": cmpl_id,
+            "object": object_type,
+            "created": created,
+            "model": model,
+        }
+        self.resp_list = resp_list
+        self.template = _template(self._chunk(PLACEHOLDER, PLACEHOLDER))
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+        self.writes = 0
+
+    def _chunk(self, content, delta, finish_reason=None):
+        choice = {
+            "index": 0,
+            "finish_reason": finish_reason,
+        }
+        if self.is_text:
+            choice['text'] = content
+        else:
+            # So yeah... do both methods? delta and messages.
+            choice['message'] = {'content': content}
+            choice['delta'] = {'content': delta} if delta is not None else {}
+
+        return dict(self.base, **{self.resp_list: [choice]})
+
+    def _write(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+        self.writes += 1
+
+    # First chunk, with the role of the message
+    def start(self):
+        chunk = self._chunk('', '')
+        if not self.is_text:
+            # This is coming back as "system" to the openapi cli, not sure why.
+            chunk[self.resp_list][0]['message'] = {'role': 'assistant', 'content': ''}
+            chunk[self.resp_list][0]['delta'] = {'role': 'assistant', 'content': ''}
+
+        self._write(('data: ' + json.dumps(chunk) + '\n').encode('utf-8'))
+        self.last_flush = time.time()
+
+    def write(self, content):
+        self.pending.append(content)
+        self.pending_bytes += len(content)
+        if self.pending_bytes >= self.max_bytes or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            content = json.dumps(''.join(self.pending)).encode('utf-8')
+            self.pending = []
+            self.pending_bytes = 0
+            self._write(content.join(self.template))
+
+        self.last_flush = time.time()
+
+    # Sends what is pending, then the last chunk with the usage
+    def finish(self, model, usage, finish_reason='stop'):
+        self.flush()
+        chunk = self._chunk('', None, finish_reason)
+        chunk['model'] = model
+        chunk['usage'] = usage
+        self._write(('data: ' + json.dumps(chunk) + '\ndata: [DONE]\n').encode('utf-8'))
@@ -0,0 +1,143 @@
+'''
+Tests of the picture job queue against a stub Stable Diffusion server.
+
+The helper LLM calls (the picture decision and the SD prompt) are replaced,
+the txt2img request really goes over HTTP. Run from the
+opendan-text-generation-webui folder:
+
+    python -m pytest extensions/openai/test_picjobs.py
+'''
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import extensions.openai.createpic as picgenerate
+from extensions.openai.picjobs import PictureJobQueue
+
+MESSAGES = [
+    {'role': 'user', 'content': 'send me a pic of you'},
+    {'role': 'assistant', 'content': 'Here is a photo of me.'},
+]
+
+
+class StubServer:
+    def __init__(self):
+        self.delay = 0
+        self.txt2img = []
+        self.callbacks = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path == '/sdapi/v1/txt2img':
+                    stub.txt2img.append(body)
+                    time.sleep(stub.delay)
+                    response = {'images': ['aW1hZ2U=']}
+                else:
+                    stub.callbacks.append(body)
+                    response = {}
+
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def sd(monkeypatch):
+    stub = StubServer()
+    monkeypatch.setitem(picgenerate.params, 'address', stub.url)
+    monkeypatch.setitem(picgenerate.params, 'translations', False)
+    monkeypatch.setattr(picgenerate, 'check_need_create_pic', lambda messages: True)
+    monkeypatch.setattr(picgenerate, 'get_sd_prompt', lambda messages: 'smiling, park, natural light')
+    monkeypatch.setattr(picgenerate, 'get_control_net_params', lambda preprocess: {})
+    yield stub
+    stub.close()
+
+
+def wait_for(queue, job, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job.id)
+        if job.status not in ['queued', 'running']:
+            return job
+
+        time.sleep(0.02)
+
+    raise AssertionError(f'{job.id} is still {job.status}')
+
+
+def test_done(sd):
+    queue = PictureJobQueue(max_workers=1, timeout=10)
+    job = wait_for(queue, queue.submit(list(MESSAGES)))
+
+    assert job.status == 'done'
+    assert job.image == 'aW1hZ2U='
+    assert job.to_dict()['imageBase64'] == 'aW1hZ2U='
+    assert len(sd.txt2img) == 1
+    assert 'smiling, park' in sd.txt2img[0]['prompt']
+
+
+def test_skipped(sd, monkeypatch):
+    monkeypatch.setattr(picgenerate, 'check_need_create_pic', lambda messages: False)
+    queue = PictureJobQueue(max_workers=1, timeout=10)
+    job = wait_for(queue, queue.submit(list(MESSAGES)))
+
+    assert job.status == 'skipped'
+    assert job.image == ''
+    assert sd.txt2img == []
+
+
+def test_timeout(sd):
+    sd.delay = 1.0
+    queue = PictureJobQueue(max_workers=1, timeout=0.3)
+    job = wait_for(queue, queue.submit(list(MESSAGES)))
+    assert job.status == 'timeout'
+
+    # The late picture doesn't replace the timeout
+    time.sleep(1.0)
+    job = queue.get(job.id)
+    assert job.status == 'timeout'
+    assert job.image == ''
+
+
+def test_ttl(sd):
+    queue = PictureJobQueue(max_workers=1, timeout=10, ttl=0.1)
+    first = wait_for(queue, queue.submit(list(MESSAGES)))
+    time.sleep(0.2)
+
+    # Finished jobs are dropped when the next one is submitted
+    second = queue.submit(list(MESSAGES))
+    assert queue.get(first.id) is None
+    assert queue.get(second.id) is not None
+    wait_for(queue, second)
+
+
+def test_callback(sd):
+    queue = PictureJobQueue(max_workers=1, timeout=10)
+    job = wait_for(queue, queue.submit(list(MESSAGES), callback_url=f'{sd.url}/callback'))
+
+    deadline = time.time() + 5
+    while len(sd.callbacks) == 0 and time.time() < deadline:
+        time.sleep(0.02)
+
+    assert sd.callbacks == [job.to_dict()]
+    assert sd.callbacks[0]['status'] == 'done'
@@ -0,0 +1,96 @@
+'''
+The translations.json table, which adds Stable Diffusion tags to the prompt
+when some words appear in the chat.
+
+The file is parsed once, and again only when its modification time changes.
+All the descriptive words are compiled into one Aho-Corasick automaton, so a
+text is scanned once however many pairs there are, and every pair whose word
+appears in it (as a substring, overlapping or not) is found.
+'''
+
+import json
+import threading
+from pathlib import Path
+
+
+class Matcher:
+    def __init__(self, words):
+        # words is a list of (word, pair index)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        for word, index in words:
+            if not word:
+                continue
+
+            node = 0
+            for char in word:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[node][char] = len(self.goto) - 1
+
+                node = self.goto[node][char]
+
+            self.output[node].add(index)
+
+        # Breadth-first, so that the fail link of a node is done before its children
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    # Returns the indices of the pairs with a word in text
+    def find(self, text):
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+
+            node = self.goto[node].get(char, 0)
+            found |= self.output[node]
+
+        return found
+
+
+class TranslationTable:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.mtime = None
+        self.pairs = []
+        self.matcher = Matcher([])
+        self.lock = threading.Lock()
+
+    def _reload(self):
+        mtime = self.path.stat().st_mtime_ns
+        with self.lock:
+            if mtime != self.mtime:
+                pairs = json.loads(self.path.read_text(encoding='utf-8'))['pairs']
+                self.matcher = Matcher([(word, i) for i, pair in enumerate(pairs) for word in pair['descriptive_word']])
+                self.pairs = pairs
+                self.mtime = mtime
+
+            return self.pairs, self.matcher
+
+    # Returns the (positive, negative) suffixes for the texts. The pairs found
+    # in the first text come first, each pair is only added once.
+    def suffixes(self, *texts):
+        pairs, matcher = self._reload()
+        triggered = []
+        for text in texts:
+            triggered += sorted(matcher.find(text or '') - set(triggered))
+
+        positive, negative = '', ''
+        for i in triggered:
+            positive = positive + ', ' + pairs[i]['SD_positive_translation'] if positive else pairs[i]['SD_positive_translation']
+            negative += ', ' + pairs[i]['SD_negative_translation']
+
+        return positive, negative
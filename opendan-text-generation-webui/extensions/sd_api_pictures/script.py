@@ -8,8 +8,8 @@ from pathlib import Path
 import gradio as gr
 import os
 import modules.shared as shared
-import requests
 import torch
+from modules import http_client
 from modules.models import reload_model, unload_model
 from PIL import Image
 
@@ -49,23 +49,23 @@ def give_VRAM_priority(actor):
     if actor == 'SD':
         unload_model()
         print("Requesting Auto1111 to re-load last checkpoint used...")
-        response = requests.post(url=f'{params["address"]}/sdapi/v1/reload-checkpoint', json='')
+        response = http_client.post(url=f'{params["address"]}/sdapi/v1/reload-checkpoint', json='')
         response.raise_for_status()
 
     elif actor == 'LLM':
         print("Requesting Auto1111 to vacate VRAM...")
-        response = requests.post(url=f'{params["address"]}/sdapi/v1/unload-checkpoint', json='')
+        response = http_client.post(url=f'{params["address"]}/sdapi/v1/unload-checkpoint', json='')
         response.raise_for_status()
         reload_model()
 
     elif actor == 'set':
         print("VRAM mangement activated -- requesting Auto1111 to vacate VRAM...")
-        response = requests.post(url=f'{params["address"]}/sdapi/v1/unload-checkpoint', json='')
+        response = http_client.post(url=f'{params["address"]}/sdapi/v1/unload-checkpoint', json='')
         response.raise_for_status()
 
     elif actor == 'reset':
         print("VRAM mangement deactivated -- requesting Auto1111 to reload checkpoint")
-        response = requests.post(url=f'{params["address"]}/sdapi/v1/reload-checkpoint', json='')
+        response = http_client.post(url=f'{params["address"]}/sdapi/v1/reload-checkpoint', json='')
         response.raise_for_status()
 
     else:
@@ -163,7 +163,7 @@ def get_SD_pictures(description):
         })
 
     print(f'Prompting the image generator via the API on {params["address"]}...')
-    response = requests.post(url=f'{params["address"]}/sdapi/v1/txt2img', json=payload)
+    response = http_client.post(url=f'{params["address"]}/sdapi/v1/txt2img', json=payload)
     response.raise_for_status()
     r = response.json()
 
@@ -268,7 +268,7 @@ def SD_api_address_update(address):
     address = filter_address(address)
     params.update({"address": address})
     try:
-        response = requests.get(url=f'{params["address"]}/sdapi/v1/sd-models')
+        response = http_client.get(url=f'{params["address"]}/sdapi/v1/sd-models', retries=1)
         response.raise_for_status()
         # r = response.json()
     except:
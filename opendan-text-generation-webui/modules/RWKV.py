@@ -47,8 +47,8 @@ class RWKVModel:
 
         return self.pipeline.generate(context, token_count=token_count, args=args, callback=callback)
 
-    def generate_with_streaming(self, **kwargs):
-        with Iteratorize(self.generate, kwargs, callback=None) as generator:
+    def generate_with_streaming(self, session=None, **kwargs):
+        with Iteratorize(self.generate, kwargs, callback=None, session=session) as generator:
             reply = ''
             for token in generator:
                 reply += token
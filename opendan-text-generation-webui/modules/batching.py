@@ -0,0 +1,340 @@
+'''
+Continuous batching for the transformers backend.
+
+Concurrent calls to generate_reply are queued here and decoded together in
+one padded batch that shares a single forward pass per step. Finished
+sequences leave the batch right away and new requests join it between steps,
+so every caller gets its own stream without waiting for the others.
+
+Sampling uses the global torch RNG, so the seed of an individual request is
+not reproducible while other requests are being decoded with it.
+'''
+
+import logging
+import threading
+import time
+import traceback
+from queue import Queue
+
+import torch
+import transformers
+
+import modules.shared as shared
+from modules import metrics
+from modules.session import get_session
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class BatchedRequest:
+    def __init__(self, generate_params, session=None):
+        input_ids = generate_params['inputs']
+        self.prompt_length = input_ids.shape[-1]
+        self.max_new_tokens = generate_params['max_new_tokens']
+        self.eos_token_ids = generate_params.get('eos_token_id', [])
+        self.stopping_criteria = generate_params.get('stopping_criteria', [])
+        self.suppress_tokens = generate_params.get('suppress_tokens', [])
+        self.do_sample = generate_params.get('do_sample', True)
+        self.processors = build_logits_processors(generate_params)
+        self.past_key_values = generate_params.get('past_key_values')
+        self.session = get_session(session)
+        self.submitted = time.time()
+
+        # The whole sequence is preallocated so that the views handed out
+        # to the consumer never change under its feet
+        self.tokens = torch.empty(self.prompt_length + self.max_new_tokens, dtype=input_ids.dtype, device=input_ids.device)
+        self.tokens[:self.prompt_length] = input_ids[0]
+        self.length = self.prompt_length
+
+        self.queue = Queue()
+        self.sentinel = object()
+        self.cancelled = False
+
+    @property
+    def input_ids(self):
+        return self.tokens[:self.length].unsqueeze(0)
+
+    def sample(self, logits):
+        scores = self.processors(self.input_ids, logits.float())
+        if self.suppress_tokens:
+            scores[:, self.suppress_tokens] = -float('inf')
+
+        if self.do_sample:
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+            return int(torch.multinomial(probs, num_samples=1)[0, 0])
+        else:
+            return int(torch.argmax(scores, dim=-1)[0])
+
+    # Appends a token, streams the sequence and returns True when it is done
+    def push(self, token):
+        self.tokens[self.length] = token
+        self.length += 1
+        self.queue.put(self.tokens[:self.length])
+
+        return any((
+            self.cancelled or self.session.stopped,
+            token in self.eos_token_ids,
+            self.length - self.prompt_length >= self.max_new_tokens,
+            len(self.stopping_criteria) > 0 and self.stopping_criteria(self.input_ids, None),
+        ))
+
+    def finish(self, error=None):
+        self.queue.put(error if error is not None else self.sentinel)
+
+
+class BatchIterator:
+
+    """
+    Per-request view of the shared decode loop. It behaves like
+    Iteratorize: it yields the full output ids after every step and
+    cancels the request when the context manager exits.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        obj = self.request.queue.get(True, None)
+        if obj is self.request.sentinel:
+            raise StopIteration
+        elif isinstance(obj, Exception):
+            raise obj
+        else:
+            return obj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.request.cancelled = True
+
+
+class ContinuousBatchScheduler:
+    def __init__(self, model, max_batch_size):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.pending = Queue()
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, generate_params, session=None):
+        request = BatchedRequest(generate_params, session)
+        self.pending.put(request)
+        return BatchIterator(request)
+
+    def close(self):
+        self.closed = True
+        self.pending.put(None)
+
+    def _loop(self):
+        while not self.closed:
+            if len(self.active) == 0:
+                self._admit(self.pending.get())
+
+            while len(self.active) < self.max_batch_size and not self.pending.empty():
+                self._admit(self.pending.get_nowait())
+
+            if len(self.active) == 0:
+                continue
+
+            try:
+                self._step()
+            except Exception as e:
+                traceback.print_exc()
+                for request in self.active:
+                    request.finish(e)
+
+                self._reset()
+
+        for request in self.active:
+            request.finish()
+
+        while not self.pending.empty():
+            request = self.pending.get_nowait()
+            if request is not None:
+                request.finish()
+
+    def _reset(self):
+        self.active = []
+        self.past_key_values = self.attention_mask = self.next_tokens = None
+
+    # Prefills a new request on its own and merges its cache into the batch
+    @torch.no_grad()
+    def _admit(self, request):
+        if request is None:
+            return
+
+        if request.cancelled:
+            request.finish()
+            return
+
+        metrics.QUEUE_WAIT.observe(time.time() - request.submitted, model=shared.model_name, route=request.session.route or 'webui', queue='batch')
+        try:
+            if request.past_key_values is not None:
+                attention_mask = torch.ones((1, request.length), dtype=torch.long, device=request.tokens.device)
+                output = self.model(input_ids=request.input_ids[:, -1:], past_key_values=request.past_key_values, attention_mask=attention_mask, use_cache=True)
+                request.past_key_values = None
+            else:
+                output = self.model(input_ids=request.input_ids, use_cache=True)
+
+            past_key_values = output.past_key_values
+            if any(k.dim() != 4 or k.shape[0] != 1 or k.shape[2] != request.length for k, v in past_key_values):
+                raise RuntimeError(f'Continuous batching does not support the cache layout of {type(self.model).__name__}.')
+
+            token = request.sample(output.logits[:, -1, :])
+        except Exception as e:
+            traceback.print_exc()
+            request.finish(e)
+            return
+
+        if request.push(token):
+            request.finish()
+            return
+
+        attention_mask = torch.ones((1, request.prompt_length), dtype=torch.long, device=request.tokens.device)
+        next_tokens = torch.tensor([token], dtype=request.tokens.dtype, device=request.tokens.device)
+        if len(self.active) == 0:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.next_tokens = next_tokens
+        else:
+            # Left-pad whichever side is shorter so that all rows end at the same position
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            batch_past = _pad_past(self.past_key_values, length)
+            new_past = _pad_past(past_key_values, length)
+            self.past_key_values = tuple(
+                (torch.cat((bk, nk)), torch.cat((bv, nv)))
+                for (bk, bv), (nk, nv) in zip(batch_past, new_past)
+            )
+            self.attention_mask = torch.cat((_pad_mask(self.attention_mask, length), _pad_mask(attention_mask, length)))
+            self.next_tokens = torch.cat((self.next_tokens, next_tokens))
+
+        self.active.append(request)
+
+    @torch.no_grad()
+    def _step(self):
+        attention_mask = torch.cat((self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))), dim=1)
+        inputs = self.model.prepare_inputs_for_generation(self.next_tokens.unsqueeze(-1), past_key_values=self.past_key_values, attention_mask=attention_mask, use_cache=True)
+        output = self.model(**inputs)
+        self.past_key_values = output.past_key_values
+        self.attention_mask = attention_mask
+
+        logits = output.logits[:, -1, :]
+        finished = []
+        for i, request in enumerate(self.active):
+            token = request.sample(logits[i:i + 1])
+            self.next_tokens[i] = token
+            if request.push(token):
+                request.finish()
+                finished.append(i)
+
+        if len(finished) > 0:
+            self._retire(finished)
+
+    # Drops finished rows and the padding columns that only they needed
+    def _retire(self, finished):
+        keep = [i for i in range(len(self.active)) if i not in finished]
+        if len(keep) == 0:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        self.active = [self.active[i] for i in keep]
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+
+        start = int(self.attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (k.index_select(0, index.to(k.device))[:, :, start:], v.index_select(0, index.to(v.device))[:, :, start:])
+            for k, v in self.past_key_values
+        )
+
+
+def _pad_past(past_key_values, length):
+    padded = []
+    for k, v in past_key_values:
+        pad = length - k.shape[2]
+        if pad > 0:
+            k = torch.cat((k.new_zeros((k.shape[0], k.shape[1], pad, k.shape[3])), k), dim=2)
+            v = torch.cat((v.new_zeros((v.shape[0], v.shape[1], pad, v.shape[3])), v), dim=2)
+
+        padded.append((k, v))
+
+    return padded
+
+
+def _pad_mask(attention_mask, length):
+    pad = length - attention_mask.shape[1]
+    if pad > 0:
+        attention_mask = torch.cat((attention_mask.new_zeros((attention_mask.shape[0], pad)), attention_mask), dim=1)
+
+    return attention_mask
+
+
+def build_logits_processors(generate_params):
+    processors = transformers.LogitsProcessorList()
+    input_ids = generate_params['inputs']
+    eos_token_ids = generate_params.get('eos_token_id', [])
+    if generate_params.get('repetition_penalty', 1.0) != 1.0:
+        processors.append(transformers.RepetitionPenaltyLogitsProcessor(penalty=generate_params['repetition_penalty']))
+    if generate_params.get('encoder_repetition_penalty', 1.0) != 1.0:
+        processors.append(transformers.EncoderRepetitionPenaltyLogitsProcessor(penalty=generate_params['encoder_repetition_penalty'], encoder_input_ids=input_ids))
+    if generate_params.get('no_repeat_ngram_size', 0) > 0:
+        processors.append(transformers.NoRepeatNGramLogitsProcessor(generate_params['no_repeat_ngram_size']))
+    if generate_params.get('min_length', 0) > 0 and len(eos_token_ids) > 0:
+        processors.append(transformers.MinLengthLogitsProcessor(generate_params['min_length'], eos_token_ids))
+
+    if generate_params.get('do_sample', True):
+        if generate_params.get('temperature', 1.0) != 1.0:
+            processors.append(transformers.TemperatureLogitsWarper(generate_params['temperature']))
+        if generate_params.get('top_k', 0) > 0:
+            processors.append(transformers.TopKLogitsWarper(generate_params['top_k']))
+        if generate_params.get('top_p', 1.0) < 1.0:
+            processors.append(transformers.TopPLogitsWarper(generate_params['top_p']))
+        if generate_params.get('typical_p', 1.0) < 1.0:
+            processors.append(transformers.TypicalLogitsWarper(generate_params['typical_p']))
+
+    return processors
+
+
+# Only greedy/sampling decoding of decoder-only models with a standard
+# (batch, heads, length, dim) cache can share the decode loop
+def can_batch(generate_params):
+    return all((
+        shared.args.continuous_batching,
+        shared.model_type not in ['HF_seq2seq', 'chatglm'],
+        getattr(getattr(shared.model, 'config', None), 'model_type', None) != 'bloom',
+        'inputs_embeds' not in generate_params,
+        generate_params.get('use_cache', True),
+        not generate_params.get('synced_gpus', False),
+        generate_params.get('num_beams', 1) == 1,
+        generate_params.get('penalty_alpha', 0) == 0,
+    ))
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler.model is not shared.model:
+            if _scheduler is not None:
+                _scheduler.close()
+
+            logging.info(f"Starting the continuous batching scheduler (max batch size: {shared.args.max_batch_size}).")
+            _scheduler = ContinuousBatchScheduler(shared.model, shared.args.max_batch_size)
+
+        return _scheduler
+
+
+def submit(generate_params, session=None):
+    return get_scheduler().submit(generate_params, session)
@@ -1,4 +1,6 @@
+import functools
 import gc
+import re
 import traceback
 from queue import Queue
 from threading import Thread
@@ -7,33 +9,123 @@ import torch
 import transformers
 
 import modules.shared as shared
+from modules.session import get_session
 
 
 class _SentinelTokenStoppingCriteria(transformers.StoppingCriteria):
 
+    """
+    Stops when any sequence of the batch ends with one of the sentinels.
+    The sentinels are stored right-aligned in a single padded tensor so
+    that one comparison checks all of them against all the sequences.
+    """
+
     def __init__(self, sentinel_token_ids: list, starting_idx: int):
         transformers.StoppingCriteria.__init__(self)
-        self.sentinel_token_ids = sentinel_token_ids
+        sentinels = [x.reshape(-1) for x in sentinel_token_ids if x.shape[-1] > 0]
         self.starting_idx = starting_idx
-        self.shortest = min([x.shape[-1] for x in sentinel_token_ids])
+        self.shortest = min([x.shape[-1] for x in sentinels], default=0)
+        self.longest = max([x.shape[-1] for x in sentinels], default=0)
+        self.lengths = torch.tensor([x.shape[-1] for x in sentinels], dtype=torch.long)
+        self.sentinels = torch.zeros((len(sentinels), self.longest), dtype=torch.long)
+        self.mask = torch.zeros((len(sentinels), self.longest), dtype=torch.bool)
+        for i, sentinel in enumerate(sentinels):
+            self.sentinels[i, self.longest - sentinel.shape[-1]:] = sentinel.cpu()
+            self.mask[i, self.longest - sentinel.shape[-1]:] = True
+
+    # Returns a [batch] tensor telling which sequences end with a sentinel
+    def done_flags(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+        trimmed_len = input_ids.shape[-1] - self.starting_idx
+        if len(self.lengths) == 0 or trimmed_len < self.shortest:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        if self.sentinels.device != input_ids.device:
+            self.sentinels = self.sentinels.to(input_ids.device)
+            self.mask = self.mask.to(input_ids.device)
+            self.lengths = self.lengths.to(input_ids.device)
+
+        width = min(self.longest, input_ids.shape[-1])
+        window = input_ids[:, None, -width:]
+        matches = (window == self.sentinels[None, :, -width:]) | ~self.mask[None, :, -width:]
+        matches = matches.all(dim=-1) & (self.lengths <= trimmed_len)[None]
+        return matches.any(dim=-1)
 
     def __call__(self, input_ids: torch.LongTensor, _scores: torch.FloatTensor) -> bool:
-        for sample in input_ids:
-            trimmed_sample = sample[self.starting_idx:]
-            trimmed_len = trimmed_sample.shape[-1]
-            if trimmed_len < self.shortest:
-                continue
+        return bool(self.done_flags(input_ids).any())
 
-            for sentinel in self.sentinel_token_ids:
-                sentinel_len = sentinel.shape[-1]
-                if trimmed_len < sentinel_len:
-                    continue
 
-                window = trimmed_sample[-sentinel_len:]
-                if torch.all(torch.eq(sentinel, window)):
-                    return True
+class StopStringMatcher:
 
-        return False
+    """
+    Finds stopping strings in generated text. All the strings are
+    searched at once with a single compiled pattern, and the proper
+    prefixes are kept in a set to tell when the text ends with the
+    beginning of one of them.
+    """
+
+    def __init__(self, strings):
+        strings = sorted(set(s for s in strings if len(s) > 0), key=len, reverse=True)
+        self.pattern = re.compile('|'.join(map(re.escape, strings))) if len(strings) > 0 else None
+        self.longest = len(strings[0]) if len(strings) > 0 else 0
+        self.prefixes = set(s[:j] for s in strings for j in range(1, len(s)))
+        self.longest_prefix = max(map(len, self.prefixes), default=0)
+
+    # Index of the earliest stopping string in text, or -1
+    def find(self, text, start=0):
+        if self.pattern is None:
+            return -1
+
+        match = self.pattern.search(text, start)
+        return match.start() if match is not None else -1
+
+    # Length of the longest end of text that could become a stopping string
+    def partial_suffix_len(self, text):
+        for j in range(min(self.longest_prefix, len(text)), 0, -1):
+            if text[-j:] in self.prefixes:
+                return j
+
+        return 0
+
+
+@functools.lru_cache(maxsize=64)
+def _get_stop_matcher(strings):
+    return StopStringMatcher(strings)
+
+
+def get_stop_matcher(strings):
+    return _get_stop_matcher(tuple(strings))
+
+
+class _SessionStoppingCriteria(transformers.StoppingCriteria):
+    def __init__(self, session):
+        transformers.StoppingCriteria.__init__(self)
+        self.session = session
+
+    def __call__(self, input_ids: torch.LongTensor, _scores: torch.FloatTensor) -> bool:
+        return self.session.stopped
+
+
+class _BatchStoppingCriteria(transformers.StoppingCriteria):
+
+    """
+    Stops a batch of sequences once every one of them has ended with a
+    stopping string or an eos token. The length at which each sequence
+    ended is kept in ended_at (-1 while it goes on).
+    """
+
+    def __init__(self, sentinel_criteria, eos_token_ids, batch_size):
+        transformers.StoppingCriteria.__init__(self)
+        self.sentinel_criteria = sentinel_criteria
+        self.eos_token_ids = torch.tensor(eos_token_ids, dtype=torch.long)
+        self.ended_at = torch.full((batch_size,), -1, dtype=torch.long)
+
+    def __call__(self, input_ids: torch.LongTensor, _scores: torch.FloatTensor) -> bool:
+        done = torch.isin(input_ids[:, -1].cpu(), self.eos_token_ids)
+        if self.sentinel_criteria is not None:
+            done |= self.sentinel_criteria.done_flags(input_ids).cpu()
+
+        self.ended_at[done & (self.ended_at < 0)] = input_ids.shape[-1]
+        return bool((self.ended_at >= 0).all())
 
 
 class Stream(transformers.StoppingCriteria):
@@ -55,16 +147,17 @@ class Iteratorize:
     Adapted from: https://stackoverflow.com/a/9969000
     """
 
-    def __init__(self, func, kwargs={}, callback=None):
+    def __init__(self, func, kwargs={}, callback=None, session=None):
         self.mfunc = func
         self.c_callback = callback
         self.q = Queue()
         self.sentinel = object()
         self.kwargs = kwargs
         self.stop_now = False
+        self.session = get_session(session)
 
         def _callback(val):
-            if self.stop_now or shared.stop_everything:
+            if self.stop_now or self.session.stopped:
                 raise ValueError
             self.q.put(val)
 
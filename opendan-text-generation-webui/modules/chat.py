@@ -12,8 +12,10 @@ import yaml
 from PIL import Image
 
 import modules.shared as shared
+from modules.callbacks import get_stop_matcher
 from modules.extensions import apply_extensions
 from modules.html_generator import chat_html_wrapper, make_thumbnail
+from modules.session import get_session
 from modules.text_generation import (encode, generate_reply,
                                      get_max_prompt_length)
 
@@ -26,10 +28,43 @@ def replace_all(text, dic):
     return text
 
 
+class TokenCounter:
+
+    """
+    Counts the tokens of prompt rows. The counts are cached inside the chat
+    history, keyed by the rendered row (message text plus turn template), so
+    that each turn is only tokenized once no matter how often the prompt is
+    rebuilt. The cache is dropped when the tokenizer changes.
+    """
+
+    def __init__(self, history):
+        cache = history.get('token_counts')
+        if cache is None or cache['tokenizer'] != id(shared.tokenizer):
+            cache = history['token_counts'] = {'tokenizer': id(shared.tokenizer), 'special': len(encode('')[0]), 'rows': {}}
+
+        self.special = cache['special']
+        self.counts = cache['rows']
+        self.used = set()
+
+    def __call__(self, row):
+        self.used.add(row)
+        if row not in self.counts:
+            self.counts[row] = len(encode(row)[0]) - self.special
+
+        return self.counts[row]
+
+    # Forgets the rows of deleted or edited messages
+    def prune(self):
+        if len(self.counts) > 2 * len(self.used) + 64:
+            for row in [row for row in self.counts if row not in self.used]:
+                del self.counts[row]
+
+
 def generate_chat_prompt(user_input, state, **kwargs):
     impersonate = kwargs['impersonate'] if 'impersonate' in kwargs else False
     _continue = kwargs['_continue'] if '_continue' in kwargs else False
     also_return_rows = kwargs['also_return_rows'] if 'also_return_rows' in kwargs else False
+    history = get_session(kwargs.get('session')).history
     is_instruct = state['mode'] == 'instruct'
     rows = [state['context'] if is_instruct else f"{state['context'].strip()}\n"]
     min_rows = 3
@@ -61,33 +96,47 @@ def generate_chat_prompt(user_input, state, **kwargs):
     bot_turn_stripped = replace_all(bot_turn.split('<|bot-message|>')[0], replacements)
 
     # Building the prompt
-    i = len(shared.history['internal']) - 1
-    while i >= 0 and len(encode(''.join(rows))[0]) < max_length:
-        if _continue and i == len(shared.history['internal']) - 1:
-            rows.insert(1, bot_turn_stripped + shared.history['internal'][i][1].strip())
+    count_tokens = TokenCounter(history)
+    token_count = count_tokens.special + count_tokens(rows[0])
+    history_rows = []
+    i = len(history['internal']) - 1
+    while i >= 0 and token_count < max_length:
+        if _continue and i == len(history['internal']) - 1:
+            history_rows.append(bot_turn_stripped + history['internal'][i][1].strip())
         else:
-            rows.insert(1, bot_turn.replace('<|bot-message|>', shared.history['internal'][i][1].strip()))
+            history_rows.append(bot_turn.replace('<|bot-message|>', history['internal'][i][1].strip()))
 
-        string = shared.history['internal'][i][0]
+        token_count += count_tokens(history_rows[-1])
+        string = history['internal'][i][0]
         if string not in ['', '<|BEGIN-VISIBLE-CHAT|>']:
-            rows.insert(1, replace_all(user_turn, {'<|user-message|>': string.strip(), '<|round|>': str(i)}))
+            history_rows.append(replace_all(user_turn, {'<|user-message|>': string.strip(), '<|round|>': str(i)}))
+            token_count += count_tokens(history_rows[-1])
 
         i -= 1
 
+    rows += reversed(history_rows)
     if impersonate:
         min_rows = 2
         rows.append(user_turn_stripped.rstrip(' '))
+        token_count += count_tokens(rows[-1])
     elif not _continue:
         # Adding the user message
         if len(user_input) > 0:
-            rows.append(replace_all(user_turn, {'<|user-message|>': user_input.strip(), '<|round|>': str(len(shared.history["internal"]))}))
+            rows.append(replace_all(user_turn, {'<|user-message|>': user_input.strip(), '<|round|>': str(len(history["internal"]))}))
+            token_count += count_tokens(rows[-1])
 
         # Adding the Character prefix
         rows.append(apply_extensions("bot_prefix", bot_turn_stripped.rstrip(' ')))
+        token_count += count_tokens(rows[-1])
 
-    while len(rows) > min_rows and len(encode(''.join(rows))[0]) >= max_length:
-        rows.pop(1)
+    # Removing the oldest rows until the prompt fits
+    dropped = 0
+    while len(rows) - dropped > min_rows and token_count >= max_length:
+        dropped += 1
+        token_count -= count_tokens(rows[dropped])
 
+    rows = rows[:1] + rows[dropped + 1:]
+    count_tokens.prune()
     prompt = ''.join(rows)
     if also_return_rows:
         return prompt, rows
@@ -115,32 +164,28 @@ def extract_message_from_reply(reply, state):
         if len(lines) > 1:
             next_character_found = True
     else:
-        for string in stopping_strings:
-            idx = reply.find(string)
-            if idx != -1:
-                reply = reply[:idx]
-                next_character_found = True
+        matcher = get_stop_matcher(stopping_strings)
+        idx = matcher.find(reply)
+        if idx != -1:
+            reply = reply[:idx]
+            next_character_found = True
 
         # If something like "\nYo" is generated just before "\nYou:"
         # is completed, trim it
-        if not next_character_found:
-            for string in stopping_strings:
-                for j in range(len(string) - 1, 0, -1):
-                    if reply[-j:] == string[:j]:
-                        reply = reply[:-j]
-                        break
-                else:
-                    continue
-
-                break
+        else:
+            j = matcher.partial_suffix_len(reply)
+            if j > 0:
+                reply = reply[:-j]
 
     return reply, next_character_found
 
 
-def chatbot_wrapper(text, state, regenerate=False, _continue=False):
+def chatbot_wrapper(text, state, regenerate=False, _continue=False, session=None):
+    session = get_session(session)
+    history = session.history
     if shared.model_name == 'None' or shared.model is None:
         logging.error("No model is loaded! Select one in the Model tab.")
-        yield shared.history['visible']
+        yield history['visible']
         return
 
     # Defining some variables
@@ -158,20 +203,20 @@ def chatbot_wrapper(text, state, regenerate=False, _continue=False):
 
         text = apply_extensions('input', text)
         # *Is typing...*
-        yield shared.history['visible'] + [[visible_text, shared.processing_message]]
+        yield history['visible'] + [[visible_text, shared.processing_message]]
     else:
-        text, visible_text = shared.history['internal'][-1][0], shared.history['visible'][-1][0]
+        text, visible_text = history['internal'][-1][0], history['visible'][-1][0]
         if regenerate:
-            shared.history['visible'].pop()
-            shared.history['internal'].pop()
+            history['visible'].pop()
+            history['internal'].pop()
             # *Is typing...*
-            yield shared.history['visible'] + [[visible_text, shared.processing_message]]
+            yield history['visible'] + [[visible_text, shared.processing_message]]
         elif _continue:
-            last_reply = [shared.history['internal'][-1][1], shared.history['visible'][-1][1]]
-            yield shared.history['visible'][:-1] + [[visible_text, last_reply[1] + '...']]
+            last_reply = [history['internal'][-1][1], history['visible'][-1][1]]
+            yield history['visible'][:-1] + [[visible_text, last_reply[1] + '...']]
 
     # Generating the prompt
-    kwargs = {'_continue': _continue}
+    kwargs = {'_continue': _continue, 'session': session}
     prompt = apply_extensions('custom_generate_chat_prompt', text, state, **kwargs)
     if prompt is None:
         prompt = generate_chat_prompt(text, state, **kwargs)
@@ -179,7 +224,7 @@ def chatbot_wrapper(text, state, regenerate=False, _continue=False):
     # Generate
     for i in range(state['chat_generation_attempts']):
         reply = None
-        for reply in generate_reply(f"{prompt}{' ' if len(cumulative_reply) > 0 else ''}{cumulative_reply}", state, eos_token=eos_token, stopping_strings=stopping_strings):
+        for reply in generate_reply(f"{prompt}{' ' if len(cumulative_reply) > 0 else ''}{cumulative_reply}", state, eos_token=eos_token, stopping_strings=stopping_strings, session=session):
             reply = cumulative_reply + reply
 
             # Extracting the reply
@@ -192,30 +237,31 @@ def chatbot_wrapper(text, state, regenerate=False, _continue=False):
                 sep = ' ' if last_reply[1][-1] not in [' ', '\n'] else ''
                 visible_reply = last_reply[1] + sep + visible_reply
 
-            # We need this global variable to handle the Stop event,
+            # We need this flag to handle the Stop event,
             # otherwise gradio gets confused
-            if shared.stop_everything:
-                return shared.history['visible']
+            if session.stopped:
+                return history['visible']
 
             if just_started:
                 just_started = False
                 if not _continue:
-                    shared.history['internal'].append(['', ''])
-                    shared.history['visible'].append(['', ''])
+                    history['internal'].append(['', ''])
+                    history['visible'].append(['', ''])
 
-            shared.history['internal'][-1] = [text, reply]
-            shared.history['visible'][-1] = [visible_text, visible_reply]
-            yield shared.history['visible']
+            history['internal'][-1] = [text, reply]
+            history['visible'][-1] = [visible_text, visible_reply]
+            yield history['visible']
             if next_character_found:
                 break
 
         if reply is not None:
             cumulative_reply = reply
 
-    yield shared.history['visible']
+    yield history['visible']
 
 
-def impersonate_wrapper(text, state):
+def impersonate_wrapper(text, state, session=None):
+    session = get_session(session)
     if shared.model_name == 'None' or shared.model is None:
         logging.error("No model is loaded! Select one in the Model tab.")
         yield ''
@@ -224,14 +270,14 @@ def impersonate_wrapper(text, state):
     # Defining some variables
     cumulative_reply = ''
     eos_token = '\n' if state['stop_at_newline'] else None
-    prompt = generate_chat_prompt(text, state, impersonate=True)
+    prompt = generate_chat_prompt(text, state, impersonate=True, session=session)
     stopping_strings = get_stopping_strings(state)
 
     # Yield *Is typing...*
     yield shared.processing_message
     for i in range(state['chat_generation_attempts']):
         reply = None
-        for reply in generate_reply(f"{prompt}{' ' if len(cumulative_reply) > 0 else ''}{cumulative_reply}", state, eos_token=eos_token, stopping_strings=stopping_strings):
+        for reply in generate_reply(f"{prompt}{' ' if len(cumulative_reply) > 0 else ''}{cumulative_reply}", state, eos_token=eos_token, stopping_strings=stopping_strings, session=session):
             reply = cumulative_reply + reply
             reply, next_character_found = extract_message_from_reply(reply, state)
             yield reply
@@ -0,0 +1,58 @@
+'''
+Incremental detokenization for streaming.
+
+Decoding the whole reply after every new token makes streaming quadratic in
+the length of the reply. StreamingDetokenizer only decodes a small window
+around the newest tokens and appends the text that it adds to the reply.
+
+The window starts a few tokens before the new ones so that tokenizers that
+change the text of a token depending on what precedes it (SentencePiece
+drops the leading space of the first token, byte-level BPE can split a
+character over several tokens) still produce the right text. A step that
+ends with an incomplete UTF-8 sequence emits nothing until the rest of the
+character has arrived.
+'''
+
+# Number of prompt tokens used as context for the first new token
+CONTEXT_TOKENS = 5
+
+
+class StreamingDetokenizer:
+    def __init__(self, tokenizer, prompt_ids, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.prompt_length = len(prompt_ids)
+        self.ids = [int(i) for i in prompt_ids[-CONTEXT_TOKENS:]]
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        self.consumed = 0
+        self.text = ''
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    # Adds one token and returns the text that it completes, if any
+    def step(self, token):
+        self.ids.append(int(token))
+        prefix_text = self.decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return ''
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        self.text += delta
+        return delta
+
+    # Takes the full output ids (prompt included) and returns the reply so far
+    def update(self, output_ids):
+        new_ids = output_ids[self.prompt_length + self.consumed:]
+        if hasattr(new_ids, 'tolist'):
+            new_ids = new_ids.tolist()
+
+        for token in new_ids:
+            self.step(token)
+
+        self.consumed += len(new_ids)
+        return self.text
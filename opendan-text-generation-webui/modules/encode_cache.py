@@ -0,0 +1,109 @@
+'''
+Memoizes the output of the tokenizer.
+
+The same strings are encoded over and over: stopping strings and the eos
+string on every request, chat turns every time the prompt is rebuilt, the
+system message of every OpenAI request. The CPU token arrays are kept here
+in LRU order, bounded both by number of entries and by size, and the whole
+cache is dropped when shared.tokenizer changes.
+'''
+
+import threading
+from collections import OrderedDict
+
+import modules.shared as shared
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class EncodeCache:
+    def __init__(self, tokenizer, max_entries, max_bytes):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+            return value
+
+    def put(self, key, value):
+        # The key holds the prompt, so count it too
+        nbytes = _nbytes(value) + len(key[0])
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+            }
+
+
+def _nbytes(value):
+    if hasattr(value, 'element_size'):
+        return value.numel() * value.element_size()
+    else:
+        return value.nbytes
+
+
+def get_cache():
+    global _cache
+    if shared.args.encode_cache_size <= 0 or shared.args.encode_cache_mb <= 0:
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.tokenizer is not shared.tokenizer:
+            _cache = EncodeCache(shared.tokenizer, shared.args.encode_cache_size, int(shared.args.encode_cache_mb * 1024 * 1024))
+
+        return _cache
+
+
+# Looks up every prompt and calls tokenize(missing_prompts) once for the rest
+def cached_encode(prompts, add_special_tokens, add_bos_token, tokenize):
+    cache = get_cache()
+    if cache is None:
+        return tokenize(prompts)
+
+    keys = [(prompt, add_special_tokens, add_bos_token) for prompt in prompts]
+    results = [cache.get(key) for key in keys]
+    results = [value[0] if value is not None else None for value in results]
+    missing = [i for i, value in enumerate(results) if value is None]
+    if len(missing) > 0:
+        for i, value in zip(missing, tokenize([prompts[i] for i in missing])):
+            cache.put(keys[i], value)
+            results[i] = value
+
+    return results
+
+
+def get_stats():
+    cache = get_cache()
+    return cache.stats() if cache is not None else None
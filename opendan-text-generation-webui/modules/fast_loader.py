@@ -0,0 +1,147 @@
+'''
+Fast loading of safetensors checkpoints, and a timing breakdown of the loads.
+
+With --fast-load, a model stored as safetensors (see convert-to-safetensors.py)
+is built on the meta device, so its weights are never initialized, and its
+shards are memory-mapped. A thread reads the tensors while the main thread
+casts them to the target dtype and moves them to the GPU, so reading the
+disk overlaps with the copies to the device.
+'''
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Empty, Queue
+
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from transformers import AutoConfig, GenerationConfig
+
+# tensors read ahead of the device copies
+QUEUE_SIZE = 8
+
+
+class LoadProfiler:
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - t0)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def summary(self):
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases.items())
+
+
+def safetensors_files(path):
+    path = Path(path)
+    index = path / 'model.safetensors.index.json'
+    if index.exists():
+        return [path / name for name in sorted(set(json.loads(index.read_text())['weight_map'].values()))]
+
+    return sorted(path.glob('*.safetensors'))
+
+
+def _read_shards(files, queue, stop, profiler):
+    from safetensors import safe_open
+
+    try:
+        for file in files:
+            with safe_open(str(file), framework='pt', device='cpu') as f:
+                for key in f.keys():
+                    if stop.is_set():
+                        return
+
+                    t0 = time.time()
+                    tensor = f.get_tensor(key)
+                    profiler.add('read', time.time() - t0)
+                    queue.put((key, tensor))
+    except Exception as e:
+        queue.put(e)
+    finally:
+        queue.put(None)
+
+
+def load_safetensors(path, LoaderClass, dtype, device, profiler, trust_remote_code=False):
+    files = safetensors_files(path)
+    if len(files) == 0:
+        raise FileNotFoundError(f'No .safetensors file in {path}')
+
+    with profiler.phase('config'):
+        config = AutoConfig.from_pretrained(path, trust_remote_code=trust_remote_code)
+
+    # No memory is allocated and no weight is initialized on the meta device
+    with profiler.phase('init'):
+        with init_empty_weights():
+            model = LoaderClass.from_config(config, torch_dtype=dtype, trust_remote_code=trust_remote_code)
+
+    names = set(name for name, _ in model.named_parameters()) | set(name for name, _ in model.named_buffers())
+    prefix = model.base_model_prefix
+    loaded = set()
+    queue = Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_shards, args=(files, queue, stop, profiler), daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            elif isinstance(item, Exception):
+                raise item
+
+            key, tensor = item
+
+            # Checkpoints saved from the base model don't have its prefix, and the other way around
+            if key not in names and f'{prefix}.{key}' in names:
+                key = f'{prefix}.{key}'
+            elif key not in names and key.startswith(f'{prefix}.') and key[len(prefix) + 1:] in names:
+                key = key[len(prefix) + 1:]
+            elif key not in names:
+                continue
+
+            with profiler.phase('cast'):
+                if tensor.is_floating_point():
+                    tensor = tensor.to(dtype)
+
+            with profiler.phase('device'):
+                set_module_tensor_to_device(model, key, device, value=tensor)
+
+            loaded.add(key)
+    finally:
+        # Unblocks the reader if the loop stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+    # Tied weights (such as lm_head and the embeddings) are only stored once
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == 'meta']
+    if len(missing) > 0:
+        raise ValueError(f'{len(missing)} weights are missing from the checkpoint, for instance {missing[0]}')
+
+    # The buffers that are not in the checkpoint (such as rotary embeddings) were built on the CPU
+    with profiler.phase('device'):
+        model.to(device)
+
+    # from_config() only derives the generation defaults from the model config,
+    # from_pretrained() reads them from generation_config.json
+    if (Path(path) / 'generation_config.json').exists() and model.can_generate():
+        model.generation_config = GenerationConfig.from_pretrained(path)
+
+    model.eval()
+    logging.info(f'Loaded {len(loaded)} tensors from {len(files)} safetensors files.')
+    return model
@@ -0,0 +1,202 @@
+'''
+Shared HTTP client for the Stable Diffusion API and the helper LLM calls.
+
+All the requests go through one requests.Session, so connections are kept
+alive and pooled. Each host gets a concurrency limit, failed requests are
+retried with exponential backoff and full jitter, and a host that keeps
+failing is skipped for a while (circuit breaker) instead of being hammered
+by every caller at once. The requests, their latencies and the state of
+the circuits are served with the other metrics of modules.metrics.
+
+Timeouts while reading the response are only retried for idempotent
+methods: a POST that timed out may still be running on the server (a
+txt2img render, for instance), and sending it again would run it twice.
+
+This module doesn't import modules.shared, so that standalone scripts can
+use it too. The defaults can be changed with the HTTP_MAX_PER_HOST,
+HTTP_RETRIES, HTTP_FAILURE_THRESHOLD and HTTP_RESET_TIMEOUT environment
+variables.
+'''
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+# Full jitter: a random delay between 0 and the exponential backoff
+def backoff_delay(attempt, base=0.5, maximum=8.0):
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class HostState:
+    def __init__(self, max_concurrency, failure_threshold, reset_timeout):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=256)
+        self.lock = threading.Lock()
+
+    # Open: fail fast. After reset_timeout, a single trial request is let through.
+    def before_request(self, host):
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if time.time() - self.opened_at < self.reset_timeout or self.trial:
+                raise CircuitOpenError(f'{host} is failing, not sending requests to it for now')
+
+            self.trial = True
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.errors += 1
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.time()
+
+    def metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'circuit': 'closed' if self.opened_at is None else 'open',
+                'latency_p50_ms': 1000 * latencies[len(latencies) // 2] if latencies else None,
+                'latency_p95_ms': 1000 * latencies[int(len(latencies) * 0.95)] if latencies else None,
+                'latency_max_ms': 1000 * latencies[-1] if latencies else None,
+            }
+
+
+class HttpClient:
+    def __init__(self, max_per_host=4, retries=3, failure_threshold=5, reset_timeout=30, pool_size=32):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hosts = {}
+        self.host_limits = {}
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def set_host_limit(self, host, max_concurrency):
+        with self.lock:
+            self.host_limits[host] = max_concurrency
+            self.hosts.pop(host, None)
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(self.host_limits.get(host, self.max_per_host), self.failure_threshold, self.reset_timeout)
+
+            return self.hosts[host]
+
+    # Like session.request(), with retries. Returns the last response even if
+    # it failed, so callers can keep using raise_for_status(). retry_timeouts
+    # defaults to whether the method is idempotent.
+    def request(self, method, url, retries=None, retry_timeouts=None, **kwargs):
+        retries = self.retries if retries is None else retries
+        retry_timeouts = method.upper() in IDEMPOTENT_METHODS if retry_timeouts is None else retry_timeouts
+        host = urlsplit(url).netloc
+        state = self._host(host)
+        for attempt in range(max(1, retries)):
+            try:
+                state.before_request(host)
+            except CircuitOpenError:
+                metrics.HTTP_REQUESTS.inc(host=host, method=method, outcome='circuit_open')
+                raise
+
+            response, error = None, None
+            with state.semaphore:
+                t0 = time.time()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.exceptions.RequestException as e:
+                    error = e
+
+                latency = time.time() - t0
+                state.record(latency, error is None and response.status_code not in RETRY_STATUSES)
+
+            metrics.HTTP_LATENCY.observe(latency, host=host, method=method)
+            metrics.HTTP_REQUESTS.inc(host=host, method=method, outcome=type(error).__name__ if error is not None else str(response.status_code))
+            if error is None and response.status_code not in RETRY_STATUSES:
+                return response
+
+            logging.info(f'{method} {url} failed (attempt {attempt + 1}/{retries}): {error or response.status_code}')
+            if attempt == retries - 1 or (isinstance(error, requests.exceptions.ReadTimeout) and not retry_timeouts):
+                break
+
+            time.sleep(backoff_delay(attempt))
+
+        if error is not None:
+            raise error
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def metrics(self):
+        with self.lock:
+            hosts = dict(self.hosts)
+
+        return {host: state.metrics() for host, state in hosts.items()}
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(
+                max_per_host=int(os.environ.get('HTTP_MAX_PER_HOST', 4)),
+                retries=int(os.environ.get('HTTP_RETRIES', 3)),
+                failure_threshold=int(os.environ.get('HTTP_FAILURE_THRESHOLD', 5)),
+                reset_timeout=float(os.environ.get('HTTP_RESET_TIMEOUT', 30)),
+            )
+
+        return _client
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_client().post(url, **kwargs)
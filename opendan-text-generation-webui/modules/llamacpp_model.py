@@ -6,6 +6,8 @@ Documentation:
 https://abetlen.github.io/llama-cpp-python/
 '''
 
+import codecs
+
 from llama_cpp import Llama, LlamaCache
 
 from modules import shared
@@ -45,22 +47,27 @@ class LlamaCppModel:
             context = context.encode()
         tokens = self.model.tokenize(context)
 
+        # A character can be split over several tokens, so only complete
+        # UTF-8 sequences are passed to the callback
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         output = b""
         count = 0
         for token in self.model.generate(tokens, top_k=top_k, top_p=top_p, temp=temperature, repeat_penalty=repetition_penalty):
             text = self.model.detokenize([token])
             output += text
             if callback:
-                callback(text.decode())
+                text = decoder.decode(text)
+                if text:
+                    callback(text)
 
             count += 1
             if count >= token_count or (token == self.model.token_eos()):
                 break
 
-        return output.decode()
+        return output.decode(errors='replace')
 
-    def generate_with_streaming(self, **kwargs):
-        with Iteratorize(self.generate, kwargs, callback=None) as generator:
+    def generate_with_streaming(self, session=None, **kwargs):
+        with Iteratorize(self.generate, kwargs, callback=None, session=session) as generator:
             reply = ''
             for token in generator:
                 reply += token
@@ -0,0 +1,234 @@
+'''
+Telemetry of the generations, in the Prometheus text format.
+
+The backends in modules.text_generation record, for every generation, the
+time spent tokenizing, the time to the first token, the latency between
+tokens, the speed and the token counts, labeled by model, backend and route
+(the API endpoint, or webui). The API servers add the time the requests
+waited in their queues and serve everything on GET /metrics. The outgoing
+requests of modules.http_client (Stable Diffusion, helper LLM) are counted
+by host and outcome, with their latency and the state of each circuit.
+'''
+
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5)
+SPEED_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+# Reads its values when rendered, from counters kept elsewhere
+class CollectedCounter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self.collect().items()]
+
+
+class CollectedGauge(CollectedCounter):
+    type = 'gauge'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, count=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[0][i] += count
+                    break
+
+            values[1] += count
+            values[2] += value * count
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, count, total) in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append((f'{self.name}_bucket', _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"'), cumulative))
+
+                samples.append((f'{self.name}_count', _format_labels(self.labelnames, key), count))
+                samples.append((f'{self.name}_sum', _format_labels(self.labelnames, key), total))
+
+        return samples
+
+
+def _circuits():
+    from modules import http_client
+
+    if http_client._client is None:
+        return {}
+
+    return {(host,): int(state['circuit'] == 'open') for host, state in http_client._client.metrics().items()}
+
+
+def _cache_counts(attr):
+    from modules import encode_cache, prefix_cache
+
+    counts = {}
+    for name, cache in (('encode', encode_cache._cache), ('prefix', prefix_cache._cache)):
+        if cache is not None:
+            counts[(name,)] = getattr(cache, attr)
+
+    return counts
+
+
+GENERATION_LABELS = ('model', 'backend', 'route')
+
+REQUESTS = Counter('textgen_requests_total', 'Generations started.', GENERATION_LABELS)
+IN_PROGRESS = Gauge('textgen_requests_in_progress', 'Generations running.', GENERATION_LABELS)
+QUEUE_WAIT = Histogram('textgen_queue_wait_seconds', 'Time spent waiting in a queue before generating.', ('model', 'route', 'queue'))
+TOKENIZE = Histogram('textgen_tokenize_seconds', 'Time spent encoding the prompt.', GENERATION_LABELS)
+TIME_TO_FIRST_TOKEN = Histogram('textgen_time_to_first_token_seconds', 'Time from the start of a generation to its first token.', GENERATION_LABELS)
+INTER_TOKEN_LATENCY = Histogram('textgen_inter_token_latency_seconds', 'Time between two generated tokens.', GENERATION_LABELS, TOKEN_LATENCY_BUCKETS)
+GENERATION_TIME = Histogram('textgen_generation_seconds', 'Duration of the generations.', GENERATION_LABELS)
+TOKENS_PER_SECOND = Histogram('textgen_tokens_per_second', 'Generated tokens per second, per generation.', GENERATION_LABELS, SPEED_BUCKETS)
+PROMPT_TOKENS = Counter('textgen_prompt_tokens_total', 'Tokens in the prompts.', GENERATION_LABELS)
+COMPLETION_TOKENS = Counter('textgen_completion_tokens_total', 'Generated tokens.', GENERATION_LABELS)
+CACHE_HITS = CollectedCounter('textgen_cache_hits_total', 'Lookups answered by a cache.', ('cache',), lambda: _cache_counts('hits'))
+CACHE_MISSES = CollectedCounter('textgen_cache_misses_total', 'Lookups that missed a cache.', ('cache',), lambda: _cache_counts('misses'))
+
+HTTP_REQUESTS = Counter('textgen_http_requests_total', 'Outgoing HTTP requests, by outcome (status code, exception or circuit_open).', ('host', 'method', 'outcome'))
+HTTP_LATENCY = Histogram('textgen_http_request_seconds', 'Latency of the outgoing HTTP requests.', ('host', 'method'))
+HTTP_CIRCUIT_OPEN = CollectedGauge('textgen_http_circuit_open', '1 while the requests to a host are skipped after repeated failures.', ('host',), _circuits)
+
+
+class GenerationMetrics:
+
+    """
+    Records one generation. update() is called with the number of tokens
+    generated so far each time the backend has new ones, and finish()
+    once it is over.
+    """
+
+    def __init__(self, model, backend, route):
+        self.labels = {'model': model, 'backend': backend, 'route': route or 'webui'}
+        self.t0 = time.time()
+        self.last = None
+        self.tokens = 0
+        self.finished = False
+        REQUESTS.inc(**self.labels)
+        IN_PROGRESS.inc(**self.labels)
+
+    def tokenized(self):
+        TOKENIZE.observe(time.time() - self.t0, **self.labels)
+
+    def update(self, tokens):
+        if tokens is None or tokens <= self.tokens:
+            return
+
+        now = time.time()
+        if self.last is None:
+            TIME_TO_FIRST_TOKEN.observe(now - self.t0, **self.labels)
+        else:
+            INTER_TOKEN_LATENCY.observe((now - self.last) / (tokens - self.tokens), count=tokens - self.tokens, **self.labels)
+
+        self.last = now
+        self.tokens = tokens
+
+    def finish(self, prompt_tokens, completion_tokens):
+        if self.finished:
+            return
+
+        self.finished = True
+        elapsed = time.time() - self.t0
+
+        # Without streaming, all the tokens come at once
+        if self.last is None and completion_tokens > 0:
+            TIME_TO_FIRST_TOKEN.observe(elapsed, **self.labels)
+
+        GENERATION_TIME.observe(elapsed, **self.labels)
+        if elapsed > 0 and completion_tokens > 0:
+            TOKENS_PER_SECOND.observe(completion_tokens / elapsed, **self.labels)
+
+        PROMPT_TOKENS.inc(max(prompt_tokens, 0), **self.labels)
+        COMPLETION_TOKENS.inc(max(completion_tokens, 0), **self.labels)
+        IN_PROGRESS.dec(**self.labels)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
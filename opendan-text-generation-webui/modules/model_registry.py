@@ -0,0 +1,347 @@
+'''
+Keeps several models loaded and switches between them.
+
+shared.model, shared.tokenizer, shared.model_type, shared.model_name and
+shared.lora_names always describe the active model, the one that the rest
+of the code generates with. The other loaded models stay on the GPU while
+they fit in --model-vram-budget, then in RAM within --model-ram-budget,
+and the least recently used ones are dropped beyond that. Going back to a
+recent model then costs a copy to the GPU instead of a load from disk.
+
+API requests run inside `with get_registry().use(name):`, which makes the
+model active and keeps it active until the block ends. The requests are
+served in order: a request for another model waits for the ones in
+progress, and the ones that come after it wait for it. A model that isn't
+loaded yet is loaded without holding the lock, so the active model keeps
+serving its requests meanwhile. Every generation, the web UI ones included,
+also runs inside `hold()`, so the model can't be switched under it.
+
+After each switch, the model that most often came next is loaded in the
+background, if it fits in the VRAM budget.
+'''
+
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+import modules.shared as shared
+from modules.LoRA import add_lora_to_model
+from modules.models import clear_torch_cache, find_model_type, load_model_as
+
+GiB = 1024 ** 3
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def available_models():
+    if shared.args.flexgen:
+        return sorted([re.sub('-np$', '', item.name) for item in list(Path(f'{shared.args.model_dir}/').glob('*')) if item.name.endswith('-np')], key=str.lower)
+    else:
+        return sorted([re.sub('.pth$', '', item.name) for item in list(Path(f'{shared.args.model_dir}/').glob('*')) if not item.name.endswith(('.txt', '-np', '.pt', '.json', '.yaml'))], key=str.lower)
+
+
+# Size of the weights on disk, a good guess of the size of the loaded model
+def estimate_bytes(model_name):
+    path = Path(f'{shared.args.model_dir}/{model_name}')
+    files = [path] if path.is_file() else list(path.glob('*.bin')) + list(path.glob('*.safetensors')) + list(path.glob('*.pt'))
+    return sum(f.stat().st_size for f in files)
+
+
+def model_bytes(model):
+    if not isinstance(model, torch.nn.Module):
+        return 0
+
+    return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+
+class ModelEntry:
+    def __init__(self, name, model, tokenizer, model_type, lora_names):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_type = model_type
+        self.lora_names = list(lora_names)
+        self.size = model_bytes(model) or estimate_bytes(name)
+
+        # Only the models loaded on a single device without a device map can be
+        # moved with .to(), the other ones (quantized, split across devices,
+        # llama.cpp...) are dropped
+        devices = {p.device.type for p in model.parameters()} if isinstance(model, torch.nn.Module) else set()
+        self.on_gpu = 'cuda' in devices or (not isinstance(model, torch.nn.Module) and not shared.args.cpu)
+        self.movable = (
+            len(devices) == 1 and devices <= {'cuda', 'cpu'}
+            and not any((shared.args.deepspeed, shared.args.flexgen, shared.args.wbits > 0))
+            and not getattr(model, 'is_loaded_in_8bit', False)
+            and not getattr(model, 'is_loaded_in_4bit', False)
+            and not hasattr(model, 'hf_device_map')
+        )
+
+    def to(self, device):
+        self.model = self.model.to(device)
+        self.on_gpu = device == 'cuda'
+
+
+class ModelRegistry:
+    def __init__(self, vram_budget, ram_budget):
+        self.vram_budget = int(vram_budget * GiB)
+        self.ram_budget = int(ram_budget * GiB)
+        self.entries = OrderedDict()  # least recently used first
+        self.active = None
+        self.users = 0
+        self.queue = deque()
+        self.loading = set()
+        self.loading_ahead = False  # the request at the head of the queue is loading its model
+        self.transitions = defaultdict(Counter)
+        self.condition = threading.Condition()
+
+    def gpu_bytes(self):
+        return sum(entry.size for entry in self.entries.values() if entry.on_gpu)
+
+    def cpu_bytes(self):
+        return sum(entry.size for entry in self.entries.values() if not entry.on_gpu)
+
+    def fits(self, needed):
+        used, budget = (self.cpu_bytes(), self.ram_budget) if shared.args.cpu else (self.gpu_bytes(), self.vram_budget)
+        return used + needed <= budget
+
+    def active_ready(self):
+        entry = self.entries.get(self.active)
+        return entry is not None and entry.model is shared.model and (entry.on_gpu or shared.args.cpu)
+
+    def resolve(self, name):
+        return name if name and (name in self.entries or name in available_models()) else None
+
+    # The web UI loads and unloads shared.model directly
+    def _sync(self):
+        entry = self.entries.get(self.active)
+        if entry is not None and entry.model is shared.model:
+            entry.tokenizer = shared.tokenizer
+            entry.lora_names = list(shared.lora_names)
+            return
+
+        if entry is not None:
+            del self.entries[entry.name]
+
+        self.active = None
+        if shared.model is not None:
+            self.entries[shared.model_name] = ModelEntry(shared.model_name, shared.model, shared.tokenizer, shared.model_type, shared.lora_names)
+            self.active = shared.model_name
+
+    @contextmanager
+    def use(self, name=None, lora_names=None):
+        ticket = object()
+        with self.condition:
+            self._sync()
+            self.queue.append(ticket)
+            try:
+                while True:
+                    wanted = name or self.active
+                    if self.queue[0] is ticket:
+                        if wanted is not None and wanted not in self.entries and wanted not in self.loading:
+                            self._load(wanted)
+                            continue
+
+                        if wanted not in self.loading and (self.users == 0 or self.active == wanted):
+                            break
+                    elif self.loading_ahead and wanted == self.active and self.active_ready():
+                        # The active model serves while the head of the queue loads another one
+                        break
+
+                    self.condition.wait()
+
+                name = name or self.active
+                if name is not None and self.active != name:
+                    self._activate(name)
+
+                if lora_names is not None and self.users == 0 and list(lora_names) != shared.lora_names:
+                    add_lora_to_model(lora_names)
+                    self._sync()
+
+                self.users += 1
+            finally:
+                self.queue.remove(ticket)
+                self.condition.notify_all()
+
+        try:
+            yield self.entries.get(name)
+        finally:
+            with self.condition:
+                self.users -= 1
+                self.condition.notify_all()
+
+    # Keeps the active model active, without queueing or switching. Unlike
+    # use(), it can be nested and entered and left from different threads
+    # (Gradio runs generators on a thread pool).
+    @contextmanager
+    def hold(self):
+        with self.condition:
+            self._sync()
+            # A switch has started and the active model isn't usable until it's done
+            while len(self.queue) > 0 and not self.active_ready():
+                self.condition.wait()
+
+            self.users += 1
+
+        try:
+            yield self.entries.get(self.active)
+        finally:
+            with self.condition:
+                self.users -= 1
+                self.condition.notify_all()
+
+    # Called with the condition held, releases it for the load itself
+    def _load(self, name):
+        t0 = time.time()
+        needed = estimate_bytes(name)
+        self._evict(keep=self.active, needed=needed)
+        if not self.fits(needed):
+            # No room next to the active model, it has to go first
+            while self.users > 0:
+                self.condition.wait()
+
+            self._evict(keep=None, needed=needed)
+
+        self.loading.add(name)
+        self.loading_ahead = True
+        self.condition.notify_all()
+        self.condition.release()
+        try:
+            model_type = find_model_type(name)
+            model, tokenizer = load_model_as(name, model_type)
+        finally:
+            self.condition.acquire()
+            self.loading.discard(name)
+            self.loading_ahead = False
+            self.condition.notify_all()
+
+        self.entries[name] = ModelEntry(name, model, tokenizer, model_type, [])
+        if self.active in self.entries:
+            self.entries.move_to_end(self.active)
+
+        logging.info(f"Loaded {name} in {(time.time()-t0):.2f} seconds.")
+
+    def _activate(self, name):
+        t0 = time.time()
+        previous = self.active
+        entry = self.entries[name]
+        if not entry.on_gpu and not shared.args.cpu:
+            self._evict(keep=None, needed=entry.size)
+            entry.to('cuda')
+
+        self.entries.move_to_end(name)
+        shared.model, shared.tokenizer = entry.model, entry.tokenizer
+        shared.model_type, shared.model_name, shared.lora_names = entry.model_type, entry.name, list(entry.lora_names)
+        self.active = name
+        self._evict(keep=name)
+        clear_torch_cache()
+        logging.info(f"Switched to {name} in {(time.time()-t0):.2f} seconds.")
+
+        if previous is not None:
+            self.transitions[previous][name] += 1
+
+        following = self.transitions[name].most_common(1)
+        if len(following) > 0:
+            self.preload(following[0][0])
+
+    # Makes room on the GPU for `needed` more bytes, then in RAM, least recently used first
+    def _evict(self, keep, needed=0):
+        gpu_needed, cpu_needed = (0, needed) if shared.args.cpu else (needed, 0)
+        for entry in list(self.entries.values()):
+            if self.gpu_bytes() + gpu_needed <= self.vram_budget:
+                break
+
+            if entry.name == keep or not entry.on_gpu:
+                continue
+
+            if entry.movable and entry.size <= self.ram_budget:
+                logging.info(f"Moving {entry.name} to RAM.")
+                entry.to('cpu')
+            else:
+                self._drop(entry)
+
+        for entry in list(self.entries.values()):
+            if self.cpu_bytes() + cpu_needed <= self.ram_budget:
+                break
+
+            if entry.name != keep and not entry.on_gpu:
+                self._drop(entry)
+
+    def _drop(self, entry):
+        logging.info(f"Unloading {entry.name}.")
+        del self.entries[entry.name]
+        if shared.model is entry.model:
+            shared.model = shared.tokenizer = None
+
+        if self.active == entry.name:
+            self.active = None
+
+        entry.model = entry.tokenizer = None
+        clear_torch_cache()
+
+    # Loads a model in the background, if it fits next to the other ones on the GPU
+    # (in RAM with --cpu)
+    def preload(self, name):
+        with self.condition:
+            self._sync()
+            if name in self.entries or name in self.loading or not self.fits(estimate_bytes(name)):
+                return
+
+            self.loading.add(name)
+
+        threading.Thread(target=self._preload, args=(name,), daemon=True).start()
+
+    def _preload(self, name):
+        try:
+            model_type = find_model_type(name)
+            model, tokenizer = load_model_as(name, model_type)
+            with self.condition:
+                self.entries[name] = ModelEntry(name, model, tokenizer, model_type, [])
+                if self.active is not None:
+                    self.entries.move_to_end(self.active)
+
+                self._evict(keep=self.active)
+        except Exception:
+            logging.exception(f"Failed to preload {name}")
+        finally:
+            with self.condition:
+                self.loading.discard(name)
+                self.condition.notify_all()
+
+    def unload_all(self):
+        with self.condition:
+            for entry in list(self.entries.values()):
+                if entry.model is not shared.model:
+                    self._drop(entry)
+
+    def stats(self):
+        with self.condition:
+            self._sync()
+            return {
+                'active': self.active,
+                'users': self.users,
+                'waiting': len(self.queue),
+                'models': {entry.name: {'device': 'gpu' if entry.on_gpu else 'cpu', 'bytes': entry.size, 'loras': entry.lora_names} for entry in self.entries.values()},
+            }
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry(shared.args.model_vram_budget, shared.args.model_ram_budget)
+
+        return _registry
+
+
+# Frees the inactive models, for unload_model()
+def unload_inactive():
+    if _registry is not None:
+        _registry.unload_all()
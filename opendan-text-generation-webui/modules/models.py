@@ -17,6 +17,8 @@ from transformers import (AutoConfig, AutoModel, AutoModelForCausalLM,
 
 import modules.shared as shared
 from modules import llama_attn_hijack
+from modules.fast_loader import (LoadProfiler, load_safetensors,
+                                 safetensors_files)
 
 transformers.logging.set_verbosity_error()
 
@@ -68,26 +70,49 @@ def find_model_type(model_name):
 
 
 def load_model(model_name):
+    shared.model_type = find_model_type(model_name)
+    return load_model_as(model_name, shared.model_type)
+
+
+# Doesn't change shared.model_type, so that a model can be loaded while another one is in use
+def load_model_as(model_name, model_type):
     logging.info(f"Loading {model_name}...")
     t0 = time.time()
 
-    shared.model_type = find_model_type(model_name)
     trust_remote_code = shared.args.trust_remote_code
-    if shared.model_type == 'chatglm':
+    if model_type == 'chatglm':
         LoaderClass = AutoModel
-    elif shared.model_type == 'HF_seq2seq':
+    elif model_type == 'HF_seq2seq':
         LoaderClass = AutoModelForSeq2SeqLM
     else:
         LoaderClass = AutoModelForCausalLM
 
+    profiler = LoadProfiler()
+    t1 = time.time()
+
     # Load the model in simple 16-bit mode by default
-    if not any([shared.args.cpu, shared.args.load_in_8bit, shared.args.wbits, shared.args.auto_devices, shared.args.disk, shared.args.gpu_memory is not None, shared.args.cpu_memory is not None, shared.args.deepspeed, shared.args.flexgen, shared.model_type in ['rwkv', 'llamacpp']]):
-        model = LoaderClass.from_pretrained(Path(f"{shared.args.model_dir}/{model_name}"), low_cpu_mem_usage=True, torch_dtype=torch.bfloat16 if shared.args.bf16 else torch.float16, trust_remote_code=trust_remote_code)
-        if torch.has_mps:
-            device = torch.device('mps')
-            model = model.to(device)
-        else:
-            model = model.cuda()
+    if not any([shared.args.cpu, shared.args.load_in_8bit, shared.args.wbits, shared.args.auto_devices, shared.args.disk, shared.args.gpu_memory is not None, shared.args.cpu_memory is not None, shared.args.deepspeed, shared.args.flexgen, model_type in ['rwkv', 'llamacpp']]):
+        path = Path(f"{shared.args.model_dir}/{model_name}")
+        dtype = torch.bfloat16 if shared.args.bf16 else torch.float16
+        device = torch.device('mps') if torch.has_mps else torch.device('cuda')
+        model = None
+        if shared.args.fast_load and len(safetensors_files(path)) > 0:
+            try:
+                model = load_safetensors(path, LoaderClass, dtype, device, profiler, trust_remote_code=trust_remote_code)
+            except Exception:
+                logging.exception("The fast loading failed, loading the model with from_pretrained instead.")
+
+            # Outside of the except block: its traceback keeps the frame of
+            # load_safetensors, and the weights it put on the GPU, alive
+            if model is None:
+                clear_torch_cache()
+
+        if model is None:
+            with profiler.phase('from_pretrained'):
+                model = LoaderClass.from_pretrained(path, low_cpu_mem_usage=True, torch_dtype=dtype, trust_remote_code=trust_remote_code)
+
+            with profiler.phase('device'):
+                model = model.to(device)
 
     # FlexGen
     elif shared.args.flexgen:
@@ -120,7 +145,7 @@ def load_model(model_name):
         logging.info(f"DeepSpeed ZeRO-3 is enabled: {is_deepspeed_zero3_enabled()}")
 
     # RMKV model (not on HuggingFace)
-    elif shared.model_type == 'rwkv':
+    elif model_type == 'rwkv':
         from modules.RWKV import RWKVModel, RWKVTokenizer
 
         model = RWKVModel.from_pretrained(Path(f'{shared.args.model_dir}/{model_name}'), dtype="fp32" if shared.args.cpu else "bf16" if shared.args.bf16 else "fp16", device="cpu" if shared.args.cpu else "cuda")
@@ -129,7 +154,7 @@ def load_model(model_name):
         return model, tokenizer
 
     # llamacpp model
-    elif shared.model_type == 'llamacpp':
+    elif model_type == 'llamacpp':
         from modules.llamacpp_model import LlamaCppModel
 
         path = Path(f'{shared.args.model_dir}/{model_name}')
@@ -218,18 +243,22 @@ def load_model(model_name):
 
         model = LoaderClass.from_pretrained(checkpoint, **params)
 
+    if len(profiler.phases) == 0:
+        profiler.add('model', time.time() - t1)
+
     # Hijack attention with xformers
     if any((shared.args.xformers, shared.args.sdp_attention)):
         llama_attn_hijack.hijack_llama_attention()
 
     # Loading the tokenizer
-    if shared.model_type == 'gpt4chan' and Path(f"{shared.args.model_dir}/gpt-j-6B/").exists():
+    t1 = time.time()
+    if model_type == 'gpt4chan' and Path(f"{shared.args.model_dir}/gpt-j-6B/").exists():
         tokenizer = AutoTokenizer.from_pretrained(Path(f"{shared.args.model_dir}/gpt-j-6B/"))
     elif type(model) is transformers.LlamaForCausalLM:
         tokenizer = None
 
         # Try to load an universal LLaMA tokenizer
-        if shared.model_type not in ['llava', 'oasst']:
+        if model_type not in ['llava', 'oasst']:
             for p in [Path(f"{shared.args.model_dir}/llama-tokenizer/"), Path(f"{shared.args.model_dir}/oobabooga_llama-tokenizer/")]:
                 if p.exists():
                     logging.info(f"Loading the universal LLaMA tokenizer from {p}...")
@@ -249,7 +278,8 @@ def load_model(model_name):
     else:
         tokenizer = AutoTokenizer.from_pretrained(Path(f"{shared.args.model_dir}/{model_name}/"), trust_remote_code=trust_remote_code)
 
-    logging.info(f"Loaded the model in {(time.time()-t0):.2f} seconds.")
+    profiler.add('tokenizer', time.time() - t1)
+    logging.info(f"Loaded the model in {(time.time()-t0):.2f} seconds ({profiler.summary()}).")
     return model, tokenizer
 
 
@@ -261,6 +291,10 @@ def clear_torch_cache():
 
 def unload_model():
     shared.model = shared.tokenizer = None
+
+    # The other models kept by the registry are freed too
+    from modules.model_registry import unload_inactive
+    unload_inactive()
     clear_torch_cache()
 
 
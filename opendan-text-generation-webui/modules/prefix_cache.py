@@ -0,0 +1,166 @@
+'''
+Reuses the KV cache of earlier prompts for the transformers backend.
+
+In chat mode, the prompt of turn N+1 is the prompt of turn N plus the reply
+and the new message. The key/value tensors of every prefilled prompt are
+kept here, indexed by a hash of each block of tokens, so that the next
+prompt only needs to prefill the tokens after its longest common prefix
+with a cached one. Entries are evicted in LRU order to stay within
+--prefix-cache-mb.
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+import modules.shared as shared
+
+BLOCK_SIZE = 16
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class CacheEntry:
+    def __init__(self, ids, past_key_values, block_hashes):
+        self.ids = ids
+        self.past_key_values = past_key_values
+        self.block_hashes = block_hashes
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+
+
+class PrefixCache:
+    def __init__(self, model, max_bytes, block_size=BLOCK_SIZE):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()
+        self.index = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Chained hashes of every full block, so that block k identifies ids[:(k + 1) * block_size]
+    def block_hashes(self, ids):
+        hashes = []
+        h = 0
+        for i in range(self.block_size, len(ids) + 1, self.block_size):
+            h = hash((h, tuple(ids[i - self.block_size:i])))
+            hashes.append(h)
+
+        return hashes
+
+    def lookup(self, ids):
+        with self.lock:
+            for h in reversed(self.block_hashes(ids)):
+                if h not in self.index:
+                    continue
+
+                key = next(iter(self.index[h]))
+                entry = self.entries[key]
+                self.entries.move_to_end(key)
+
+                # Verify the match and extend it past the last full block
+                n = min(len(ids), len(entry.ids))
+                length = 0
+                while length < n and ids[length] == entry.ids[length]:
+                    length += 1
+
+                if length > 0:
+                    self.hits += 1
+                    return entry, length
+
+            self.misses += 1
+            return None, 0
+
+    def store(self, ids, past_key_values):
+        key = hash(tuple(ids))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+
+            entry = CacheEntry(ids, past_key_values, self.block_hashes(ids))
+            if entry.nbytes > self.max_bytes:
+                return
+
+            while self.nbytes + entry.nbytes > self.max_bytes:
+                self._evict()
+
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            for h in entry.block_hashes:
+                self.index.setdefault(h, set()).add(key)
+
+    def _evict(self):
+        key, entry = self.entries.popitem(last=False)
+        self.nbytes -= entry.nbytes
+        for h in entry.block_hashes:
+            keys = self.index.get(h)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.index[h]
+
+    # Returns the cache of input_ids[:, :-1], computing only what is not cached yet.
+    # The last token is left out so that generate() still has something to feed.
+    @torch.no_grad()
+    def prefill(self, input_ids):
+        ids = input_ids[0].tolist()
+        target = len(ids) - 1
+        if target <= 0:
+            return None
+
+        entry, length = self.lookup(ids)
+        length = min(length, target)
+        past_key_values = None
+        if entry is not None:
+            past_key_values = tuple((k[:, :, :length], v[:, :, :length]) for k, v in entry.past_key_values)
+
+        if length < target:
+            attention_mask = torch.ones((1, target), dtype=torch.long, device=input_ids.device)
+            output = self.model(input_ids=input_ids[:, length:target], past_key_values=past_key_values, attention_mask=attention_mask, use_cache=True)
+            past_key_values = output.past_key_values
+
+        if shared.args.verbose:
+            logging.info(f"Prefix cache: reused {length} of {len(ids)} prompt tokens.")
+
+        self.store(ids[:target], past_key_values)
+        return past_key_values
+
+
+def can_reuse(generate_params):
+    return all((
+        shared.args.prefix_cache_mb > 0,
+        shared.model_type not in ['HF_seq2seq', 'chatglm'],
+        getattr(getattr(shared.model, 'config', None), 'model_type', None) != 'bloom',
+        'inputs_embeds' not in generate_params,
+        generate_params.get('use_cache', True),
+        not generate_params.get('synced_gpus', False),
+        generate_params.get('num_beams', 1) == 1,
+        generate_params.get('penalty_alpha', 0) == 0,
+    ))
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.model is not shared.model:
+            _cache = PrefixCache(shared.model, int(shared.args.prefix_cache_mb * 1024 * 1024))
+
+        return _cache
+
+
+# Adds the cached prefix of the prompt to generate_params, if possible
+def apply_prefix_cache(generate_params):
+    if not can_reuse(generate_params):
+        return
+
+    input_ids = generate_params['inputs']
+    past_key_values = get_cache().prefill(input_ids)
+    if past_key_values is not None:
+        generate_params['past_key_values'] = past_key_values
+        generate_params['attention_mask'] = torch.ones_like(input_ids)
@@ -0,0 +1,84 @@
+'''
+Per-conversation state.
+
+A Session carries the chat history, the character and a cancel flag
+through prompt building and generation, so that several conversations can
+share the loaded model at the same time and be stopped one by one. The web
+UI keeps using the process-wide shared.history, shared.character and
+shared.stop_everything through default_session.
+'''
+
+import threading
+
+import modules.shared as shared
+
+
+class Session:
+    def __init__(self, history=None, character=None, chat=None, route=None):
+        self.history = history if history is not None else {'internal': [], 'visible': []}
+        self.character = character
+        self.chat = chat  # None follows --chat
+        self.route = route  # the API endpoint, for the metrics
+        self.cancel_event = threading.Event()
+        self.new_tokens = None  # tokens generated so far, set by the backends that have the ids
+
+    def is_chat(self):
+        return shared.is_chat() if self.chat is None else self.chat
+
+    @property
+    def stopped(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def reset(self):
+        self.cancel_event.clear()
+        self.new_tokens = None
+
+
+class DefaultSession(Session):
+
+    """
+    The session of the web UI, backed by the shared module so that the
+    existing code and extensions keep seeing the same state.
+    """
+
+    def __init__(self):
+        self.chat = None
+        self.route = None
+        self.new_tokens = None
+
+    @property
+    def history(self):
+        return shared.history
+
+    @history.setter
+    def history(self, value):
+        shared.history = value
+
+    @property
+    def character(self):
+        return shared.character
+
+    @character.setter
+    def character(self, value):
+        shared.character = value
+
+    @property
+    def stopped(self):
+        return shared.stop_everything
+
+    def cancel(self):
+        shared.stop_everything = True
+
+    def reset(self):
+        shared.stop_everything = False
+        self.new_tokens = None
+
+
+default_session = DefaultSession()
+
+
+def get_session(session=None):
+    return session if session is not None else default_session
@@ -120,6 +120,15 @@ parser.add_argument('--no-cache', action='store_true', help='Set use_cache to Fa
 parser.add_argument('--xformers', action='store_true', help="Use xformer's memory efficient attention. This should increase your tokens/s.")
 parser.add_argument('--sdp-attention', action='store_true', help="Use torch 2.0's sdp attention.")
 parser.add_argument('--trust-remote-code', action='store_true', help="Set trust_remote_code=True while loading a model. Necessary for ChatGLM.")
+parser.add_argument('--continuous-batching', action='store_true', help='Decode concurrent requests together in a single batch that new requests can join between steps. Useful when serving several API clients at once.')
+parser.add_argument('--max-batch-size', type=int, default=16, help='Maximum number of sequences decoded together with --continuous-batching.')
+parser.add_argument('--prefix-cache-mb', type=float, default=0, help='Memory budget in MiB for reusing the KV cache of previous prompts that share a prefix with the current one (for instance, earlier chat turns). 0 disables it.')
+parser.add_argument('--encode-cache-size', type=int, default=4096, help='Maximum number of tokenized strings to keep in memory. 0 disables the tokenizer cache.')
+parser.add_argument('--encode-cache-mb', type=float, default=32, help='Memory budget in MiB for the tokenizer cache.')
+parser.add_argument('--model-vram-budget', type=float, default=0, help='VRAM in GiB for keeping several models loaded at once. The API switches between them with the "model" field of the requests. 0 only keeps the active model on the GPU.')
+parser.add_argument('--model-ram-budget', type=float, default=0, help='RAM in GiB for the models moved out of the GPU by --model-vram-budget, so that switching back to them doesn\'t reload them from disk.')
+parser.add_argument('--preload-models', type=str, nargs="+", help='Models to load in the background at startup, within --model-vram-budget.')
+parser.add_argument('--fast-load', action='store_true', help='Load safetensors models by memory-mapping their shards straight to the GPU, without initializing the weights first. Convert a model with convert-to-safetensors.py to use it.')
 
 # llama.cpp
 parser.add_argument('--threads', type=int, default=0, help='Number of threads to use.')
@@ -4,17 +4,25 @@ import random
 import re
 import time
 import traceback
+from functools import partial
 
 import numpy as np
 import torch
 import transformers
 
 import modules.shared as shared
-from modules.callbacks import (Iteratorize, Stream,
-                               _SentinelTokenStoppingCriteria)
+from modules import batching, metrics
+from modules.callbacks import (Iteratorize, Stream, _BatchStoppingCriteria,
+                               _SentinelTokenStoppingCriteria,
+                               _SessionStoppingCriteria, get_stop_matcher)
+from modules.detokenizer import StreamingDetokenizer
+from modules.encode_cache import cached_encode
 from modules.extensions import apply_extensions
 from modules.html_generator import generate_4chan_html, generate_basic_html
+from modules.model_registry import get_registry
 from modules.models import clear_torch_cache, local_rank
+from modules.prefix_cache import apply_prefix_cache
+from modules.session import get_session
 
 
 def get_max_prompt_length(state):
@@ -25,31 +33,55 @@ def get_max_prompt_length(state):
     return max_length
 
 
-def encode(prompt, add_special_tokens=True, add_bos_token=True, truncation_length=None):
+def _tokenize(prompts, add_special_tokens=True, add_bos_token=True):
     if shared.model_type in ['rwkv', 'llamacpp']:
-        input_ids = shared.tokenizer.encode(str(prompt))
-        input_ids = np.array(input_ids).reshape(1, len(input_ids))
-        return input_ids
+        return [np.array(ids).reshape(1, len(ids)) for ids in map(shared.tokenizer.encode, prompts)]
+
+    # Fast tokenizers encode the whole list in parallel
+    if len(prompts) > 1 and getattr(shared.tokenizer, 'is_fast', False):
+        batch = shared.tokenizer(prompts, add_special_tokens=add_special_tokens)['input_ids']
     else:
-        input_ids = shared.tokenizer.encode(str(prompt), return_tensors='pt', add_special_tokens=add_special_tokens)
+        batch = [shared.tokenizer.encode(prompt, add_special_tokens=add_special_tokens) for prompt in prompts]
+
+    results = []
+    for ids in batch:
+        input_ids = torch.tensor([ids], dtype=torch.long)
 
         # This is a hack for making replies more creative.
-        if not add_bos_token and input_ids[0][0] == shared.tokenizer.bos_token_id:
+        if not add_bos_token and input_ids.shape[1] > 0 and input_ids[0][0] == shared.tokenizer.bos_token_id:
             input_ids = input_ids[:, 1:]
 
         # Llama adds this extra token when the first character is '\n', and this
         # compromises the stopping criteria, so we just remove it
-        if type(shared.tokenizer) is transformers.LlamaTokenizer and input_ids[0][0] == 29871:
+        if type(shared.tokenizer) is transformers.LlamaTokenizer and input_ids.shape[1] > 0 and input_ids[0][0] == 29871:
             input_ids = input_ids[:, 1:]
 
+        results.append(input_ids)
+
+    return results
+
+
+# Returns the CPU token arrays of several prompts at once, without truncation
+def encode_batch(prompts, add_special_tokens=True, add_bos_token=True):
+    prompts = [str(prompt) for prompt in prompts]
+    return cached_encode(prompts, add_special_tokens, add_bos_token, lambda missing: _tokenize(missing, add_special_tokens, add_bos_token))
+
+
+def encode(prompt, add_special_tokens=True, add_bos_token=True, truncation_length=None):
+    input_ids = encode_batch([prompt], add_special_tokens, add_bos_token)[0]
+
+    # The cached array must not be modified by the caller
+    if shared.model_type in ['rwkv', 'llamacpp']:
+        return input_ids.copy()
+
     # Handling truncation
     if truncation_length is not None:
         input_ids = input_ids[:, -truncation_length:]
 
-    if shared.model_type in ['rwkv', 'llamacpp'] or shared.args.cpu:
-        return input_ids
+    if shared.args.cpu:
+        return input_ids.clone()
     elif shared.args.flexgen:
-        return input_ids.numpy()
+        return input_ids.numpy().copy()
     elif shared.args.deepspeed:
         return input_ids.to(device=local_rank)
     elif torch.has_mps:
@@ -93,27 +125,37 @@ def fix_galactica(s):
     return s
 
 
-def get_reply_from_output_ids(output_ids, input_ids, original_question, state):
+def get_reply_from_output_ids(output_ids, input_ids, original_question, state, detokenizer=None, session=None):
+    session = get_session(session)
+    is_chat = session.is_chat()
     if shared.model_type == 'HF_seq2seq':
+        session.new_tokens = len(output_ids)
         reply = decode(output_ids, state['skip_special_tokens'])
-        if not shared.is_chat():
+        if not is_chat:
             reply = apply_extensions('output', reply)
     else:
-        new_tokens = len(output_ids) - len(input_ids[0])
-        reply = decode(output_ids[-new_tokens:], state['skip_special_tokens'])
+        session.new_tokens = len(output_ids) - len(input_ids[0])
+        if detokenizer is not None:
+            reply = detokenizer.update(output_ids)
+
+            # Match the plain decode below, which drops the leading space
+            if type(shared.tokenizer) is transformers.LlamaTokenizer and reply.startswith(' '):
+                reply = reply[1:]
+        else:
+            reply = decode(output_ids[-session.new_tokens:], state['skip_special_tokens'])
 
         if type(shared.tokenizer) is transformers.LlamaTokenizer:
             if len(original_question) > 0 and original_question[-1] not in [' ', '\n']:
                 reply = ' ' + reply
 
-        if not shared.is_chat():
+        if not is_chat:
             reply = original_question + apply_extensions('output', reply)
 
     return reply
 
 
-def formatted_outputs(reply, model_name):
-    if not shared.is_chat():
+def formatted_outputs(reply, model_name, session=None):
+    if not get_session(session).is_chat():
         if shared.model_type == 'galactica':
             reply = fix_galactica(reply)
             return reply, reply, generate_basic_html(reply)
@@ -142,13 +184,23 @@ def stop_everything_event():
     shared.stop_everything = True
 
 
-def generate_reply(question, state, eos_token=None, stopping_strings=[]):
+def generate_reply(question, state, eos_token=None, stopping_strings=[], session=None):
+    # The API can't switch shared.model in the middle of a generation started from the web UI
+    with get_registry().hold():
+        yield from _generate_reply(question, state, eos_token, stopping_strings, session)
+
+
+def _generate_reply(question, state, eos_token, stopping_strings, session):
+    session = get_session(session)
     state = apply_extensions('state', state)
     generate_func = apply_extensions('custom_generate_reply')
-    if generate_func is None:
+    if generate_func is not None:
+        # Extensions don't know about sessions
+        generate_func = partial(_without_session, generate_func)
+    else:
         if shared.model_name == 'None' or shared.model is None:
             logging.error("No model is loaded! Select one in the Model tab.")
-            yield formatted_outputs(question, shared.model_name)
+            yield formatted_outputs(question, shared.model_name, session)
             return
 
         if shared.model_type in ['rwkv', 'llamacpp']:
@@ -160,20 +212,155 @@ def generate_reply(question, state, eos_token=None, stopping_strings=[]):
 
     # Preparing the input
     original_question = question
-    if not shared.is_chat():
+    if not session.is_chat():
         question = apply_extensions('input', question)
 
     if shared.args.verbose:
         print(f'\n\n{question}\n--------------------\n')
 
-    shared.stop_everything = False
+    session.reset()
+    clear_torch_cache()
+    seed = set_manual_seed(state['seed'])
+    for reply in generate_func(question, original_question, seed, state, eos_token, stopping_strings, session=session):
+        yield formatted_outputs(reply, shared.model_name, session)
+
+
+def _without_session(generate_func, *args, session=None):
+    return generate_func(*args)
+
+
+# Generates n replies to each prompt, without streaming. Returns a list of
+# (reply, number of new tokens), the n replies of the first prompt first.
+# The replies are clipped at the first stopping string.
+def generate_choices(prompts, state, n=1, stopping_strings=[], session=None):
+    session = get_session(session)
+    if shared.model_name == 'None' or shared.model is None or shared.model_type in ['rwkv', 'llamacpp', 'HF_seq2seq'] or shared.args.flexgen or shared.soft_prompt or apply_extensions('custom_generate_reply') is not None:
+        return _generate_choices_sequential(prompts, state, n, stopping_strings, session)
+
+    return _generate_choices_batched(prompts, state, n, stopping_strings, session)
+
+
+def _generate_choices_sequential(prompts, state, n, stopping_strings, session):
+    stop_matcher = get_stop_matcher(stopping_strings)
+    choices = []
+    for prompt in prompts:
+        # Outside of chat mode the replies start with the prompt
+        start = 0 if session.is_chat() else len(prompt)
+        for i in range(n):
+            answer = ''
+            for reply in generate_reply(prompt, state, stopping_strings=stopping_strings, session=session):
+                answer = reply if isinstance(reply, str) else reply[0]
+                idx = stop_matcher.find(answer, start)
+                if idx != -1:
+                    answer = answer[:idx]
+                    break
+
+            choices.append((answer, session.new_tokens if session.new_tokens is not None else len(encode(answer)[0])))
+
+            # generate_reply() clears the flag, so check it before the next one
+            if session.stopped:
+                return choices
+
+    return choices
+
+
+# All the replies come from one generate() call: the prompts are padded on
+# the left, each one is sampled n times with num_return_sequences and the
+# batch stops once every sequence has stopped. The tokenizer extensions and
+# the prefix cache only work on single prompts, so they are skipped.
+def _generate_choices_batched(prompts, state, n, stopping_strings, session):
+    state = apply_extensions('state', state)
+    generate_params = {}
+    for k in ['max_new_tokens', 'do_sample', 'temperature', 'top_p', 'typical_p', 'repetition_penalty', 'encoder_repetition_penalty', 'top_k', 'min_length', 'no_repeat_ngram_size', 'num_beams', 'penalty_alpha', 'length_penalty', 'early_stopping']:
+        generate_params[k] = state[k]
+
+    if state['ban_eos_token']:
+        generate_params['suppress_tokens'] = [shared.tokenizer.eos_token_id]
+
+    if shared.args.no_cache:
+        generate_params.update({'use_cache': False})
+
+    if shared.args.deepspeed:
+        generate_params.update({'synced_gpus': True})
+
+    stats = metrics.GenerationMetrics(shared.model_name, 'transformers', session.route)
+    questions = prompts if session.is_chat() else [apply_extensions('input', prompt) for prompt in prompts]
+    rows = [encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))[0] for question in questions]
+    stats.tokenized()
+    eos_token_ids = [shared.tokenizer.eos_token_id] if shared.tokenizer.eos_token_id is not None else []
+    pad_token_id = shared.tokenizer.pad_token_id if shared.tokenizer.pad_token_id is not None else (eos_token_ids[0] if eos_token_ids else 0)
+
+    width = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), width), pad_token_id, dtype=torch.long, device=rows[0].device)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, row in enumerate(rows):
+        input_ids[i, width - len(row):] = row
+        attention_mask[i, width - len(row):] = 1
+
+    sentinel_criteria = None
+    if len(stopping_strings) > 0:
+        sentinel_token_ids = [encode(string, add_special_tokens=False) for string in stopping_strings]
+        sentinel_criteria = _SentinelTokenStoppingCriteria(sentinel_token_ids=sentinel_token_ids, starting_idx=width)
+
+    batch_criteria = _BatchStoppingCriteria(sentinel_criteria, eos_token_ids, len(rows) * n)
+    generate_params.update({
+        'inputs': input_ids,
+        'attention_mask': attention_mask,
+        'num_return_sequences': n,
+        'pad_token_id': pad_token_id,
+        'eos_token_id': eos_token_ids,
+        'stopping_criteria': transformers.StoppingCriteriaList([batch_criteria, _SessionStoppingCriteria(session)]),
+    })
+
+    session.reset()
     clear_torch_cache()
     seed = set_manual_seed(state['seed'])
-    for reply in generate_func(question, original_question, seed, state, eos_token, stopping_strings):
-        yield formatted_outputs(reply, shared.model_name)
+    t0 = time.time()
+    new_tokens = 0
+    failed = False
+    try:
+        with torch.no_grad():
+            output = shared.model.generate(**generate_params)
+
+        stop_matcher = get_stop_matcher(stopping_strings)
+        choices = []
+        for i in range(output.shape[0]):
+            row = rows[i // n]
+            end = int(batch_criteria.ended_at[i]) if batch_criteria.ended_at[i] >= 0 else output.shape[-1]
+            new_ids = output[i, width:end].to(row.device)
+            reply = get_reply_from_output_ids(torch.cat((row, new_ids)), row[None], prompts[i // n], state, session=session)
+            reply = formatted_outputs(reply, shared.model_name, session)
+            if not isinstance(reply, str):
+                reply = reply[0]
+
+            idx = stop_matcher.find(reply, 0 if session.is_chat() else len(prompts[i // n]))
+            choices.append((reply[:idx] if idx != -1 else reply, len(new_ids)))
 
+        t1 = time.time()
+        new_tokens = sum(count for _, count in choices)
+        print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens in {len(choices)} choices, context {width}, seed {seed})')
+    except Exception:
+        # The API has already sent its headers, so this has to end with replies
+        traceback.print_exc()
+        failed = True
+    finally:
+        stats.finish(sum(len(row) for row in rows), new_tokens)
+
+    if failed:
+        if len(rows) * n == 1:
+            return [('', 0)]
+
+        # Often an OOM, which one sequence at a time can get around. The
+        # memory is freed here, once the traceback no longer holds the batch.
+        del generate_params
+        clear_torch_cache()
+        return _generate_choices_sequential(prompts, state, n, stopping_strings, session)
 
-def generate_reply_HF(question, original_question, seed, state, eos_token=None, stopping_strings=[]):
+    return choices
+
+
+def generate_reply_HF(question, original_question, seed, state, eos_token=None, stopping_strings=[], session=None):
+    session = get_session(session)
     generate_params = {}
     for k in ['max_new_tokens', 'do_sample', 'temperature', 'top_p', 'typical_p', 'repetition_penalty', 'encoder_repetition_penalty', 'top_k', 'min_length', 'no_repeat_ngram_size', 'num_beams', 'penalty_alpha', 'length_penalty', 'early_stopping']:
         generate_params[k] = state[k]
@@ -188,7 +375,9 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
         generate_params.update({'synced_gpus': True})
 
     # Encode the input
+    stats = metrics.GenerationMetrics(shared.model_name, 'transformers', session.route)
     input_ids = encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))
+    stats.tokenized()
     output = input_ids[0]
     cuda = not any((shared.args.cpu, shared.args.deepspeed))
 
@@ -219,17 +408,39 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
             stopping_criteria_list.append(_SentinelTokenStoppingCriteria(sentinel_token_ids=sentinel_token_ids, starting_idx=len(input_ids[0])))
             break
 
+    stopping_criteria_list.append(_SessionStoppingCriteria(session))
+
     # Update generate_params with the eos token and the stopping strings
     generate_params['eos_token_id'] = eos_token_ids
     generate_params['stopping_criteria'] = stopping_criteria_list
 
     t0 = time.time()
     try:
-        if not shared.is_chat() and shared.model_type != 'HF_seq2seq':
+        if not session.is_chat() and shared.model_type != 'HF_seq2seq':
             yield original_question
 
+        # Only prefill the part of the prompt that isn't cached yet
+        apply_prefix_cache(generate_params)
+
+        # Only the new tokens are decoded at each step while streaming
+        detokenizer = None
+        if state['stream'] and shared.model_type != 'HF_seq2seq':
+            detokenizer = StreamingDetokenizer(shared.tokenizer, input_ids[0].tolist(), state['skip_special_tokens'])
+
+        # Decode together with the other in-flight requests.
+        if batching.can_batch(generate_params):
+            with batching.submit(generate_params, session) as generator:
+                for output in generator:
+                    if state['stream']:
+                        reply = get_reply_from_output_ids(output, input_ids, original_question, state, detokenizer, session)
+                        stats.update(session.new_tokens)
+                        yield reply
+
+            if not state['stream']:
+                yield get_reply_from_output_ids(output, input_ids, original_question, state, session=session)
+
         # Generate the entire reply at once.
-        if not state['stream']:
+        elif not state['stream']:
             with torch.no_grad():
                 output = shared.model.generate(**generate_params)[0]
                 if cuda:
@@ -238,7 +449,7 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
             if shared.soft_prompt:
                 output = torch.cat((input_ids[0], output[filler_input_ids.shape[1]:]))
 
-            yield get_reply_from_output_ids(output, input_ids, original_question, state)
+            yield get_reply_from_output_ids(output, input_ids, original_question, state, session=session)
 
         # Stream the reply 1 token at a time.
         # This is based on the trick of using 'stopping_criteria' to create an iterator.
@@ -251,14 +462,16 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
                     shared.model.generate(**kwargs)
 
             def generate_with_streaming(**kwargs):
-                return Iteratorize(generate_with_callback, kwargs, callback=None)
+                return Iteratorize(generate_with_callback, kwargs, callback=None, session=session)
 
             with generate_with_streaming(**generate_params) as generator:
                 for output in generator:
                     if shared.soft_prompt:
                         output = torch.cat((input_ids[0], output[filler_input_ids.shape[1]:]))
 
-                    yield get_reply_from_output_ids(output, input_ids, original_question, state)
+                    reply = get_reply_from_output_ids(output, input_ids, original_question, state, detokenizer, session)
+                    stats.update(session.new_tokens)
+                    yield reply
                     if output[-1] in eos_token_ids:
                         break
 
@@ -268,33 +481,37 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
         t1 = time.time()
         original_tokens = len(original_input_ids[0])
         new_tokens = len(output) - (original_tokens if shared.model_type != 'HF_seq2seq' else 0)
+        stats.finish(original_tokens, new_tokens)
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
         return
 
 
-def generate_reply_custom(question, original_question, seed, state, eos_token=None, stopping_strings=[]):
+def generate_reply_custom(question, original_question, seed, state, eos_token=None, stopping_strings=[], session=None):
+    session = get_session(session)
     seed = set_manual_seed(state['seed'])
     generate_params = {'token_count': state['max_new_tokens']}
     for k in ['temperature', 'top_p', 'top_k', 'repetition_penalty']:
         generate_params[k] = state[k]
 
+    stats = metrics.GenerationMetrics(shared.model_name, shared.model_type, session.route)
     t0 = time.time()
     try:
-        if not shared.is_chat():
+        if not session.is_chat():
             yield question
 
         if not state['stream']:
             reply = shared.model.generate(context=question, **generate_params)
             output = original_question + reply
-            if not shared.is_chat():
+            if not session.is_chat():
                 reply = original_question + apply_extensions('output', reply)
 
             yield reply
         else:
 
-            for reply in shared.model.generate_with_streaming(context=question, **generate_params):
+            for reply in shared.model.generate_with_streaming(context=question, session=session, **generate_params):
+                stats.update(stats.tokens + 1)
                 output = original_question + reply
-                if not shared.is_chat():
+                if not session.is_chat():
                     reply = original_question + apply_extensions('output', reply)
 
                 yield reply
@@ -305,11 +522,13 @@ def generate_reply_custom(question, original_question, seed, state, eos_token=No
         t1 = time.time()
         original_tokens = len(encode(original_question)[0])
         new_tokens = len(encode(output)[0]) - original_tokens
+        stats.finish(original_tokens, new_tokens)
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
         return
 
 
-def generate_reply_flexgen(question, original_question, seed, state, eos_token=None, stopping_strings=[]):
+def generate_reply_flexgen(question, original_question, seed, state, eos_token=None, stopping_strings=[], session=None):
+    session = get_session(session)
     generate_params = {}
     for k in ['max_new_tokens', 'do_sample', 'temperature']:
         generate_params[k] = state[k]
@@ -318,7 +537,9 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
         generate_params['max_new_tokens'] = 8
 
     # Encode the input
+    stats = metrics.GenerationMetrics(shared.model_name, 'flexgen', session.route)
     input_ids = encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))
+    stats.tokenized()
     output = input_ids[0]
 
     # Find the eos tokens
@@ -338,7 +559,7 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
 
     t0 = time.time()
     try:
-        if not shared.is_chat():
+        if not session.is_chat():
             yield question
 
         # Generate the entire reply at once.
@@ -346,12 +567,12 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
             with torch.no_grad():
                 output = shared.model.generate(**generate_params)[0]
 
-            yield get_reply_from_output_ids(output, input_ids, original_question, state)
+            yield get_reply_from_output_ids(output, input_ids, original_question, state, session=session)
 
         # Stream the output naively for FlexGen since it doesn't support 'stopping_criteria'
         else:
             for i in range(state['max_new_tokens'] // 8 + 1):
-                if shared.stop_everything:
+                if session.stopped:
                     break
 
                 clear_torch_cache()
@@ -361,7 +582,9 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
                 if np.count_nonzero(np.isin(input_ids[0], eos_token_ids)) < np.count_nonzero(np.isin(output, eos_token_ids)):
                     break
 
-                yield get_reply_from_output_ids(output, original_input_ids, original_question, state)
+                reply = get_reply_from_output_ids(output, original_input_ids, original_question, state, session=session)
+                stats.update(session.new_tokens)
+                yield reply
                 input_ids = np.reshape(output, (1, output.shape[0]))
                 generate_params.update({'inputs': input_ids})
 
@@ -371,5 +594,6 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
         t1 = time.time()
         original_tokens = len(original_input_ids[0])
         new_tokens = len(output) - (original_tokens if shared.model_type != 'HF_seq2seq' else 0)
+        stats.finish(original_tokens, new_tokens)
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
         return
@@ -46,6 +46,7 @@ import modules.extensions as extensions_module
 from modules import chat, shared, training, ui
 from modules.html_generator import chat_html_wrapper
 from modules.LoRA import add_lora_to_model
+from modules.model_registry import get_registry
 from modules.models import load_model, load_soft_prompt, unload_model
 from modules.text_generation import (encode, generate_reply,
                                      stop_everything_event)
@@ -919,6 +920,9 @@ if __name__ == "__main__":
         if shared.args.lora:
             add_lora_to_model(shared.args.lora)
 
+    for model_name in shared.args.preload_models or []:
+        get_registry().preload(model_name)
+
     # Force a character to be loaded
     if shared.is_chat():
         shared.persistent_interface_state.update({
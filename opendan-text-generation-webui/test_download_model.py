@@ -0,0 +1,114 @@
+'''
+Tests of the chunked downloads of download-model.py against a local server
+that answers HEAD and byte range requests. Run from the
+opendan-text-generation-webui folder:
+
+    python -m pytest test_download_model.py
+'''
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+spec = importlib.util.spec_from_file_location('download_model', Path(__file__).parent / 'download-model.py')
+download_model = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(download_model)
+
+PART_SIZE = 1024 * 1024
+DATA = os.urandom(5000000)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+ETAG = '"model"'
+
+
+class StubServer:
+    def __init__(self):
+        self.ignore_ranges = False
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_data(self, body):
+                start, end = 0, len(DATA)
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if match and not stub.ignore_ranges:
+                    start = int(match.group(1))
+                    end = int(match.group(2)) + 1 if match.group(2) else len(DATA)
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(DATA)}')
+                else:
+                    self.send_response(200)
+
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', ETAG)
+                self.send_header('Content-Length', str(end - start))
+                self.end_headers()
+                if body:
+                    try:
+                        self.wfile.write(DATA[start:end])
+                    except ConnectionError:
+                        # The client stopped reading, like after a 200 to a range request
+                        pass
+
+            def do_HEAD(self):
+                self.send_data(False)
+
+            def do_GET(self):
+                self.send_data(True)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/model.bin'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download_model, 'PART_SIZE', PART_SIZE)
+    stub = StubServer()
+    yield stub
+    stub.close()
+
+
+def test_fresh(server, tmp_path):
+    digest = download_model.get_single_file(server.url, tmp_path, connections=4)
+
+    assert digest == SHA256
+    assert (tmp_path / 'model.bin').read_bytes() == DATA
+    assert not (tmp_path / 'model.bin.parts.json').exists()
+
+
+def test_resume(server, tmp_path):
+    # Written offsets that are not multiples of the 8 KiB read buffer
+    parts = [[start, min(start + PART_SIZE, len(DATA)), 0] for start in range(0, len(DATA), PART_SIZE)]
+    parts[0][2] = 500000
+    parts[1][2] = 1000
+    data = bytearray(len(DATA))
+    for start, end, written in parts:
+        data[start:start + written] = DATA[start:start + written]
+
+    (tmp_path / 'model.bin').write_bytes(data)
+    (tmp_path / 'model.bin.parts.json').write_text(json.dumps({'size': len(DATA), 'etag': ETAG, 'parts': parts}))
+
+    digest = download_model.get_single_file(server.url, tmp_path, connections=4)
+
+    assert digest == SHA256
+    assert (tmp_path / 'model.bin').read_bytes() == DATA
+    assert not (tmp_path / 'model.bin.parts.json').exists()
+
+
+def test_ranges_ignored(server, tmp_path):
+    server.ignore_ranges = True
+    with pytest.raises(IOError, match='ignored the byte range'):
+        download_model.get_single_file(server.url, tmp_path, connections=4)
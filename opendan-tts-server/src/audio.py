@@ -0,0 +1,104 @@
+import subprocess
+import threading
+
+import numpy as np
+
+# pause between two sentences
+SILENCE_SECONDS = 0.3
+
+# bark produces about 13 seconds of audio per call, which is roughly this many characters
+MAX_GROUP_CHARS = 180
+
+
+def group_sentences(sentences, max_chars=MAX_GROUP_CHARS):
+    """Merges consecutive short sentences so that each generate_audio call does more work."""
+    groups = []
+    for s in sentences:
+        s = s.strip()
+        if not s:
+            continue
+        if groups and len(groups[-1]) + 1 + len(s) <= max_chars:
+            groups[-1] += " " + s
+        else:
+            groups.append(s)
+    return groups
+
+
+def to_pcm16(audio_array):
+    return (np.clip(audio_array, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def silence(sample_rate, seconds=SILENCE_SECONDS):
+    return np.zeros(int(seconds * sample_rate), dtype=np.int16)
+
+
+def concatenate(audio_arrays, sample_rate, silence_seconds=SILENCE_SECONDS):
+    """Joins the sentences into one 16-bit mono array, with a short pause between them."""
+    parts = []
+    for i, audio_array in enumerate(audio_arrays):
+        if i > 0:
+            parts.append(silence(sample_rate, silence_seconds))
+        parts.append(to_pcm16(audio_array))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+
+
+def _ffmpeg_opus(sample_rate, bitrate, stderr=subprocess.PIPE):
+    return subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", bitrate, "-f", "ogg", "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+
+
+def encode_opus(pcm, sample_rate, bitrate="64k"):
+    """Encodes 16-bit mono PCM to Opus in an OGG container, entirely through pipes."""
+    proc = _ffmpeg_opus(sample_rate, bitrate)
+    out, err = proc.communicate(pcm.tobytes())
+    if proc.returncode != 0:
+        raise RuntimeError("ffmpeg failed: " + err.decode(errors="replace"))
+    return out
+
+
+def stream_opus(audio_arrays, sample_rate, bitrate="64k", chunk_size=4096):
+    """
+    Encodes an iterable of sentence waveforms to OGG/Opus and yields the encoded
+    bytes as soon as ffmpeg produces them, so that playback can start before the
+    last sentence is synthesized.
+    """
+    proc = _ffmpeg_opus(sample_rate, bitrate, stderr=subprocess.DEVNULL)
+    errors = []
+
+    def feed():
+        try:
+            for i, audio_array in enumerate(audio_arrays):
+                if i > 0:
+                    proc.stdin.write(silence(sample_rate).tobytes())
+                proc.stdin.write(to_pcm16(audio_array).tobytes())
+                proc.stdin.flush()
+        except Exception as err:
+            errors.append(err)
+        finally:
+            # Stops a lazy producer (see main.synthesize) from synthesizing what nobody will hear
+            close = getattr(audio_arrays, "close", None)
+            if close is not None:
+                close()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    try:
+        while True:
+            chunk = proc.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        writer.join()
+        proc.wait()
+
+    if errors:
+        raise errors[0]
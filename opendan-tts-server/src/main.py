@@ -1,16 +1,18 @@
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 import schemas
 import uvicorn
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from functions import *
+import audio
 import base64
 import os
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from bark import SAMPLE_RATE, generate_audio, preload_models
-import soundfile as sf
-import wave
-import numpy as np
 import nltk
 
 # fastapi port
@@ -25,27 +27,6 @@ app = FastAPI(docs_url=None, redoc_url=None)
 origins = ["*"]  # set to "*" means all.
 
 
-def concatenate_wavs(wav_files, output_file, silence_duration=0.3):
-    wavs = [wave.open(f, 'rb') for f in wav_files]
-    sampwidth = wavs[0].getsampwidth()
-    framerate = wavs[0].getframerate()
-    nchannels = wavs[0].getnchannels()
-
-    samples = [wav.readframes(wav.getnframes()) for wav in wavs]
-    total_frames = sum(len(s) for s in samples) + int(silence_duration * framerate * nchannels * sampwidth)
-
-    output = wave.open(output_file, 'wb')
-    output.setparams((nchannels, sampwidth, framerate, total_frames, 'NONE', 'Uncompressed'))
-
-    for s in samples:
-        output.writeframes(s)
-        silence_frame = np.zeros((int(silence_duration * framerate), 2)).astype(np.int16).tobytes()
-        for i in range(int(nchannels / 2)):
-            output.writeframes(silence_frame)
-
-    output.close()
-
-
 # Set cross domain parameter transfer
 app.add_middleware(
     CORSMiddleware,
@@ -62,43 +43,68 @@ GIRLFRIEND_PRESETS = {
 }
 
 
+# bark runs on its own thread, so that the event loop stays free and the next
+# sentence is synthesized while the previous one is encoded and sent. bark keeps
+# its models in module globals and concurrent generate_audio calls on them have
+# not been checked to be safe, so more workers are opt-in.
+tts_workers = int(os.environ.get("TTS_WORKERS", 1))
+synth_executor = ThreadPoolExecutor(max_workers=tts_workers)
+
+
+def get_voice_params(item):
+    preset = (item.voice_preset or "sweet").lower()
+    return {
+        "history_prompt": GIRLFRIEND_PRESETS.get(preset, GIRLFRIEND_PRESETS["sweet"]),
+        "text_temp": item.text_temp if item.text_temp is not None else 0.6,
+        "waveform_temp": item.waveform_temp if item.waveform_temp is not None else 0.6,
+    }
+
+
+def synthesize(text, voice_params):
+    """
+    Yields the waveform of each group of sentences, in order. Only tts_workers
+    groups are submitted ahead of the one being consumed, so when the generator
+    is closed (a stream client went away) the rest of the text isn't synthesized.
+    """
+    groups = iter(audio.group_sentences(nltk.sent_tokenize(text)))
+    pending = deque()
+
+    def submit():
+        while len(pending) < tts_workers:
+            group = next(groups, None)
+            if group is None:
+                return
+            pending.append(synth_executor.submit(generate_audio, group, **voice_params))
+
+    try:
+        submit()
+        while pending:
+            waveform = pending.popleft().result()
+            submit()
+            yield waveform
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def tts_to_ogg(item):
+    audio_arrays = list(synthesize(item.text, get_voice_params(item)))
+    pcm = audio.concatenate(audio_arrays, SAMPLE_RATE)
+    return audio.encode_opus(pcm, SAMPLE_RATE)
+
+
 @app.post("/tts_bark/")
 async def tts_bark(item: schemas.generate_web):
     time_start = time.time()
     text = item.text
     print(f"{text=}")
     try:
-        sentences = nltk.sent_tokenize(text)
-        preset = (item.voice_preset or "sweet").lower()
-        history_prompt = GIRLFRIEND_PRESETS.get(preset, GIRLFRIEND_PRESETS["sweet"])
-        text_temp = item.text_temp if item.text_temp is not None else 0.6
-        waveform_temp = item.waveform_temp if item.waveform_temp is not None else 0.6
-        idx = 1
-        wavs = []
-        for s in sentences:
-            audio_array = generate_audio(s, history_prompt=history_prompt, text_temp=text_temp, waveform_temp=waveform_temp)
-            fname = f"tmp-{idx}.wav"
-            sf.write(fname, audio_array, SAMPLE_RATE)
-            idx += 1
-            wavs.append(fname)
-        file_name_pre = f"out-{time.time()}"
-        file_name_wav = file_name_pre + ".wav"
-        file_name_ogg = file_name_pre + ".ogg"
-        concatenate_wavs(wavs, file_name_wav)
-
-        # convert to OGG
-        os.system("ffmpeg -i " + file_name_wav + " -c:a libopus -b:a 64k -y " + file_name_ogg)
-
-        with open(file_name_ogg, "rb") as f:
-            audio_content = f.read()
+        audio_content = await run_in_threadpool(tts_to_ogg, item)
         base64_audio = base64.b64encode(audio_content).decode("utf-8")
         res = {"file_base64": base64_audio,
                "audio_text": text,
-               "file_name": file_name_ogg,
                }
         print_log(item, res, time_start)
-        os.remove(file_name_wav)
-        os.remove(file_name_ogg)
 
         return res
     except Exception as err:
@@ -106,6 +112,14 @@ async def tts_bark(item: schemas.generate_web):
         print_log(item, res, time_start)
         return res
 
+
+# Same as /tts_bark/, but the OGG/Opus bytes are streamed back while the later sentences are still being synthesized
+@app.post("/tts_bark/stream/")
+async def tts_bark_stream(item: schemas.generate_web):
+    print(f"text={item.text!r}")
+    audio_arrays = synthesize(item.text, get_voice_params(item))
+    return StreamingResponse(audio.stream_opus(audio_arrays, SAMPLE_RATE), media_type="audio/ogg")
+
 if __name__ == '__main__':
 
     print_env(server_port)
@@ -3,7 +3,9 @@ import argparse
 import base64
 import sys
 from pathlib import Path
-import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "opendan-text-generation-webui"))
+from modules import http_client
 
 
 def generate_image(
@@ -51,7 +53,7 @@ def generate_image(
             }
         )
 
-    response = requests.post(url=f"{address}/sdapi/v1/txt2img", json=payload, timeout=600)
+    response = http_client.post(f"{address}/sdapi/v1/txt2img", json=payload, timeout=600)
     response.raise_for_status()
     data = response.json()
     if not data.get("images"):
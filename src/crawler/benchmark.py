@@ -0,0 +1,136 @@
+"""Crawl throughput against a local stub site, for several --concurrency values.
+
+The site runs in its own process and serves `--pages` generated pages that
+each link to a few others, with `--latency-ms` of simulated server time per
+response. Run from the repository root:
+
+    python -m src.crawler.benchmark --pages 5000 --concurrency 1 4 16 64
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+
+from .config import CrawlerConfig
+from .main import crawl
+from .util import get_registered_domain
+
+WORDS = (
+    "river stone garden window market letter harbor morning winter summer "
+    "valley bridge candle forest meadow silver copper engine signal paper "
+    "castle orchard lantern island mountain station theater village circle "
+    "mirror planet rocket shadow thunder violin whistle anchor basket blanket "
+    "bottle button camera carpet cookie dragon feather finger flower guitar "
+    "hammer helmet jacket kettle ladder magnet needle pencil pillow puzzle "
+    "rabbit saddle spider sponge tunnel turtle wallet wizard yellow zipper"
+).split()
+
+
+def make_page(index: int, pages: int, links: int, paragraphs: int) -> str:
+    rng = random.Random(index)
+    body = "".join(
+        "<p>" + " ".join(rng.choice(WORDS) for _ in range(60)) + ".</p>"
+        for _ in range(paragraphs)
+    )
+    anchors = "".join(f'<li><a href="/page/{rng.randrange(pages)}">more</a></li>' for _ in range(links))
+    return (
+        f"<html><head><title>Page {index}</title></head><body>"
+        f"<article><h1>Page {index}</h1>{body}</article>"
+        f"<nav><ul>{anchors}</ul></nav></body></html>"
+    )
+
+
+def serve(port: int, pages: int, links: int, paragraphs: int, latency: float) -> None:
+    from aiohttp import web
+
+    async def robots(request: web.Request) -> web.Response:
+        return web.Response(text="User-agent: *\nAllow: /\n")
+
+    async def page(request: web.Request) -> web.Response:
+        index = int(request.match_info["index"])
+        if index >= pages:
+            raise web.HTTPNotFound()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return web.Response(text=make_page(index, pages, links, paragraphs), content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/robots.txt", robots)
+    app.router.add_get("/page/{index}", page)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port: int) -> None:
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"The stub site did not start on port {port}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Crawler throughput benchmark")
+    parser.add_argument("--pages", type=int, default=5000, help="Pages of the stub site")
+    parser.add_argument("--links", type=int, default=8, help="Links on each page")
+    parser.add_argument("--paragraphs", type=int, default=5, help="Paragraphs of 60 words on each page")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Server time of each response")
+    parser.add_argument("--max-pages", type=int, default=None, help="Pages to crawl, all of them by default")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--extract-workers", type=int, default=os.cpu_count() or 1, help="Processes that parse the pages, 0 to parse on the event loop")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = multiprocessing.Process(
+        target=serve,
+        args=(port, args.pages, args.links, args.paragraphs, args.latency_ms / 1000),
+        daemon=True,
+    )
+    server.start()
+
+    try:
+        asyncio.run(wait_for_port(port))
+        with tempfile.TemporaryDirectory() as tmp:
+            seeds_file = os.path.join(tmp, "seeds.txt")
+            seed = f"http://127.0.0.1:{port}/page/0"
+            with open(seeds_file, "w", encoding="utf-8") as f:
+                f.write(seed + "\n")
+
+            print(f"{'concurrency':>11} {'pages':>7} {'seconds':>8} {'pages/s':>8} {'MB/s':>6} {'parse ms':>8}")
+            for concurrency in args.concurrency:
+                cfg = CrawlerConfig(
+                    seeds_file=seeds_file,
+                    allowlist_domains=[get_registered_domain(seed)],
+                    max_pages=args.max_pages or args.pages,
+                    concurrency=concurrency,
+                    per_domain_rps=1e9,
+                    output_path=os.path.join(tmp, f"out-{concurrency}.jsonl"),
+                    timeout_seconds=30,
+                    max_content_chars=100000,
+                    extract_workers=args.extract_workers,
+                )
+                stats = asyncio.run(crawl(cfg))
+                print(
+                    f"{concurrency:>11} {stats.pages:>7} {stats.elapsed:>8.2f} "
+                    f"{stats.pages_per_second:>8.1f} {stats.bytes_per_second / 1e6:>6.2f} {stats.parse_ms_per_page:>8.2f}"
+                )
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
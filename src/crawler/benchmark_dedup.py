@@ -0,0 +1,75 @@
+"""Near-duplicate detection with the SimhashIndex against the linear scan.
+
+A stream of random fingerprints, some of them a few bits away from an
+earlier one, is deduplicated with both methods. The scan is quadratic, so
+it only runs up to `--scan-limit` fingerprints. Run from the repository root:
+
+    python -m src.crawler.benchmark_dedup --sizes 10000 100000 1000000
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+
+from .dedup import SimhashIndex
+from .util import hamming_distance
+
+
+def fingerprints(n: int, duplicates: float, seed: int = 0) -> list[int]:
+    rng = random.Random(seed)
+    result: list[int] = []
+    for _ in range(n):
+        if result and rng.random() < duplicates:
+            fp = rng.choice(result)
+            for _ in range(rng.randrange(6)):
+                fp ^= 1 << rng.randrange(64)
+        else:
+            fp = rng.getrandbits(64)
+        result.append(fp)
+    return result
+
+
+def dedup_scan(stream: list[int]) -> list[bool]:
+    kept: list[int] = []
+    decisions = []
+    for fp in stream:
+        is_dup = any(hamming_distance(fp, prev) <= 3 for prev in kept)
+        if not is_dup:
+            kept.append(fp)
+        decisions.append(is_dup)
+    return decisions
+
+
+def dedup_index(stream: list[int]) -> list[bool]:
+    index = SimhashIndex(max_distance=3)
+    return [not index.add_if_new(fp) for fp in stream]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Near-duplicate detection benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Share of near-duplicates in the stream")
+    parser.add_argument("--scan-limit", type=int, default=20000, help="Largest size measured with the linear scan")
+    args = parser.parse_args()
+
+    print(f"{'pages':>9} {'method':>6} {'seconds':>8} {'us/page':>8} {'dups':>8}")
+    for n in args.sizes:
+        stream = fingerprints(n, args.duplicates)
+
+        t0 = time.perf_counter()
+        index_decisions = dedup_index(stream)
+        elapsed = time.perf_counter() - t0
+        print(f"{n:>9} {'index':>6} {elapsed:>8.2f} {elapsed / n * 1e6:>8.1f} {sum(index_decisions):>8}")
+
+        if n <= args.scan_limit:
+            t0 = time.perf_counter()
+            scan_decisions = dedup_scan(stream)
+            elapsed = time.perf_counter() - t0
+            print(f"{n:>9} {'scan':>6} {elapsed:>8.2f} {elapsed / n * 1e6:>8.1f} {sum(scan_decisions):>8}")
+            if scan_decisions != index_decisions:
+                raise SystemExit("The index and the scan disagree")
+
+
+if __name__ == "__main__":
+    main()
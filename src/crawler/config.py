@@ -1,4 +1,7 @@
+from __future__ import annotations
+
 import argparse
+import os
 from dataclasses import dataclass
 
 DEFAULT_USER_AGENT = (
@@ -16,6 +19,12 @@ class CrawlerConfig:
     output_path: str
     timeout_seconds: int
     max_content_chars: int
+    dedup_index_path: str | None = None
+    extract_workers: int = 0
+    state_dir: str | None = None
+    resume: bool = False
+    robots_ttl_seconds: float = 3600.0
+    robots_cache_path: str | None = None
 
 
 def parse_args() -> CrawlerConfig:
@@ -27,6 +36,12 @@ def parse_args() -> CrawlerConfig:
     parser.add_argument("--output", required=True, help="Output JSONL path")
     parser.add_argument("--timeout", type=int, default=20)
     parser.add_argument("--max-content-chars", type=int, default=100000)
+    parser.add_argument("--dedup-index", default=None, help="File that keeps the page fingerprints between crawls")
+    parser.add_argument("--extract-workers", type=int, default=os.cpu_count() or 1, help="Processes that parse the pages, 0 to parse on the event loop")
+    parser.add_argument("--state-dir", default=None, help="Directory of the frontier and the checkpoints, <output>.state by default")
+    parser.add_argument("--resume", action="store_true", help="Continue the crawl from the last checkpoint in --state-dir")
+    parser.add_argument("--robots-ttl", type=float, default=3600.0, help="Seconds before a robots.txt is fetched again")
+    parser.add_argument("--robots-cache", default=None, help="SQLite file that keeps the robots.txt files between crawls")
     args = parser.parse_args()
 
     with open(args.seeds, "r", encoding="utf-8") as f:
@@ -53,4 +68,10 @@ def parse_args() -> CrawlerConfig:
         output_path=args.output,
         timeout_seconds=args.timeout,
         max_content_chars=args.max_content_chars,
+        dedup_index_path=args.dedup_index,
+        extract_workers=args.extract_workers,
+        state_dir=args.state_dir,
+        resume=args.resume,
+        robots_ttl_seconds=args.robots_ttl,
+        robots_cache_path=args.robots_cache,
     )
\ No newline at end of file
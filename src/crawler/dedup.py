@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import os
+
+import numpy as np
+
+# Bits set in every byte value, for NumPy versions without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class SimhashIndex:
+    """Finds the 64-bit simhashes within `max_distance` bits of a new one.
+
+    The fingerprints are split into `max_distance + 1` bands: two
+    fingerprints that differ in at most `max_distance` bits have at least
+    one identical band. Every band has a sorted table of its values, so
+    the candidates are found with a binary search per band and then
+    checked all at once with a vectorized popcount.
+
+    New fingerprints go to a small buffer that is scanned linearly and
+    merged into the tables once it holds `merge_every` of them.
+    """
+
+    def __init__(self, max_distance: int = 3, merge_every: int = 4096):
+        bands = max_distance + 1
+        if bands > 64:
+            raise ValueError("max_distance must be below 64")
+
+        self.max_distance = max_distance
+        self.merge_every = merge_every
+
+        # (shift, mask) of each band, the first ones one bit wider when 64 doesn't divide evenly
+        widths = [64 // bands + (1 if i < 64 % bands else 0) for i in range(bands)]
+        self._bands: list[tuple[np.uint64, np.uint64]] = []
+        shift = 0
+        for width in widths:
+            self._bands.append((np.uint64(shift), np.uint64((1 << width) - 1)))
+            shift += width
+
+        self._fingerprints = np.empty(1024, dtype=np.uint64)
+        self._size = 0
+        self._indexed = 0
+        self._keys = [np.empty(0, dtype=np.uint64) for _ in self._bands]
+        self._order = [np.empty(0, dtype=np.int64) for _ in self._bands]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _band_values(self, values: np.ndarray, band: int) -> np.ndarray:
+        shift, mask = self._bands[band]
+        return (values >> shift) & mask
+
+    def contains_near(self, fingerprint: int) -> bool:
+        fp = np.uint64(fingerprint)
+        candidates = [self._fingerprints[self._indexed:self._size]]
+        for band, (shift, mask) in enumerate(self._bands):
+            value = (fp >> shift) & mask
+            keys = self._keys[band]
+            lo = np.searchsorted(keys, value, side="left")
+            hi = np.searchsorted(keys, value, side="right")
+            if hi > lo:
+                candidates.append(self._fingerprints[self._order[band][lo:hi]])
+
+        candidates = np.concatenate(candidates)
+        if len(candidates) == 0:
+            return False
+        return bool((popcount(candidates ^ fp) <= self.max_distance).any())
+
+    def add(self, fingerprint: int) -> None:
+        if self._size == len(self._fingerprints):
+            grown = np.empty(2 * len(self._fingerprints), dtype=np.uint64)
+            grown[:self._size] = self._fingerprints[:self._size]
+            self._fingerprints = grown
+
+        self._fingerprints[self._size] = np.uint64(fingerprint)
+        self._size += 1
+        if self._size - self._indexed >= self.merge_every:
+            self._merge()
+
+    def add_if_new(self, fingerprint: int) -> bool:
+        """Adds the fingerprint unless it is a near-duplicate. Returns True if it was added."""
+        if self.contains_near(fingerprint):
+            return False
+        self.add(fingerprint)
+        return True
+
+    def _merge(self) -> None:
+        new = np.arange(self._indexed, self._size, dtype=np.int64)
+        for band in range(len(self._bands)):
+            values = self._band_values(self._fingerprints[new], band)
+            sort = np.argsort(values, kind="stable")
+            values, rows = values[sort], new[sort]
+            positions = np.searchsorted(self._keys[band], values, side="right")
+            self._keys[band] = np.insert(self._keys[band], positions, values)
+            self._order[band] = np.insert(self._order[band], positions, rows)
+        self._indexed = self._size
+
+    def _rebuild(self) -> None:
+        rows = np.arange(self._size, dtype=np.int64)
+        for band in range(len(self._bands)):
+            values = self._band_values(self._fingerprints[:self._size], band)
+            sort = np.argsort(values, kind="stable")
+            self._keys[band] = values[sort]
+            self._order[band] = rows[sort]
+        self._indexed = self._size
+
+    def save(self, path: str) -> None:
+        # Only the fingerprints are stored, the tables are rebuilt on load
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, self._fingerprints[:self._size])
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, max_distance: int = 3, merge_every: int = 4096) -> SimhashIndex:
+        index = cls(max_distance=max_distance, merge_every=merge_every)
+        if os.path.exists(path):
+            fingerprints = np.load(path)
+            index._fingerprints = np.empty(max(1024, 2 * len(fingerprints)), dtype=np.uint64)
+            index._fingerprints[:len(fingerprints)] = fingerprints
+            index._size = len(fingerprints)
+            index._rebuild()
+        return index
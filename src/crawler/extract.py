@@ -1,10 +1,16 @@
 from __future__ import annotations
 
-from typing import Iterable
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml.etree import ParserError
 from readability import Document
+from readability.htmls import shorten_title
+from readability.readability import Unparseable
 
 
 SFW_BLOCK_KEYWORDS = {
@@ -16,17 +22,42 @@ SFW_BLOCK_KEYWORDS = {
     "explicit",
 }
 
+_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+
+class _Document(Document):
+    # Keeps the cleaned article tree, so that its text doesn't have to be parsed back from the summary
+    def get_clean_html(self):
+        self.article = self.html
+        return super().get_clean_html()
+
+
+def _text(element) -> str:
+    for unwanted in element.xpath(".//script|.//style|.//noscript"):
+        unwanted.drop_tree()
+    return " ".join(s.strip() for s in element.itertext() if s.strip())
+
 
 def extract_content_and_links(url: str, html: str, max_chars: int) -> tuple[str | None, list[str]]:
-    doc = Document(html)
-    title = (doc.short_title() or "").strip()
-    summary_html = doc.summary(html_partial=True)
+    # One lxml tree is shared by the link discovery and readability, which works on copies of it
+    try:
+        tree = lxml.html.document_fromstring(html.encode("utf-8", "replace"), parser=_HTML_PARSER)
+    except (ParserError, ValueError):
+        return None, []
+
+    # Discover links from original HTML for better coverage
+    links = [urljoin(url, href) for href in tree.xpath("//a/@href")]
+
+    doc = _Document(tree)
+    try:
+        doc.summary(html_partial=True)
+    except Unparseable:
+        return None, []
 
-    soup = BeautifulSoup(summary_html, "lxml")
-    for unwanted in soup(["script", "style", "noscript"]):
-        unwanted.decompose()
+    # The hidden elements are now gone from the tree, the title comes out as from doc.short_title()
+    title = (shorten_title(tree) or "").strip()
 
-    text = soup.get_text(" ", strip=True)
+    text = _text(doc.article)
 
     text_lower = text.lower()
     if any(k in text_lower for k in SFW_BLOCK_KEYWORDS):
@@ -38,12 +69,37 @@ def extract_content_and_links(url: str, html: str, max_chars: int) -> tuple[str
     if len(text) > max_chars:
         text = text[:max_chars]
 
-    # Discover links from original HTML for better coverage
-    soup_all = BeautifulSoup(html, "lxml")
-    links: list[str] = []
-    for a in soup_all.find_all("a", href=True):
-        href = a.get("href")
-        absolute = urljoin(url, href)
-        links.append(absolute)
-
-    return (f"{title}\n\n{text}" if title else text), links
\ No newline at end of file
+    return (f"{title}\n\n{text}" if title else text), links
+
+
+def timed_extract(url: str, html: str, max_chars: int) -> tuple[str | None, list[str], float]:
+    t0 = time.perf_counter()
+    text, links = extract_content_and_links(url, html, max_chars)
+    return text, links, time.perf_counter() - t0
+
+
+class ExtractionPool:
+    """Runs the extraction in worker processes, off the event loop.
+
+    At most `max_in_flight` pages are handed to the workers at once, the
+    other fetchers wait for a slot. With no workers, pages are extracted on
+    the event loop.
+    """
+
+    def __init__(self, workers: int, max_in_flight: int | None = None):
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self._slots = asyncio.Semaphore(max_in_flight or 2 * max(1, workers))
+
+    async def extract(self, url: str, html: str, max_chars: int) -> tuple[str | None, list[str], float]:
+        if self._executor is None:
+            return timed_extract(url, html, max_chars)
+
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, timed_extract, url, html, max_chars)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
@@ -15,17 +15,18 @@ class DomainLimiter:
         return self._limiters[domain]
 
 
-async def fetch_text(session: aiohttp.ClientSession, url: str, timeout_s: int, limiter: AsyncLimiter) -> tuple[int | None, str | None]:
+async def fetch_text(session: aiohttp.ClientSession, url: str, timeout_s: int, limiter: AsyncLimiter) -> tuple[int | None, str | None, int]:
+    """Returns the status, the HTML (None if the page isn't HTML) and the size of the body."""
     async with limiter:
         try:
             async with session.get(url, timeout=timeout_s) as resp:
                 status = resp.status
                 if status != 200:
-                    return status, None
+                    return status, None, 0
                 content_type = resp.headers.get("Content-Type", "")
                 if "text/html" not in content_type and "application/xhtml+xml" not in content_type:
-                    return status, None
-                text = await resp.text(errors="ignore")
-                return status, text
+                    return status, None, 0
+                body = await resp.read()
+                return status, body.decode(resp.get_encoding(), errors="ignore"), len(body)
         except Exception:
-            return None, None
\ No newline at end of file
+            return None, None, 0
\ No newline at end of file
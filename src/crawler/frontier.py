@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import sqlite3
+from collections import deque
+
+
+class BloomFilter:
+    """Fixed-size set of strings with false positives but no false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> bool:
+        if not os.path.exists(path) or os.path.getsize(path) != len(self.bits):
+            return False
+        with open(path, "rb") as f:
+            f.readinto(self.bits)
+        return True
+
+
+class Frontier:
+    """URLs to crawl and URLs ever enqueued, kept in SQLite.
+
+    Every URL is enqueued at most once: the `seen` table is the exact set,
+    and the Bloom filter in front of it answers "never seen" without a
+    query. URLs handed out by pop() stay in the table until complete() is
+    called, so the ones in flight when the process dies are crawled again
+    on resume. Changes reach the disk on checkpoint().
+    """
+
+    def __init__(self, directory: str, resume: bool = False, bloom_capacity: int = 10_000_000, batch_size: int = 256):
+        os.makedirs(directory, exist_ok=True)
+        self._db_path = os.path.join(directory, "frontier.sqlite3")
+        self._bloom_path = os.path.join(directory, "seen.bloom")
+        if not resume:
+            for path in (self._db_path, self._db_path + "-wal", self._db_path + "-shm", self._bloom_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self._db = sqlite3.connect(self._db_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS seen (url TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, taken INTEGER NOT NULL DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS queue_pending ON queue (taken, id);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        # What was in flight when the last run stopped is pending again
+        self._db.execute("UPDATE queue SET taken = 0 WHERE taken = 1")
+
+        self._bloom = BloomFilter(bloom_capacity)
+        if not self._bloom.load(self._bloom_path):
+            for (url,) in self._db.execute("SELECT url FROM seen"):
+                self._bloom.add(url)
+
+        self._batch_size = batch_size
+        self._buffer: deque[tuple[int, str]] = deque()
+
+    def add(self, urls: list[str]) -> int:
+        added = 0
+        for url in urls:
+            # A miss in the Bloom filter means the URL is new, a hit has to be checked
+            if url in self._bloom and self._db.execute("SELECT 1 FROM seen WHERE url = ?", (url,)).fetchone():
+                continue
+            if self._db.execute("INSERT OR IGNORE INTO seen (url) VALUES (?)", (url,)).rowcount == 0:
+                continue
+            self._db.execute("INSERT INTO queue (url) VALUES (?)", (url,))
+            self._bloom.add(url)
+            added += 1
+        return added
+
+    def pop(self) -> tuple[int, str] | None:
+        if not self._buffer:
+            rows = self._db.execute(
+                "SELECT id, url FROM queue WHERE taken = 0 ORDER BY id LIMIT ?", (self._batch_size,)
+            ).fetchall()
+            if rows:
+                self._db.execute(
+                    f"UPDATE queue SET taken = 1 WHERE id IN ({','.join('?' * len(rows))})", [row[0] for row in rows]
+                )
+            self._buffer.extend(rows)
+        return self._buffer.popleft() if self._buffer else None
+
+    def complete(self, entry_id: int) -> None:
+        self._db.execute("DELETE FROM queue WHERE id = ?", (entry_id,))
+
+    def pending(self) -> int:
+        return len(self._buffer) + self._db.execute("SELECT COUNT(*) FROM queue WHERE taken = 0").fetchone()[0]
+
+    def get_state(self, key: str, default: str | None = None) -> str | None:
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key: str, value: str) -> None:
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def checkpoint(self) -> None:
+        self._db.commit()
+        self._bloom.save(self._bloom_path)
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._db.close()
@@ -2,94 +2,267 @@ from __future__ import annotations
 
 import asyncio
 import json
-from collections import deque
-from typing import Set
+import os
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from urllib.parse import urldefrag, urlparse
 
 import aiohttp
 import orjson
 
 from .config import CrawlerConfig, DEFAULT_USER_AGENT, parse_args
-from .robots import RobotsCache
+from .robots import RobotsCache, aiohttp_fetcher
 from .fetch import DomainLimiter, fetch_text
-from .extract import extract_content_and_links
-from .util import normalize_url, is_domain_allowed, content_simhash, hamming_distance
+from .extract import ExtractionPool
+from .dedup import SimhashIndex
+from .frontier import Frontier
+from .util import normalize_url, is_domain_allowed, content_simhash
+
+
+CHECKPOINT_SECONDS = 10.0
+
+
+@lru_cache(maxsize=1 << 16)
+def canonical_url(url: str) -> str | None:
+    # url_normalize takes ~0.1 ms, and the same navigation links turn up on most pages of a site
+    url, _ = urldefrag(url)
+    if urlparse(url).scheme not in ("http", "https"):
+        return None
+    try:
+        return normalize_url(url)
+    except (ValueError, UnicodeError):
+        return None
 
 
 class JsonlWriter:
-    def __init__(self, path: str):
+    def __init__(self, path: str, offset: int | None = None):
         self._path = path
-        self._fp = open(path, "wb")
+        if offset is None:
+            self._fp = open(path, "wb")
+        else:
+            # Resuming: what was written after the last checkpoint is written again
+            self._fp = open(path, "r+b" if os.path.exists(path) else "wb")
+            self._fp.truncate(offset)
+            self._fp.seek(offset)
 
     def write(self, obj: dict) -> None:
         self._fp.write(orjson.dumps(obj) + b"\n")
 
+    def flush(self) -> int:
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        return self._fp.tell()
+
     def close(self) -> None:
         self._fp.close()
 
 
-async def crawl(cfg: CrawlerConfig) -> None:
-    seeds: list[str] = []
-    with open(cfg.seeds_file, "r", encoding="utf-8") as f:
-        seeds = [line.strip() for line in f if line.strip()]
+@dataclass
+class CrawlStats:
+    pages: int = 0
+    fetched: int = 0
+    bytes: int = 0
+    parsed: int = 0
+    parse_seconds: float = 0.0
+    started: float = field(default_factory=time.monotonic)
+    finished: float | None = None
 
-    queue: deque[str] = deque(seeds)
-    visited: Set[str] = set()
-    fingerprints: list[int] = []
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
 
-    robots = RobotsCache(user_agent=DEFAULT_USER_AGENT)
-    domain_limiter = DomainLimiter(cfg.per_domain_rps)
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed if self.elapsed > 0 else 0.0
 
-    connector = aiohttp.TCPConnector(limit=cfg.concurrency)
-    timeout = aiohttp.ClientTimeout(total=cfg.timeout_seconds)
-    headers = {"User-Agent": DEFAULT_USER_AGENT}
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
 
-    writer = JsonlWriter(cfg.output_path)
+    @property
+    def parse_ms_per_page(self) -> float:
+        return 1000 * self.parse_seconds / self.parsed if self.parsed > 0 else 0.0
 
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
-        pages_collected = 0
-        while queue and pages_collected < cfg.max_pages:
-            url = normalize_url(queue.popleft())
-            if url in visited:
-                continue
-            visited.add(url)
+    def summary(self) -> str:
+        return (
+            f"{self.pages} pages ({self.fetched} fetched, {self.bytes / 1e6:.1f} MB) in {self.elapsed:.1f}s: "
+            f"{self.pages_per_second:.1f} pages/s, {self.bytes_per_second / 1e6:.2f} MB/s, "
+            f"parse {self.parse_ms_per_page:.1f} ms/page"
+        )
 
-            if not is_domain_allowed(url, cfg.allowlist_domains):
-                continue
 
-            if not await robots.allowed(session, url):
-                continue
+class Crawler:
+    """Runs `concurrency` workers that pull URLs from one shared frontier.
 
-            status, html = await fetch_text(session, url, cfg.timeout_seconds, domain_limiter.for_url(url))
-            if status != 200 or not html:
-                continue
+    The frontier and the set of URLs already enqueued live on disk (see
+    Frontier), so memory stays flat however large the crawl gets. The
+    bookkeeping (frontier, fingerprints, page count, output) is only
+    touched between awaits, so the workers, which all run on the same event
+    loop, never see it half updated, and a checkpoint taken between two
+    awaits is consistent. Every `CHECKPOINT_SECONDS` the output is flushed
+    and its length stored with the frontier, so a resumed crawl continues
+    from the last checkpoint.
+    """
 
-            text, links = extract_content_and_links(url, html, cfg.max_content_chars)
-            if not text:
-                continue
+    def __init__(self, cfg: CrawlerConfig, session: aiohttp.ClientSession, writer: JsonlWriter, extractor: ExtractionPool, frontier: Frontier, fingerprints: SimhashIndex, fingerprints_path: str):
+        self.cfg = cfg
+        self.session = session
+        self.writer = writer
+        self.extractor = extractor
+        self.frontier = frontier
+        self.fingerprints = fingerprints
+        self.fingerprints_path = fingerprints_path
+        self.robots = RobotsCache(DEFAULT_USER_AGENT, aiohttp_fetcher(session), cfg.robots_ttl_seconds, cfg.robots_cache_path)
+        self.domain_limiter = DomainLimiter(cfg.per_domain_rps)
+        self.stats = CrawlStats()
+        self.done = asyncio.Event()
+        # Pages written by the runs this one resumes, they count towards max_pages
+        self.previous_pages = int(frontier.get_state("pages", "0"))
+        self._busy = 0
+        self._changed = asyncio.Condition()
+
+    def enqueue(self, urls: list[str]) -> int:
+        """Normalizes the URLs and adds the allowed ones that were never enqueued before."""
+        allowed = []
+        for url in urls:
+            url = canonical_url(url)
+            if url is not None and is_domain_allowed(url, self.cfg.allowlist_domains):
+                allowed.append(url)
+        return self.frontier.add(allowed)
+
+    def checkpoint(self) -> None:
+        self.frontier.set_state("pages", str(self.previous_pages + self.stats.pages))
+        self.frontier.set_state("output_offset", str(self.writer.flush()))
+        self.fingerprints.save(self.fingerprints_path)
+        self.frontier.checkpoint()
+
+    async def run(self, seeds: list[str]) -> CrawlStats:
+        self.enqueue(seeds)
+        if self.previous_pages >= self.cfg.max_pages:
+            self.done.set()
 
-            fp = content_simhash(text)
-            is_dup = any(hamming_distance(fp, prev) <= 3 for prev in fingerprints)
-            if is_dup:
+        workers = [asyncio.create_task(self._worker()) for _ in range(max(1, self.cfg.concurrency))]
+        stopped = asyncio.create_task(self.done.wait())
+        checkpoints = asyncio.create_task(self._checkpoint_periodically())
+        try:
+            await asyncio.wait([stopped, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in workers:
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            # The pages in flight when the crawl stops stay in the frontier for the next run
+            for task in workers + [stopped, checkpoints]:
+                task.cancel()
+            await asyncio.gather(*workers, stopped, checkpoints, return_exceptions=True)
+            self.checkpoint()
+            self.robots.close()
+            self.stats.finished = time.monotonic()
+
+        return self.stats
+
+    async def _checkpoint_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(CHECKPOINT_SECONDS)
+            self.checkpoint()
+
+    async def _worker(self) -> None:
+        while not self.done.is_set():
+            entry = self.frontier.pop()
+            if entry is None:
+                if self._busy == 0:
+                    # Nothing pending and no one left to discover more
+                    self.done.set()
+                    break
+                async with self._changed:
+                    await self._changed.wait()
                 continue
-            fingerprints.append(fp)
 
-            writer.write({
-                "url": url,
-                "text": text,
-            })
-            pages_collected += 1
+            entry_id, url = entry
+            self._busy += 1
+            try:
+                # Pages cut short by the end of the crawl, or by an error, stay pending for the next run
+                if await self._process(url):
+                    self.frontier.complete(entry_id)
+            finally:
+                self._busy -= 1
+                async with self._changed:
+                    self._changed.notify_all()
+
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _process(self, url: str) -> bool:
+        """Returns False if the crawl stopped before the page was dealt with."""
+        if self.done.is_set():
+            return False
+
+        if not await self.robots.allowed(url):
+            return True
+
+        status, html, nbytes = await fetch_text(self.session, url, self.cfg.timeout_seconds, self.domain_limiter.for_url(url))
+        self.stats.fetched += 1
+        self.stats.bytes += nbytes
+        if status != 200 or not html:
+            return True
+
+        text, links, parse_seconds = await self.extractor.extract(url, html, self.cfg.max_content_chars)
+        self.stats.parsed += 1
+        self.stats.parse_seconds += parse_seconds
+        if self.done.is_set():
+            return False
+        if not text:
+            return True
+
+        if not self.fingerprints.add_if_new(content_simhash(text)):
+            return True
+
+        self.writer.write({
+            "url": url,
+            "text": text,
+        })
+        self.stats.pages += 1
+        self.enqueue(links)
+        if self.previous_pages + self.stats.pages >= self.cfg.max_pages:
+            self.done.set()
+        return True
+
+
+async def crawl(cfg: CrawlerConfig) -> CrawlStats:
+    seeds: list[str] = []
+    with open(cfg.seeds_file, "r", encoding="utf-8") as f:
+        seeds = [line.strip() for line in f if line.strip()]
+
+    connector = aiohttp.TCPConnector(limit=cfg.concurrency)
+    timeout = aiohttp.ClientTimeout(total=cfg.timeout_seconds)
+    headers = {"User-Agent": DEFAULT_USER_AGENT}
 
-            for link in links:
-                if link not in visited:
-                    queue.append(link)
+    state_dir = cfg.state_dir or cfg.output_path + ".state"
+    frontier = Frontier(state_dir, resume=cfg.resume)
+    fingerprints_path = cfg.dedup_index_path or os.path.join(state_dir, "fingerprints.npy")
+    if cfg.resume or cfg.dedup_index_path:
+        fingerprints = SimhashIndex.load(fingerprints_path)
+    else:
+        fingerprints = SimhashIndex()
 
-    writer.close()
+    offset = frontier.get_state("output_offset")
+    writer = JsonlWriter(cfg.output_path, int(offset) if cfg.resume and offset is not None else None)
+    extractor = ExtractionPool(cfg.extract_workers)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            crawler = Crawler(cfg, session, writer, extractor, frontier, fingerprints, fingerprints_path)
+            return await crawler.run(seeds)
+    finally:
+        extractor.close()
+        writer.close()
+        frontier.close()
 
 
 def main() -> None:
     cfg = parse_args()
-    asyncio.run(crawl(cfg))
+    stats = asyncio.run(crawl(cfg))
+    print(stats.summary())
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,32 +1,103 @@
+from __future__ import annotations
+
 import asyncio
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable
+from urllib import robotparser
 from urllib.parse import urlparse
 
-import aiohttp
-from urllib import robotparser
+if TYPE_CHECKING:
+    import aiohttp
+
+# Takes the robots.txt URL, returns its text, or None when there is none (anything but a 200)
+RobotsFetcher = Callable[[str], Awaitable["str | None"]]
+
+
+def aiohttp_fetcher(session: aiohttp.ClientSession, timeout_s: float = 10) -> RobotsFetcher:
+    async def fetch(robots_url: str) -> str | None:
+        async with session.get(robots_url, timeout=timeout_s) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.text(errors="ignore")
+
+    return fetch
+
+
+def _parse(body: str | None) -> robotparser.RobotFileParser:
+    rp = robotparser.RobotFileParser()
+    rp.parse((body or "").splitlines())
+    return rp
 
 
 class RobotsCache:
-    def __init__(self, user_agent: str):
+    """robots.txt rules of every origin, fetched once per `ttl_seconds`.
+
+    Concurrent checks against one origin share a single fetch, while checks
+    against other origins go on. With a `cache_path`, the robots.txt bodies
+    and their fetch times are also kept in SQLite, so later runs reuse them
+    until they expire. An origin whose robots.txt can't be fetched is
+    treated as allowing everything, until the entry expires.
+    """
+
+    def __init__(self, user_agent: str, fetch: RobotsFetcher, ttl_seconds: float = 3600.0, cache_path: str | None = None):
         self._user_agent = user_agent
-        self._cache: dict[str, robotparser.RobotFileParser] = {}
-        self._lock = asyncio.Lock()
+        self._fetch = fetch
+        self._ttl = ttl_seconds
+        self._cache: dict[str, tuple[float, robotparser.RobotFileParser]] = {}
+        self._in_flight: dict[str, asyncio.Future[robotparser.RobotFileParser]] = {}
+        self._db = None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(cache_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS robots (origin TEXT PRIMARY KEY, fetched_at REAL NOT NULL, body TEXT)"
+            )
+            self._db.commit()
 
-    async def allowed(self, session: aiohttp.ClientSession, url: str) -> bool:
+    async def allowed(self, url: str) -> bool:
         parsed = urlparse(url)
         origin = f"{parsed.scheme}://{parsed.netloc}"
-        async with self._lock:
-            rp = self._cache.get(origin)
-            if rp is None:
-                rp = robotparser.RobotFileParser()
-                robots_url = origin.rstrip("/") + "/robots.txt"
-                try:
-                    async with session.get(robots_url, timeout=10) as resp:
-                        if resp.status == 200:
-                            body = await resp.text(errors="ignore")
-                            rp.parse(body.splitlines())
-                        else:
-                            rp.parse([])
-                except Exception:
-                    rp.parse([])
-                self._cache[origin] = rp
-        return self._cache[origin].can_fetch(self._user_agent, url)
\ No newline at end of file
+        rp = await self._rules(origin)
+        return rp.can_fetch(self._user_agent, url)
+
+    async def _rules(self, origin: str) -> robotparser.RobotFileParser:
+        entry = self._cache.get(origin)
+        if entry is not None and time.time() - entry[0] < self._ttl:
+            return entry[1]
+
+        future = self._in_flight.get(origin)
+        if future is None:
+            future = asyncio.ensure_future(self._load(origin))
+            self._in_flight[origin] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(origin, None))
+        # One caller being cancelled mustn't cancel the fetch the others wait for
+        return await asyncio.shield(future)
+
+    async def _load(self, origin: str) -> robotparser.RobotFileParser:
+        if self._db is not None:
+            row = self._db.execute("SELECT fetched_at, body FROM robots WHERE origin = ?", (origin,)).fetchone()
+            if row is not None and time.time() - row[0] < self._ttl:
+                rp = _parse(row[1])
+                self._cache[origin] = (row[0], rp)
+                return rp
+
+        fetched_at = time.time()
+        try:
+            body = await self._fetch(origin + "/robots.txt")
+        except Exception:
+            body = None
+        rp = _parse(body)
+        self._cache[origin] = (fetched_at, rp)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO robots (origin, fetched_at, body) VALUES (?, ?, ?)", (origin, fetched_at, body)
+            )
+            self._db.commit()
+        return rp
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None